@@ -3,9 +3,13 @@ import sys
 import os
 import argparse
 import logging
+import socket
+import multiprocessing
 
 import utils
 import models
+import notifier
+import bulkcheckin
 
 
 logger = logging.getLogger('balaio.main')
@@ -28,8 +32,31 @@ if __name__ == '__main__':
     parser.add_argument('--alembic-config',
                         action='store',
                         dest='alembic_configfile')
+    parser.add_argument('--file-list',
+                        action='store',
+                        dest='file_list',
+                        help='bulkcheckin: file with one package per line')
+    parser.add_argument('--workers',
+                        action='store',
+                        dest='workers',
+                        type=int,
+                        default=multiprocessing.cpu_count(),
+                        help='bulkcheckin: number of analysis processes')
+    parser.add_argument('--batch-size',
+                        action='store',
+                        dest='batch_size',
+                        type=int,
+                        default=100,
+                        help='bulkcheckin: number of packages per transaction')
+    parser.add_argument('--no-validation',
+                        action='store_false',
+                        dest='validation',
+                        help='bulkcheckin: do not send the attempts to the validator')
     parser.add_argument('activity',
-                        choices=['syncdb', 'shell'])
+                        choices=['syncdb', 'shell', 'bulkcheckin'])
+    parser.add_argument('paths',
+                        nargs='*',
+                        help='bulkcheckin: packages or directories of packages')
 
     args = parser.parse_args()
 
@@ -87,3 +114,29 @@ if __name__ == '__main__':
         import code
         code.interact(local=local_scope)
 
+    elif activity == 'bulkcheckin':
+        # Checks in the packages bypassing the monitor, e.g. to
+        # backfill the database with historical packages.
+        if not args.paths and not args.file_list:
+            sys.exit('%s: error: packages are required, as paths or --file-list' % __file__)
+
+        config = utils.balaio_config_from_env()
+        models.Session.configure(bind=models.create_engine_from_config(config))
+
+        stream = None
+        if args.validation:
+            try:
+                stream = utils.get_writable_socket(config.get('app', 'socket'))
+            except socket.error as e:
+                sys.exit('%s: error: the validator is not running: %s' % (__file__, e))
+
+        bulk = bulkcheckin.BulkCheckin(notifier.checkin_notifier_factory(config),
+                                       stream=stream, batch_size=args.batch_size)
+        stats = bulk.run(bulkcheckin.iter_packages(args.paths, file_list=args.file_list,
+                            recursive=config.getboolean('monitor', 'recursive')),
+                         workers=args.workers)
+
+        print 'Done. %(analyzed)s packages analyzed, %(checked_in)s checked in, ' \
+              '%(duplicated)s duplicated and %(failed)s failed, at %(packages_per_second).1f packages/s' % stats
+        sys.exit(0)
+
@@ -0,0 +1,298 @@
+# coding: utf-8
+"""
+Checks in large amounts of packages at once, e.g. to backfill the
+database with historical packages, bypassing the monitor.
+
+Packages are analyzed by a pool of processes, and the resulting rows
+are inserted in batched transactions. The valid attempts are then
+sent to the validator.
+"""
+import os
+import time
+import logging
+import itertools
+import multiprocessing
+
+from sqlalchemy.exc import IntegrityError
+import transaction
+
+import utils
+import models
+import checkin
+import monitor
+
+
+__all__ = ['iter_packages', 'analyze', 'BulkCheckin']
+logger = logging.getLogger('balaio.bulkcheckin')
+
+
+def iter_packages(paths, file_list=None, recursive=True):
+    """
+    Yields the filepaths of the packages to be checked in.
+
+    :param paths: list of packages or directories of packages.
+    :param file_list: (optional) path to a file with one package per line.
+    :param recursive: (optional) if the subdirectories must be walked too.
+    """
+    for path in paths:
+        if os.path.isdir(path):
+            for filepath in monitor.walk_packages([path], recursive=recursive):
+                yield filepath
+        else:
+            yield path
+
+    if file_list:
+        with open(file_list) as fp:
+            for line in fp:
+                filepath = line.strip()
+                if filepath:
+                    yield filepath
+
+
+def analyze(filepath):
+    """
+    Analyzes the package at `filepath`. Runs on the worker processes.
+
+    :returns: a tuple (filepath, :class:`checkin.AnalyzedPackage`, error message).
+    """
+    try:
+        pkg = checkin.PackageAnalyzer(filepath)
+    except Exception as e:
+        return filepath, None, str(e)
+
+    try:
+        return filepath, pkg.analyze(), None
+    except Exception as e:
+        return filepath, None, str(e)
+    finally:
+        pkg._cleanup_package_fp()
+
+
+class BulkCheckin(object):
+    """
+    Checks in packages in batches.
+
+    :param CheckinNotifier: as returned by :func:`notifier.checkin_notifier_factory`.
+    :param stream: (optional) writable socket connected to the validator.
+    If missing, the attempts are not sent.
+    :param Session: (optional) Reference to a Session class.
+    :param batch_size: (optional) number of packages per transaction.
+    :param clock: (optional) callable that returns the current time.
+    """
+    def __init__(self, CheckinNotifier, stream=None, Session=models.Session,
+                 batch_size=100, clock=time.time):
+        self.CheckinNotifier = CheckinNotifier
+        self.stream = stream
+        self.Session = Session
+        self.batch_size = batch_size
+        self._clock = clock
+
+        self.started_at = None
+        self.analyzed = 0
+        self.checked_in = 0
+        self.sent = 0
+        self.duplicated = 0
+        self.failed = 0
+
+    def run(self, filepaths, workers=1):
+        """
+        Checks in the packages of `filepaths`.
+
+        :param filepaths: iterable of filepaths of packages.
+        :param workers: (optional) number of analysis processes. With a
+        single worker, packages are analyzed in the current process.
+        :returns: a dict as returned by :meth:`stats`.
+        """
+        self.started_at = self._clock()
+
+        if workers > 1:
+            # the schema is compiled once, and inherited by the workers.
+            checkin.schema_registry.preload(checkin.SPS_XSD)
+            pool = multiprocessing.Pool(workers)
+            results = pool.imap_unordered(analyze, filepaths, chunksize=4)
+        else:
+            pool = None
+            results = itertools.imap(analyze, filepaths)
+
+        try:
+            while True:
+                batch = list(itertools.islice(results, self.batch_size))
+                if not batch:
+                    break
+
+                self.checkin_batch(batch)
+                logger.info('Bulk checkin progress: %s' % self.stats())
+        finally:
+            if pool is not None:
+                pool.terminate()
+
+        return self.stats()
+
+    def checkin_batch(self, results):
+        """
+        Inserts the attempts of a batch of analyzed packages in a single
+        transaction, and sends the valid ones to the validator.
+
+        If the transaction fails, e.g. because a package was checked in by
+        the monitor in the meantime, each package is checked in on its own.
+
+        :param results: list of tuples as returned by :func:`analyze`.
+        """
+        analyses = []
+        for filepath, analysis, error in results:
+            self.analyzed += 1
+
+            # the same rules of :func:`checkin.get_attempt`.
+            if analysis is not None:
+                missing_fields = models.ArticlePkg.missing_fields(analysis.meta)
+                if missing_fields:
+                    analysis, error = None, 'missing %s' % ', '.join(missing_fields)
+
+            if analysis is None:
+                logger.info('Failed during checkin: %s: %s' % (filepath, error))
+                self._mark(utils.mark_as_failed, filepath)
+                self.failed += 1
+            else:
+                analyses.append(analysis)
+
+        if analyses:
+            self._checkin(analyses)
+
+    def _checkin(self, analyses, retry=True):
+        try:
+            attempts, duplicated = self._insert(analyses)
+        except IntegrityError as e:
+            transaction.abort()
+            if len(analyses) > 1:
+                logger.info('Checking in the packages one at a time, after %s' % e)
+                for analysis in analyses:
+                    self._checkin([analysis])
+                return None
+
+            # the same rules of :func:`checkin.get_attempt`. The statement
+            # is left out, as it names every column.
+            filepath = analyses[0]._filename
+            if 'violates not-null constraint' in str(e.orig):
+                logger.info('Failed during checkin: %s: %s' % (filepath, e))
+                self._mark(utils.mark_as_failed, filepath)
+                self.failed += 1
+            elif self._is_checked_in(analyses[0]):
+                # e.g. by a concurrent checkin, after the lookup of _insert.
+                logger.info('The package %s already exists.' % filepath)
+                self._mark(utils.mark_as_duplicated, filepath)
+                self.duplicated += 1
+            elif retry:
+                # e.g. the ArticlePkg was inserted by a concurrent checkin,
+                # and is found by the lookup of the next try.
+                logger.info('Checking in the package %s again, after %s' % (filepath, e))
+                self._checkin(analyses, retry=False)
+            else:
+                logger.info('Failed during checkin: %s: %s' % (filepath, e))
+                self._mark(utils.mark_as_failed, filepath)
+                self.failed += 1
+            return None
+        except Exception:
+            transaction.abort()
+            raise
+
+        self.checked_in += len(attempts)
+        self._notify(attempts)
+
+        for analysis in duplicated:
+            logger.info('The package %s already exists.' % analysis._filename)
+            self._mark(utils.mark_as_duplicated, analysis._filename)
+            self.duplicated += 1
+
+        if self.stream is not None:
+            for attempt in attempts:
+                if attempt.is_valid:
+                    utils.send_message(self.stream, attempt, utils.make_digest)
+                    self.sent += 1
+
+    def _insert(self, analyses):
+        session = self.Session()
+
+        # known packages and articles are looked up once per batch.
+        checksums = [analysis.checksum for analysis in analyses]
+        known = set(row.package_checksum for row in session.query(models.Attempt.package_checksum).filter(
+            models.Attempt.package_checksum.in_(checksums)))
+
+        identities = dict((analysis.checksum, models.ArticlePkg.make_identity(analysis.meta))
+                          for analysis in analyses)
+        article_pkgs = dict((article_pkg.identity, article_pkg) for article_pkg in
+            session.query(models.ArticlePkg).filter(models.ArticlePkg.identity.in_(identities.values())))
+
+        attempts = []
+        duplicated = []
+        with session.no_autoflush:
+            for analysis in analyses:
+                if analysis.checksum in known:
+                    duplicated.append(analysis)
+                    continue
+                known.add(analysis.checksum)
+
+                attempt = models.Attempt.get_from_package(analysis)
+                attempt.analysis = analysis
+                session.add(attempt)
+
+                identity = identities[analysis.checksum]
+                article_pkg = article_pkgs.get(identity)
+                if article_pkg is None:
+                    article_pkg = article_pkgs[identity] = models.ArticlePkg(identity=identity, **analysis.meta)
+
+                attempt.articlepkg = article_pkg
+                attempt.is_valid = True
+
+                attempts.append(attempt)
+
+        transaction.commit()
+        return attempts, duplicated
+
+    def _is_checked_in(self, analysis):
+        """
+        Whether an attempt with the checksum of `analysis` exists.
+        """
+        session = self.Session()
+        try:
+            return session.query(models.Attempt.package_checksum).filter_by(
+                package_checksum=analysis.checksum).first() is not None
+        finally:
+            transaction.abort()
+
+    def _notify(self, attempts):
+        """
+        Notifies the checkin of `attempts`. It is done only after they are
+        committed, so a batch checked in again one package at a time is
+        not notified twice.
+        """
+        session = self.Session()
+        try:
+            for attempt in attempts:
+                checkin_notifier = self.CheckinNotifier(attempt, session)
+                checkin_notifier.start()
+                if attempt.is_valid:
+                    checkin_notifier.tell('Attempt ready to be validated', models.Status.ok, 'Checkin')
+                else:
+                    checkin_notifier.tell('Attempt cannot be validated', models.Status.error, 'Checkin')
+                checkin_notifier.end()
+            transaction.commit()
+        except Exception as e:
+            transaction.abort()
+            logger.error('Could not store the checkin notices of %s attempts: %s' % (len(attempts), e))
+
+    def _mark(self, mark_as, filepath):
+        try:
+            mark_as(filepath)
+        except OSError as e:
+            logger.debug('The file is gone before being marked. %s' % e)
+
+    def stats(self):
+        elapsed = self._clock() - self.started_at if self.started_at is not None else 0
+        return {
+            'analyzed': self.analyzed,
+            'checked_in': self.checked_in,
+            'sent': self.sent,
+            'duplicated': self.duplicated,
+            'failed': self.failed,
+            'packages_per_second': self.analyzed / elapsed if elapsed else 0.0,
+        }
@@ -0,0 +1,271 @@
+# coding: utf-8
+import time
+import datetime
+import logging
+import threading
+from collections import OrderedDict
+
+from sqlalchemy.exc import SQLAlchemyError
+
+import models
+import utils
+
+
+__all__ = ['LRUCache', 'CoalescingCache', 'DOIValidator']
+logger = logging.getLogger('balaio.cache')
+
+# sentinel for missing cache entries, as ``None`` is a valid value.
+_missing = object()
+
+
+class LRUCache(object):
+    """
+    Thread-safe, in-process cache, that discards the least recently used
+    entries when full.
+
+    :param maxsize: (optional) max number of entries.
+    :param ttl: (optional) default time to live of the entries, in seconds.
+    :param clock: (optional) callable that returns the current time.
+    """
+    def __init__(self, maxsize=1024, ttl=None, clock=time.time):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._clock = clock
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """
+        Returns the value of `key`, or `default` if it is missing or expired.
+        """
+        with self._lock:
+            try:
+                value, expires_at = self._data.pop(key)
+            except KeyError:
+                return default
+
+            if expires_at is not None and expires_at <= self._clock():
+                return default
+
+            # moves the entry to the most recently used position.
+            self._data[key] = (value, expires_at)
+            return value
+
+    def set(self, key, value, ttl=None):
+        """
+        Stores `value` under `key`.
+
+        :param ttl: (optional) overrides the default time to live.
+        """
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = self._clock() + ttl if ttl is not None else None
+
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (value, expires_at)
+
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def __contains__(self, key):
+        return self.get(key, _missing) is not _missing
+
+    def __len__(self):
+        return len(self._data)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class _Fetch(object):
+    """
+    A fetch in progress, waited by concurrent lookups of the same key.
+    """
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class CoalescingCache(object):
+    """
+    :class:`LRUCache` that fetches missing entries on its own.
+
+    Concurrent lookups of the same missing key share a single
+    fetch, and errors raised by it are not cached.
+
+    :param maxsize: (optional) max number of entries.
+    :param ttl: (optional) time to live of the entries, in seconds.
+    :param clock: (optional) callable that returns the current time.
+    """
+    def __init__(self, maxsize=256, ttl=60*60, clock=time.time):
+        self._lru = LRUCache(maxsize=maxsize, ttl=ttl, clock=clock)
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def get(self, key, fetch):
+        """
+        Returns the value of `key`, calling `fetch` if it is missing.
+
+        :param key: hashable key.
+        :param fetch: callable that receives nothing and returns the value.
+        """
+        with self._lock:
+            value = self._lru.get(key, _missing)
+            if value is not _missing:
+                self.hits += 1
+                return value
+
+            in_flight = self._in_flight.get(key)
+            if in_flight is None:
+                self.misses += 1
+                in_flight = self._in_flight[key] = _Fetch()
+                is_leader = True
+            else:
+                self.coalesced += 1
+                is_leader = False
+
+        if not is_leader:
+            in_flight.done.wait()
+            if in_flight.error is not None:
+                raise in_flight.error
+            return in_flight.value
+
+        try:
+            in_flight.value = fetch()
+        except Exception as e:
+            in_flight.error = e
+            raise
+        else:
+            self._lru.set(key, in_flight.value)
+            return in_flight.value
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+            in_flight.done.set()
+
+    @property
+    def hit_ratio(self):
+        """
+        Ratio of lookups that did not fetch the data.
+        """
+        lookups = self.hits + self.misses + self.coalesced
+        return float(self.hits + self.coalesced) / lookups if lookups else 0.0
+
+    def stats(self):
+        return {
+            'size': len(self._lru),
+            'hits': self.hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+            'hit_ratio': self.hit_ratio,
+        }
+
+
+class DOIValidator(object):
+    """
+    Checks if DOIs are registered, caching the results.
+
+    The results are looked up in an in-process :class:`LRUCache`, then in
+    the :class:`models.DOIResolution` table, and only then `resolver` is
+    called. Positive and negative results have distinct time to live, as
+    an unregistered DOI may be registered at any moment.
+
+    Only the statuses that tell if the DOI is registered are cached:
+    200, and client errors like 404. Errors raised by `resolver` are not
+    cached, nor are server errors or throttling, e.g. 503 or 429, which
+    are taken as unregistered DOIs for that call only.
+
+    :param Session: (optional) Session class not bound to the transaction
+    manager, as the results are committed on their own. If missing, only the
+    in-process cache is used.
+    :param resolver: (optional) callable that returns the HTTP status of
+    a DOI at CrossRef.
+    :param positive_ttl: (optional) seconds a registered DOI is kept.
+    :param negative_ttl: (optional) seconds an unregistered DOI is kept.
+    :param lru: (optional) instance of :class:`LRUCache`.
+    """
+    # client errors that do not tell if the DOI is registered.
+    transient_statuses = (408, 429)
+
+    def __init__(self, Session=None, resolver=utils.get_doi_status,
+                 positive_ttl=30*24*60*60, negative_ttl=24*60*60, lru=None):
+        self.Session = Session
+        self._resolver = resolver
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self._lru = lru if lru is not None else LRUCache(maxsize=4096)
+
+    def _ttl(self, is_valid):
+        return self.positive_ttl if is_valid else self.negative_ttl
+
+    def _load(self, doi):
+        """
+        Gets the stored result for `doi`, if not expired.
+        """
+        session = self.Session()
+        try:
+            resolution = session.query(models.DOIResolution).get(doi)
+        except SQLAlchemyError as e:
+            logger.error('Could not load the cached resolution of DOI %s: %s' % (doi, e))
+            return None
+        finally:
+            session.close()
+
+        if resolution is None:
+            return None
+
+        age = datetime.datetime.now() - resolution.checked_at
+        if age > datetime.timedelta(seconds=self._ttl(resolution.is_valid)):
+            return None
+
+        return resolution
+
+    def _store(self, doi, is_valid):
+        session = self.Session()
+        try:
+            session.merge(models.DOIResolution(doi=doi, is_valid=is_valid))
+            session.commit()
+        except SQLAlchemyError as e:
+            # e.g. the same DOI being stored by another worker.
+            session.rollback()
+            logger.info('Could not cache the resolution of DOI %s: %s' % (doi, e))
+        finally:
+            session.close()
+
+    def __call__(self, doi):
+        """
+        Returns ``True`` if `doi` is registered.
+        """
+        # DOIs are case insensitive.
+        key = doi.strip().lower()
+
+        is_valid = self._lru.get(key)
+        if is_valid is not None:
+            return is_valid
+
+        if self.Session is not None:
+            resolution = self._load(key)
+            if resolution is not None:
+                remaining = self._ttl(resolution.is_valid) - (
+                    datetime.datetime.now() - resolution.checked_at).total_seconds()
+                self._lru.set(key, resolution.is_valid, ttl=remaining)
+                return resolution.is_valid
+
+        status = self._resolver(doi)
+        is_valid = status == 200
+
+        if not is_valid and not (400 <= status < 500 and status not in self.transient_statuses):
+            logger.warning('Could not check DOI %s: HTTP status %s' % (doi, status))
+            return is_valid
+
+        self._lru.set(key, is_valid, ttl=self._ttl(is_valid))
+        if self.Session is not None:
+            self._store(key, is_valid)
+
+        return is_valid
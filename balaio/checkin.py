@@ -5,58 +5,87 @@ import stat
 import zipfile
 import itertools
 import logging
+import threading
 
 from sqlalchemy.orm.exc import MultipleResultsFound, NoResultFound
 from sqlalchemy.exc import IntegrityError
 import transaction
 from packtools import xray
+from lxml import etree
 
 import models
 import utils
 import excepts
 import notifier
 
-__all__ = ['PackageAnalyzer', 'get_attempt']
+__all__ = ['PackageAnalyzer', 'AnalyzedPackage', 'SchemaRegistry', 'get_attempt']
 logger = logging.getLogger('balaio.checkin')
 
+SPS_XSD = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'xsds', 'sps.xsd'))
 
-class PackageAnalyzer(xray.SPSPackage):
 
-    def __init__(self, *args):
-        super(PackageAnalyzer, self).__init__(*args)
-        self._errors = set()
-        self._default_perms = stat.S_IMODE(os.stat(self._filename).st_mode)
-        self._is_locked = False
-
-    def __enter__(self):
-        self.lock_package()
-        return self
+class SchemaRegistry(object):
+    """
+    Compiles each XML Schema once per thread.
 
-    def __exit__(self, exc_type, exc_value, traceback):
-        try:
-            self.restore_perms()
-        except OSError, exc:
-            logger.info('The package had been deleted before the permissions restore procedure: %s' % exc)
-        self._cleanup_package_fp()
+    A compiled schema must not validate documents concurrently, so each
+    thread keeps its own copy instead of waiting for a shared one.
+    """
+    def __init__(self):
+        self._local = threading.local()
 
     @property
-    def meta(self):
-        dct_mta = super(PackageAnalyzer, self).meta
-
-        ign, dct_mta['issue_suppl_volume'], dct_mta['issue_number'], dct_mta['issue_suppl_number'] = utils.issue_identification(
-            dct_mta['issue_volume'], dct_mta['issue_number'], dct_mta['supplement'])
+    def _schemas(self):
+        """
+        The schemas compiled by the calling thread.
+        """
+        try:
+            return self._local.schemas
+        except AttributeError:
+            self._local.schemas = {}
+            return self._local.schemas
 
-        del dct_mta['supplement']
+    def get(self, xsd_path):
+        """
+        Returns the lxml.etree.XMLSchema for `xsd_path`, compiled by
+        the calling thread.
+        """
+        schemas = self._schemas
+        try:
+            return schemas[xsd_path]
+        except KeyError:
+            logger.debug('Compiling the schema %s' % xsd_path)
+            schema = schemas[xsd_path] = etree.XMLSchema(etree.parse(xsd_path))
+            return schema
 
-        return dct_mta
+    def preload(self, *xsd_paths):
+        """
+        Compiles the schemas for the calling thread in advance, e.g.
+        before forking worker processes, which inherit them.
+        """
+        for xsd_path in xsd_paths:
+            self.get(xsd_path)
 
-    @property
-    def errors(self):
+    def validate(self, xsd_path, xml):
         """
-        Returns a tuple of errors
+        Validates `xml` against the schema at `xsd_path`.
+
+        :param xsd_path: filesystem path to the XML Schema.
+        :param xml: an lxml.etree.ElementTree.
         """
-        return tuple(self._errors)
+        return self.get(xsd_path).validate(xml)
+
+
+schema_registry = SchemaRegistry()
+
 
+class PackageLockMixin(object):
+    """
+    Write protects the package while it is being processed.
+
+    Expects the attributes ``_filename``, ``_default_perms``, ``_is_locked``
+    and ``_errors``.
+    """
     def lock_package(self):
         """
          - Removes the write permission for Owners and Others
@@ -87,6 +116,179 @@ class PackageAnalyzer(xray.SPSPackage):
         os.chmod(self._filename, self._default_perms)
         self._is_locked = False
 
+    @property
+    def errors(self):
+        """
+        Returns a tuple of errors
+        """
+        return tuple(self._errors)
+
+
+class PackageAnalyzer(PackageLockMixin, xray.SPSPackage):
+
+    def __init__(self, *args):
+        super(PackageAnalyzer, self).__init__(*args)
+        self._errors = set()
+        self._default_perms = stat.S_IMODE(os.stat(self._filename).st_mode)
+        self._is_locked = False
+        self._checksum = None
+        self._meta = None
+        self._xml = None
+        self._validity = {}
+
+    def __enter__(self):
+        self.lock_package()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            self.restore_perms()
+        except OSError, exc:
+            logger.info('The package had been deleted before the permissions restore procedure: %s' % exc)
+        self._cleanup_package_fp()
+
+    @property
+    def checksum(self):
+        # the whole package is read to compute it.
+        if self._checksum is None:
+            self._checksum = super(PackageAnalyzer, self).checksum
+        return self._checksum
+
+    @property
+    def meta(self):
+        if self._meta is None:
+            dct_mta = super(PackageAnalyzer, self).meta
+
+            ign, dct_mta['issue_suppl_volume'], dct_mta['issue_number'], dct_mta['issue_suppl_number'] = utils.issue_identification(
+                dct_mta['issue_volume'], dct_mta['issue_number'], dct_mta['supplement'])
+
+            del dct_mta['supplement']
+            self._meta = dct_mta
+
+        return dict(self._meta)
+
+    @property
+    def xml(self):
+        # the tree is shared by the schema validation and all
+        # the validation pipes, and must not be parsed again.
+        if self._xml is None:
+            self._xml = super(PackageAnalyzer, self).xml
+        return self._xml
+
+    def _memoized_validation(self, name):
+        if name not in self._validity:
+            self._validity[name] = getattr(super(PackageAnalyzer, self), name)()
+        return self._validity[name]
+
+    def is_valid_package(self):
+        return self._memoized_validation('is_valid_package')
+
+    def is_valid_meta(self):
+        return self._memoized_validation('is_valid_meta')
+
+    def is_valid_schema(self):
+        """
+        Validates the xml against SPS, using the schema compiled by
+        :data:`schema_registry`.
+        """
+        if 'is_valid_schema' not in self._validity:
+            self._validity['is_valid_schema'] = schema_registry.validate(SPS_XSD, self.xml)
+        return self._validity['is_valid_schema']
+
+    def analyze(self):
+        """
+        Returns an :class:`AnalyzedPackage` with the results of the analysis.
+
+        Validations are performed in the same order of
+        :meth:`models.Attempt.get_from_package`, and the ones after a
+        failure are reported as failed without being performed.
+        """
+        is_valid_package = self.is_valid_package()
+        is_valid_meta = is_valid_package and self.is_valid_meta()
+        is_valid_schema = is_valid_meta and self.is_valid_schema()
+
+        xml_bytes = None
+        if is_valid_package:
+            try:
+                xml_bytes = etree.tostring(self.xml)
+            except AttributeError:
+                # the package must have exactly one xml.
+                pass
+
+        return AnalyzedPackage(self._filename,
+                               checksum=self.checksum,
+                               meta=self.meta,
+                               xml_bytes=xml_bytes,
+                               is_valid_package=is_valid_package,
+                               is_valid_meta=is_valid_meta,
+                               is_valid_schema=is_valid_schema)
+
+
+class AnalyzedPackage(PackageLockMixin):
+    """
+    The results of a package analysis, that can be pickled and sent
+    along with its :class:`models.Attempt`. It quacks like a
+    :class:`PackageAnalyzer`, without reading the package again.
+
+    :param filename: filesystem path to the package.
+    :param checksum: the package checksum.
+    :param meta: a dict as returned by :attr:`PackageAnalyzer.meta`.
+    :param xml_bytes: the serialized xml of the package.
+    :param is_valid_package: result of :meth:`PackageAnalyzer.is_valid_package`.
+    :param is_valid_meta: result of :meth:`PackageAnalyzer.is_valid_meta`.
+    :param is_valid_schema: result of :meth:`PackageAnalyzer.is_valid_schema`.
+    """
+    def __init__(self, filename, checksum, meta, xml_bytes,
+                 is_valid_package, is_valid_meta, is_valid_schema):
+        self._filename = filename
+        self.checksum = checksum
+        self._meta = meta
+        self._xml_bytes = xml_bytes
+        self._validity = {'package': is_valid_package,
+                          'meta': is_valid_meta,
+                          'schema': is_valid_schema}
+        self._errors = set()
+        self._default_perms = None
+        self._is_locked = False
+        self._xml = None
+
+    def __getstate__(self):
+        # lxml trees cannot be pickled.
+        state = self.__dict__.copy()
+        state['_xml'] = None
+        return state
+
+    @property
+    def meta(self):
+        return dict(self._meta)
+
+    @property
+    def xml(self):
+        if self._xml_bytes is None:
+            raise AttributeError('There must be only one xml file inside a package.')
+
+        if self._xml is None:
+            self._xml = etree.ElementTree(etree.fromstring(self._xml_bytes))
+        return self._xml
+
+    def is_valid_package(self):
+        return self._validity['package']
+
+    def is_valid_meta(self):
+        return self._validity['meta']
+
+    def is_valid_schema(self):
+        return self._validity['schema']
+
+    def lock_package(self):
+        if self._default_perms is None:
+            self._default_perms = stat.S_IMODE(os.stat(self._filename).st_mode)
+        super(AnalyzedPackage, self).lock_package()
+
+    def restore_perms(self):
+        if self._default_perms is not None:
+            super(AnalyzedPackage, self).restore_perms()
+
 
 def get_attempt(package, Session=models.Session):
     """
@@ -99,7 +301,7 @@ def get_attempt(package, Session=models.Session):
     Case 1: Package is valid and has all needed metadata:
             A :class:`models.Attempt` is returned, bound to a :class:`models.ArticlePkg`.
     Case 2: Package is valid and doesn't have all needed metadata:
-            A :class:`models.Attempt` is returned, with :attr:`models.Attempt.is_valid==False`.
+            raises :class:`ValueError`, naming the missing fields.
     Case 3: Package is invalid
             A :class:`models.Attempt` is returned, with :attr:`models.Attempt.is_valid==False`.
     Case 4: Package is duplicated
@@ -119,6 +321,15 @@ def get_attempt(package, Session=models.Session):
             attempt = models.Attempt.get_from_package(pkg)
             session.add(attempt)
 
+            # Sent along with the attempt, so the package is not
+            # read again during the validation.
+            attempt.analysis = pkg.analyze()
+
+            missing_fields = models.ArticlePkg.missing_fields(pkg.meta)
+            if missing_fields:
+                logger.error('The package %s is missing %s. Aborting.' % (package, ', '.join(missing_fields)))
+                raise ValueError('The package %s is missing %s' % (package, ', '.join(missing_fields)))
+
             # Trying to bind a ArticlePkg
             savepoint = transaction.savepoint()
             try:
@@ -157,6 +368,10 @@ def get_attempt(package, Session=models.Session):
             else:
                 raise excepts.DuplicatedPackage('The package %s already exists.' % package)
 
+        except ValueError:
+            transaction.abort()
+            raise
+
         except Exception as e:
             transaction.abort()
 
@@ -2,15 +2,35 @@ import transaction
 
 from pyramid.response import Response
 from pyramid.config import Configurator
-from pyramid.httpexceptions import HTTPNotFound, HTTPAccepted, HTTPCreated
+from pyramid.httpexceptions import HTTPNotFound, HTTPAccepted, HTTPCreated, HTTPBadRequest
 from pyramid.view import notfound_view_config, view_config
 from pyramid.events import NewRequest
 
-from sqlalchemy import func
+from sqlalchemy import func, text
+from sqlalchemy.orm import subqueryload
 from sqlalchemy.orm.exc import NoResultFound
 
 import models
 import health
+import cache
+
+
+TOTAL_COUNT_MODES = ('exact', 'cached', 'estimated')
+
+# Relations read by `to_dict`, loaded with a query per relation
+# instead of one query per object.
+SERIALIZATION_LOADERS = {
+    models.Attempt: (subqueryload('checkpoint').subqueryload('messages'),),
+    models.ArticlePkg: (subqueryload('attempts'), subqueryload('tickets')),
+    models.Ticket: (subqueryload('comments'),),
+}
+
+
+def query_for_serialization(request, model):
+    """
+    Returns a query of `model` that loads all the data needed by `to_dict`.
+    """
+    return request.db.query(model).options(*SERIALIZATION_LOADERS[model])
 
 
 def get_query_filters(model, request_params):
@@ -21,6 +41,100 @@ def get_query_filters(model, request_params):
     return filters
 
 
+def _exact_count(request, model, filters):
+    return request.db.query(func.count(model.id)).filter_by(**filters).scalar()
+
+
+def _estimated_count(request, model, filters):
+    """
+    Uses the planner statistics of PostgreSQL to estimate the number of
+    rows of an unfiltered table. Falls back to the cached count otherwise.
+    """
+    if not filters and request.db.get_bind().dialect.name == 'postgresql':
+        estimate = request.db.execute(
+            text('SELECT reltuples::bigint FROM pg_class WHERE relname = :table'),
+            {'table': model.__tablename__}).scalar()
+        # tables never analyzed may be estimated as empty.
+        if estimate is not None and estimate > 0:
+            return estimate
+
+    return _cached_count(request, model, filters)
+
+
+def _cached_count(request, model, filters):
+    total_counts = getattr(request.registry, 'total_counts', None)
+    if total_counts is None:
+        return _exact_count(request, model, filters)
+
+    return total_counts.get((model.__name__, tuple(sorted(filters.items()))),
+                            lambda: _exact_count(request, model, filters))
+
+
+def get_total_count(request, model, filters, keyset=False):
+    """
+    Counts the objects of `model` matching `filters`.
+
+    Counting is expensive on large tables, so the count may be exact,
+    cached for some seconds or estimated, according to the setting
+    ``total_count`` of the section ``http_server``.
+
+    :param keyset: (optional) if the count is for a page selected by
+    ``after_id``. Its mode is set by ``after_id_total_count``, which
+    defaults to the mode of ``total_count``.
+    """
+    settings = request.registry.settings.get('http_server', {})
+    mode = settings.get('total_count', 'exact')
+    if keyset:
+        mode = settings.get('after_id_total_count', mode)
+
+    if mode == 'cached':
+        return _cached_count(request, model, filters)
+    elif mode == 'estimated':
+        return _estimated_count(request, model, filters)
+    else:
+        return _exact_count(request, model, filters)
+
+
+def paginate(request, model):
+    """
+    Returns a page of objects of `model`, as expected by the `gtw` renderer.
+
+    Pages are selected by ``limit`` and ``offset`` querystring params,
+    or by ``limit`` and ``after_id``. The later is based on the
+    primary key, and its cost does not grow with the page depth.
+    """
+    limit = request.params.get('limit', request.registry.settings.get('http_server', {}).get('limit', 20))
+    filters = get_query_filters(model, request.params)
+
+    if 'after_id' in request.params:
+        try:
+            after_id = int(request.params['after_id'])
+            limit = int(limit)
+        except ValueError:
+            raise HTTPBadRequest('after_id and limit must be integers')
+
+        objects = query_for_serialization(request, model).filter_by(**filters).filter(
+            model.id > after_id).order_by(model.id).limit(limit).all()
+
+        return {'limit': limit,
+                'after_id': after_id,
+                'next_after_id': objects[-1].id if objects and len(objects) == limit else None,
+                'filters': filters,
+                'total': get_total_count(request, model, filters, keyset=True),
+                'objects': [obj.to_dict() for obj in objects]}
+
+    offset = request.params.get('offset', 0)
+    # the eager loaders repeat the query, so the rows must be ordered.
+    objects = query_for_serialization(request, model).order_by(model.id).filter_by(
+        **filters).limit(limit).offset(offset)
+
+    return {'limit': limit,
+            'offset': offset,
+            'filters': filters,
+            'total': get_total_count(request, model, filters),
+            'objects': [obj.to_dict() for obj in objects]}
+
+
 @notfound_view_config(append_slash=True)
 def notfound(request):
     return HTTPNotFound('Not found')
@@ -37,7 +151,7 @@ def package(request):
     Get a single object and return a serialized dict
     """
 
-    article = request.db.query(models.ArticlePkg).get(request.matchdict['id'])
+    article = query_for_serialization(request, models.ArticlePkg).get(request.matchdict['id'])
 
     if article is None:
         return HTTPNotFound()
@@ -51,17 +165,7 @@ def list_package(request):
     Return a dict content the total param and the objects list
     Example: {'total': 12, 'limit': 20, offset: 0, 'objects': [object, object,...]}
     """
-    limit = request.params.get('limit', request.registry.settings.get('http_server', {}).get('limit', 20))
-    offset = request.params.get('offset', 0)
-
-    filters = get_query_filters(models.ArticlePkg, request.params)
-    articles = request.db.query(models.ArticlePkg).filter_by(**filters).limit(limit).offset(offset)
-
-    return {'limit': limit,
-            'offset': offset,
-            'filters': filters,
-            'total': request.db.query(func.count(models.ArticlePkg.id)).filter_by(**filters).scalar(),
-            'objects': [article.to_dict() for article in articles]}
+    return paginate(request, models.ArticlePkg)
 
 
 @view_config(route_name='Attempt', request_method='GET', renderer="gtw")
@@ -69,7 +173,7 @@ def attempt(request):
     """
     Get a single object and return a serialized dict
     """
-    attempt = request.db.query(models.Attempt).get(request.matchdict['id'])
+    attempt = query_for_serialization(request, models.Attempt).get(request.matchdict['id'])
 
     if not attempt:
         return HTTPNotFound()
@@ -83,17 +187,7 @@ def attempts(request):
     Return a dict content the total param and the objects list
     Example: {'total': 12, 'limit': 20, offset:0, 'objects': [object, object,...]}
     """
-    limit = request.params.get('limit', request.registry.settings.get('http_server', {}).get('limit', 20))
-    offset = request.params.get('offset', 0)
-
-    filters = get_query_filters(models.Attempt, request.params)
-    attempts = request.db.query(models.Attempt).filter_by(**filters).limit(limit).offset(offset)
-
-    return {'limit': limit,
-            'offset': offset,
-            'filters': filters,
-            'total': request.db.query(func.count(models.Attempt.id)).filter_by(**filters).scalar(),
-            'objects': [attempt.to_dict() for attempt in attempts]}
+    return paginate(request, models.Attempt)
 
 
 @view_config(route_name='Ticket', request_method='GET', renderer="gtw")
@@ -102,7 +196,7 @@ def ticket(request):
     Get a single object and return a serialized dict
     """
 
-    ticket = request.db.query(models.Ticket).get(request.matchdict['id'])
+    ticket = query_for_serialization(request, models.Ticket).get(request.matchdict['id'])
 
     if ticket is None:
         return HTTPNotFound()
@@ -116,17 +210,7 @@ def list_ticket(request):
     Return a dict content the total param and the objects list
     Example: {'total': 12, 'limit': 20, offset: 0, 'objects': [object, object,...]}
     """
-
-    limit = request.params.get('limit', request.registry.settings.get('http_server', {}).get('limit', 20))
-    offset = request.params.get('offset', 0)
-    filters = get_query_filters(models.Ticket, request.params)
-    tickets = request.db.query(models.Ticket).filter_by(**filters).limit(limit).offset(offset)
-
-    return {'limit': limit,
-            'offset': offset,
-            'filters': filters,
-            'total': request.db.query(func.count(models.Ticket.id)).filter_by(**filters).scalar(),
-            'objects': [ticket.to_dict() for ticket in tickets]}
+    return paginate(request, models.Ticket)
 
 
 @view_config(route_name='ticket', request_method='POST', renderer="gtw")
@@ -213,6 +297,15 @@ def main(config, engine):
 
     config_pyrmd.add_renderer('gtw', factory='renderers.GtwFactory')
 
+    # Total counts of the list endpoints
+    http_settings = dict(config.items()).get('http_server') or {}
+    for setting in ('total_count', 'after_id_total_count'):
+        if http_settings.get(setting, 'exact') not in TOTAL_COUNT_MODES:
+            raise ValueError('unknown %s mode. supported are: %s' % (setting, ', '.join(TOTAL_COUNT_MODES)))
+
+    config_pyrmd.registry.total_counts = cache.CoalescingCache(
+        ttl=int(http_settings.get('total_cache_ttl', 60)))
+
     #DB session bound to each request
     config_pyrmd.registry.Session = models.ScopedSession
     config_pyrmd.registry.Session.configure(bind=engine)
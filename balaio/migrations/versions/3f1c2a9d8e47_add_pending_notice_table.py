@@ -0,0 +1,29 @@
+"""add pending_notice table
+
+Revision ID: 3f1c2a9d8e47
+Revises: None
+Create Date: 2026-10-16 10:12:31.402118
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3f1c2a9d8e47'
+down_revision = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('pending_notice',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('created_at', sa.DateTime(), nullable=False),
+        sa.Column('checkin_uri', sa.String(), nullable=True),
+        sa.Column('payload', sa.String(), nullable=False),
+        sa.Column('retries', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('id')
+    )
+
+
+def downgrade():
+    op.drop_table('pending_notice')
@@ -0,0 +1,27 @@
+"""add doi_resolution table
+
+Revision ID: 5b8e0d6a1c32
+Revises: 3f1c2a9d8e47
+Create Date: 2026-10-16 11:03:54.120884
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5b8e0d6a1c32'
+down_revision = '3f1c2a9d8e47'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('doi_resolution',
+        sa.Column('doi', sa.String(), nullable=False),
+        sa.Column('is_valid', sa.Boolean(), nullable=False),
+        sa.Column('checked_at', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('doi')
+    )
+
+
+def downgrade():
+    op.drop_table('doi_resolution')
@@ -0,0 +1,25 @@
+"""add articlepkg_aid_seq sequence
+
+Revision ID: 7d2f4b9c0e15
+Revises: 5b8e0d6a1c32
+Create Date: 2026-10-16 13:21:07.554310
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '7d2f4b9c0e15'
+down_revision = '5b8e0d6a1c32'
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.schema import CreateSequence, DropSequence
+
+
+def upgrade():
+    if op.get_bind().dialect.supports_sequences:
+        op.execute(CreateSequence(sa.Sequence('articlepkg_aid_seq')))
+
+
+def downgrade():
+    if op.get_bind().dialect.supports_sequences:
+        op.execute(DropSequence(sa.Sequence('articlepkg_aid_seq')))
@@ -0,0 +1,86 @@
+"""add articlepkg.identity
+
+Revision ID: 9a61c3e2b7d4
+Revises: 7d2f4b9c0e15
+Create Date: 2026-10-16 14:02:48.918273
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '9a61c3e2b7d4'
+down_revision = '7d2f4b9c0e15'
+
+import hashlib
+import logging
+
+from alembic import op
+import sqlalchemy as sa
+
+
+logger = logging.getLogger('alembic.migration')
+BATCH_SIZE = 1000
+
+# a copy of models.ArticlePkg.make_identity as of this revision.
+IDENTITY_FIELDS = ('article_title', 'journal_pissn', 'journal_eissn',
+                   'issue_year', 'issue_volume', 'issue_number',
+                   'issue_suppl_volume', 'issue_suppl_number')
+
+
+def make_identity(meta):
+    values = []
+    for field in IDENTITY_FIELDS:
+        value = meta.get(field)
+        if value is None:
+            value = u''
+        elif isinstance(value, str):
+            value = value.decode('utf-8')
+        elif not isinstance(value, unicode):
+            value = unicode(value)
+        values.append(u' '.join(value.upper().split()))
+
+    return hashlib.sha1(u'\x1f'.join(values).encode('utf-8')).hexdigest()
+
+
+articlepkg = sa.sql.table('articlepkg',
+    sa.sql.column('id', sa.Integer),
+    sa.sql.column('identity', sa.String),
+    *[sa.sql.column(field) for field in IDENTITY_FIELDS])
+
+
+def backfill():
+    """
+    Fills the identity of the existing packages. Packages sharing an
+    identity are kept apart, and only the oldest one gets it.
+    """
+    conn = op.get_bind()
+    seen = set()
+    last_id = 0
+
+    while True:
+        rows = conn.execute(articlepkg.select().where(
+            articlepkg.c.id > last_id).order_by(articlepkg.c.id).limit(BATCH_SIZE)).fetchall()
+        if not rows:
+            break
+
+        for row in rows:
+            identity = make_identity(dict(row))
+            if identity in seen:
+                logger.warning('ArticlePkg %s shares its identity with an older package' % row['id'])
+                continue
+
+            seen.add(identity)
+            conn.execute(articlepkg.update().where(
+                articlepkg.c.id == row['id']).values(identity=identity))
+
+        last_id = rows[-1]['id']
+
+
+def upgrade():
+    op.add_column('articlepkg', sa.Column('identity', sa.String(length=40), nullable=True))
+    backfill()
+    op.create_unique_constraint('articlepkg_identity_key', 'articlepkg', ['identity'])
+
+
+def downgrade():
+    op.drop_constraint('articlepkg_identity_key', 'articlepkg')
+    op.drop_column('articlepkg', 'identity')
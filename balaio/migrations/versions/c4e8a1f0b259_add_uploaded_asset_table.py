@@ -0,0 +1,34 @@
+"""add uploaded_asset table
+
+Revision ID: c4e8a1f0b259
+Revises: 9a61c3e2b7d4
+Create Date: 2026-10-16 17:21:07.402316
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'c4e8a1f0b259'
+down_revision = '9a61c3e2b7d4'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('uploaded_asset',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('host', sa.String(), nullable=False),
+        sa.Column('path', sa.String(), nullable=False),
+        sa.Column('checksum', sa.String(length=40), nullable=False),
+        sa.Column('size', sa.Integer(), nullable=False),
+        sa.Column('link_target', sa.String(), nullable=True),
+        sa.Column('uploaded_at', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('host', 'path')
+    )
+    op.create_index('ix_uploaded_asset_checksum', 'uploaded_asset', ['checksum'])
+
+
+def downgrade():
+    op.drop_index('ix_uploaded_asset_checksum', table_name='uploaded_asset')
+    op.drop_table('uploaded_asset')
@@ -0,0 +1,24 @@
+"""add pending_notice claims
+
+Revision ID: e2b7c05d4a91
+Revises: c4e8a1f0b259
+Create Date: 2026-10-16 18:40:12.803417
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'e2b7c05d4a91'
+down_revision = 'c4e8a1f0b259'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('pending_notice', sa.Column('claimed_by', sa.String(), nullable=True))
+    op.add_column('pending_notice', sa.Column('claimed_at', sa.DateTime(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('pending_notice', 'claimed_at')
+    op.drop_column('pending_notice', 'claimed_by')
@@ -1,7 +1,10 @@
 #coding: utf-8
 import datetime
+import hashlib
 import logging
+import json
 import os
+import threading
 
 import enum
 
@@ -14,7 +17,10 @@ from sqlalchemy import (
     String,
     Boolean,
     Table,
+    Sequence,
+    UniqueConstraint,
     event,
+    select,
 )
 from sqlalchemy.orm import (
     relationship,
@@ -22,12 +28,13 @@ from sqlalchemy.orm import (
     scoped_session,
     sessionmaker,
 )
-from sqlalchemy.orm.exc import MultipleResultsFound, NoResultFound
+from sqlalchemy.orm.exc import NoResultFound
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.ext.hybrid import hybrid_property
 from zope.sqlalchemy import ZopeTransactionExtension
 
-from base28 import genbase
+from base28 import genbase, reprbase, BASE28
 
 
 logger = logging.getLogger(__name__)
@@ -37,6 +44,9 @@ ScopedSession = scoped_session(
     sessionmaker(expire_on_commit=False, extension=ZopeTransactionExtension()))
 
 Session = sessionmaker(expire_on_commit=False, extension=ZopeTransactionExtension())
+
+#Not managed by the transaction manager. Used by caches that commit on their own
+CacheSession = sessionmaker(expire_on_commit=False)
 Base = declarative_base()
 
 
@@ -84,6 +94,10 @@ class Attempt(Base):
     is_valid = Column(Boolean)
     checkin_uri = Column(String(length=64), nullable=True)
 
+    # instance of :class:`checkin.AnalyzedPackage`, sent along with the
+    # attempt to the validator. It is not persisted.
+    analysis = None
+
     articlepkg = relationship('ArticlePkg',
                               backref=backref('attempts',
                               cascade='all, delete-orphan'))
@@ -141,12 +155,47 @@ class ArticlePkg(Base):
     issue_number = Column(String, nullable=True)
     issue_suppl_volume = Column(String, nullable=True)
     issue_suppl_number = Column(String, nullable=True)
+    identity = Column(String(length=40), nullable=True, unique=True)
+
+    # package metadata that identifies an article.
+    identity_fields = ('article_title', 'journal_pissn', 'journal_eissn',
+                       'issue_year', 'issue_volume', 'issue_number',
+                       'issue_suppl_volume', 'issue_suppl_number')
 
-    def get_aid(self):
+    # package metadata an article cannot be created without.
+    required_fields = ('article_title', 'journal_title', 'issue_year')
+
+    @classmethod
+    def missing_fields(cls, meta):
         """
-        Produce a fresh `aid` only for instances not yet persisted.
+        Returns the list of :attr:`required_fields` missing in `meta`.
+
+        :param meta: a dict as returned by :attr:`checkin.PackageAnalyzer.meta`.
+        """
+        return [field for field in cls.required_fields if meta.get(field) is None]
+
+    @classmethod
+    def make_identity(cls, meta):
         """
-        return self.aid if (self.id and self.aid) else genbase(10)
+        Returns a sha1 hexdigest of the normalized metadata that identifies
+        an article.
+
+        :param meta: a dict as returned by :attr:`checkin.PackageAnalyzer.meta`.
+        """
+        values = []
+        for field in cls.identity_fields:
+            value = meta.get(field)
+            if value is None:
+                value = u''
+            elif isinstance(value, str):
+                # the metadata is utf-8, and byte strings are not
+                # decoded implicitly, as ascii.
+                value = value.decode('utf-8')
+            elif not isinstance(value, unicode):
+                value = unicode(value)
+            values.append(u' '.join(value.upper().split()))
+
+        return hashlib.sha1(u'\x1f'.join(values).encode('utf-8')).hexdigest()
 
     def to_dict(self):
         return dict(id=self.id,
@@ -173,21 +222,33 @@ class ArticlePkg(Base):
         """
         Get or create an ArticlePkg for a package.
 
+        A new ArticlePkg is inserted in a savepoint, as a concurrent
+        checkin of the same article may insert it first. In that case,
+        the ArticlePkg inserted by the other checkin is returned.
+
         :param package: instance of :class:`checkin.ArticlePackage`.
         :param session: sqlalchemy db session
         """
         meta = package.meta
+        identity = cls.make_identity(meta)
         try:
-            article_pkg = session.query(ArticlePkg).filter_by(article_title=meta['article_title']).one()
-        except MultipleResultsFound as e:
-            logger.error('Multiple results trying to get a models.ArticlePkg for article_title=%s. %s' % (
-                meta['article_title'], e))
-
-            raise ValueError('Multiple ArticlePkg for the given criteria')
-        except NoResultFound as e:
+            article_pkg = session.query(ArticlePkg).filter_by(identity=identity).one()
+        except NoResultFound:
             logger.debug('Creating a new models.ArticlePkg')
 
-            article_pkg = ArticlePkg(**meta)
+            article_pkg = ArticlePkg(identity=identity, **meta)
+
+            savepoint = session.begin_nested()
+            try:
+                session.add(article_pkg)
+                savepoint.commit()
+            except IntegrityError:
+                savepoint.rollback()
+                article_pkg = session.query(ArticlePkg).filter_by(identity=identity).first()
+                if article_pkg is None:
+                    raise
+
+                logger.debug('The models.ArticlePkg %s was created concurrently' % identity)
 
         return article_pkg
 
@@ -382,27 +443,165 @@ class Checkpoint(Base):
                         )
 
 
+class PendingNotice(Base):
+    """
+    A notice that could not be delivered to SciELO Manager.
+
+    Pending notices are delivered again by :class:`notifier.NoticeDispatcher`.
+    """
+    __tablename__ = 'pending_notice'
+    id = Column(Integer, primary_key=True)
+    created_at = Column(DateTime, nullable=False)
+    checkin_uri = Column(String, nullable=True)
+    payload = Column(String, nullable=False)
+    retries = Column(Integer, nullable=False, default=0)
+    # the dispatcher delivering the notice, see :meth:`notifier.NoticeDispatcher.load_pending`.
+    claimed_by = Column(String, nullable=True)
+    claimed_at = Column(DateTime, nullable=True)
+
+    def __init__(self, *args, **kwargs):
+        super(PendingNotice, self).__init__(*args, **kwargs)
+        self.created_at = datetime.datetime.now()
+
+    @property
+    def data(self):
+        return json.loads(self.payload)
+
+    @data.setter
+    def data(self, value):
+        self.payload = json.dumps(value)
+        self.checkin_uri = value.get('checkin')
+
+    def __repr__(self):
+        return "<PendingNotice('%s, %s')>" % (self.id, self.checkin_uri)
+
+
+class DOIResolution(Base):
+    """
+    The result of checking if a DOI is registered at CrossRef.
+    """
+    __tablename__ = 'doi_resolution'
+    doi = Column(String, primary_key=True)
+    is_valid = Column(Boolean, nullable=False)
+    checked_at = Column(DateTime, nullable=False)
+
+    def __init__(self, *args, **kwargs):
+        super(DOIResolution, self).__init__(*args, **kwargs)
+        self.checked_at = datetime.datetime.now()
+
+    def __repr__(self):
+        return "<DOIResolution('%s, %s')>" % (self.doi, self.is_valid)
+
+
+class UploadedAsset(Base):
+    """
+    A file stored at a remote host, identified by the checksum of its contents.
+
+    Assets linked to another one with the same contents have `link_target`
+    set to its path. The manifest is kept by :class:`uploader.AssetManifest`.
+    """
+    __tablename__ = 'uploaded_asset'
+    __table_args__ = (UniqueConstraint('host', 'path'),)
+    id = Column(Integer, primary_key=True)
+    host = Column(String, nullable=False)
+    path = Column(String, nullable=False)
+    checksum = Column(String(length=40), nullable=False, index=True)
+    size = Column(Integer, nullable=False)
+    link_target = Column(String, nullable=True)
+    uploaded_at = Column(DateTime, nullable=False)
+
+    def __init__(self, *args, **kwargs):
+        super(UploadedAsset, self).__init__(*args, **kwargs)
+        self.uploaded_at = datetime.datetime.now()
+
+    def __repr__(self):
+        return "<UploadedAsset('%s:%s, %s')>" % (self.host, self.path, self.checksum)
+
+
+AID_LENGTH = 10
+aid_sequence = Sequence('articlepkg_aid_seq', metadata=Base.metadata)
+
+
+class AidAllocator(object):
+    """
+    Allocates unique values for :attr:`ArticlePkg.aid`.
+
+    Blocks of `block_size` numbers are reserved atomically by taking a value
+    from a database sequence, and encoded in base 28. Each process reserves
+    its own blocks, so allocating an aid costs a round-trip only once per block.
+
+    Databases without sequences get random aids instead.
+
+    In both cases the candidates are checked against the existing aids
+    with a single query, as aids were random in the past.
+
+    :param block_size: (optional) number of aids reserved at once.
+    """
+    def __init__(self, block_size=100):
+        self.block_size = block_size
+        self._lock = threading.Lock()
+        self._pid = None
+        self._next = self._end = 0
+
+    def _reserve_block(self, session):
+        hi = session.execute(select([aid_sequence.next_value()])).scalar()
+        self._next = hi * self.block_size
+        self._end = self._next + self.block_size
+
+    def _candidates(self, session, count):
+        bind = session.get_bind(mapper=ArticlePkg.__mapper__)
+        if not bind.dialect.supports_sequences:
+            return [genbase(AID_LENGTH) for i in range(count)]
+
+        candidates = []
+        with self._lock:
+            # the reserved block must not be shared with forked processes.
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._next = self._end = 0
+
+            while len(candidates) < count:
+                if self._next >= self._end:
+                    self._reserve_block(session)
+
+                candidates.append(reprbase(self._next).rjust(AID_LENGTH, BASE28[0]))
+                self._next += 1
+
+        return candidates
+
+    def allocate(self, session, count):
+        """
+        Returns a list of `count` unused aids.
+
+        :param session: the session the aids will be used.
+        :param count: number of aids needed.
+        """
+        aids = []
+        while len(aids) < count:
+            candidates = set(self._candidates(session, count - len(aids))) - set(aids)
+
+            with session.no_autoflush:
+                in_use = set(aid for (aid,) in session.query(ArticlePkg.aid).filter(
+                    ArticlePkg.aid.in_(candidates)))
+
+            if in_use:
+                logger.info("Skipping %s aids already in use" % len(in_use))
+
+            aids.extend(candidates - in_use)
+
+        return aids
+
+
+aid_allocator = AidAllocator()
+
+
 @event.listens_for(Session, 'before_flush')
 def before_flush(session, flush_context, instances):
     # ArticlePkg.aid must be generated automaticaly while
     # a new instance is being saved.
-    for obj in session.new:
-        if isinstance(obj, ArticlePkg):
-            # obj.aid must be unique, so we are checking for its absence
-            # before assigning. This is not quite reliable by the lack
-            # of atomicity over both the operations (query+assignment).
-            for trial_no in range(10):
-                aid = obj.get_aid()
-                try:
-                    session.query(ArticlePkg).filter_by(aid=aid).one()
-                except NoResultFound:
-                    break
-                else:
-                    logger.error("Conflict while generating ArticlePkg.aid attribute")
-                    continue
-            else:
-                logger.error("Max attempts to generate an unique ArticlePkg.aid has expired. Giving up.")
-                aid = None
+    new_pkgs = [obj for obj in session.new if isinstance(obj, ArticlePkg) and not obj.aid]
 
+    if new_pkgs:
+        for obj, aid in zip(new_pkgs, aid_allocator.allocate(session, len(new_pkgs))):
             obj.aid = aid
 
@@ -2,15 +2,24 @@
 import os
 import time
 import threading
+import multiprocessing
 import Queue
 import logging
 import zipfile
 import socket
+import itertools
+from collections import OrderedDict
+
+try:
+    from scandir import scandir
+except ImportError:
+    scandir = None
 
 import pyinotify
 import transaction
 
 import utils
+import cache
 import checkin
 import models
 import excepts
@@ -24,16 +33,95 @@ logger = logging.getLogger('balaio.monitor')
 mask = pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVE_SELF | pyinotify.IN_MOVED_TO | pyinotify.IN_CREATE
 
 
+# Execution modes for the package analysis.
+#  - threads: packages are analyzed by the worker threads.
+#  - processes: packages are analyzed by a pool of processes, and only the
+#    resulting attempt is sent back to the worker threads.
+MODES = ('threads', 'processes')
+
+# Order in which the queued packages are analyzed.
+#  - fifo: arrival order.
+#  - age: the oldest files first.
+#  - size: the smallest files first.
+PRIORITIES = ('fifo', 'age', 'size')
+
+
+def _setup_checkin_process(config):
+    """
+    Initializes a process of the checkin pool.
+
+    Database connections cannot be shared across processes, so each one
+    binds the Session to a brand new engine.
+    """
+    models.Session.configure(bind=models.create_engine_from_config(config))
+
+
 class Monitor(object):
-    def __init__(self, config, workers=None):
-        self.job_queue = Queue.Queue()
-        self.total_workers = workers or 1
+    def __init__(self, config, workers=None, mode=None):
         self.config = config
 
+        if workers is None and config.has_option('monitor', 'workers'):
+            workers = config.getint('monitor', 'workers')
+        self.total_workers = workers or 1
+
+        if mode is None and config.has_option('monitor', 'mode'):
+            mode = config.get('monitor', 'mode')
+        self.mode = mode or 'threads'
+
+        if self.mode not in MODES:
+            raise ValueError('mode must be one of %s' % ', '.join(MODES))
+
+        self.priority = config.get('monitor', 'priority') if config.has_option('monitor', 'priority') else 'fifo'
+        if self.priority not in PRIORITIES:
+            raise ValueError('priority must be one of %s' % ', '.join(PRIORITIES))
+
+        if config.has_option('monitor', 'priority_journals'):
+            self.priority_journals = tuple(issn.strip() for issn in
+                config.get('monitor', 'priority_journals').split(',') if issn.strip())
+        else:
+            self.priority_journals = ()
+
+        # producers are blocked while the queue is full.
+        queue_size = config.getint('monitor', 'queue_size') if config.has_option('monitor', 'queue_size') else 1000
+        self.job_queue = Queue.PriorityQueue(maxsize=queue_size)
+        self._sequence = itertools.count()
+
+        self._stats_lock = threading.Lock()
+        self.started_at = time.time()
+        self.processed = 0
+        self.busy_workers = 0
+        self.busy_time = 0.0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
         self.CheckinNotifier = notifier.checkin_notifier_factory(self.config)
+        # the pool must be forked before any thread or socket is created.
+        self._setup_pool()
         self._setup_sock()
         self._setup_workers()
 
+    def _setup_pool(self):
+        if self.mode == 'processes':
+            self.pool = multiprocessing.Pool(self.total_workers,
+                                             initializer=_setup_checkin_process,
+                                             initargs=(self.config,))
+            logger.info('Analyzing packages with %s processes' % self.total_workers)
+        else:
+            self.pool = None
+
+    def get_attempt(self, filepath):
+        """
+        Runs :func:`checkin.get_attempt` according to the execution mode.
+
+        When running on processes, the calling thread is blocked until
+        the attempt is sent back by the pool. Exceptions raised during
+        the analysis are re-raised here.
+        """
+        if self.pool is not None:
+            return self.pool.apply(checkin.get_attempt, (filepath,))
+        else:
+            return checkin.get_attempt(filepath)
+
     def _setup_sock(self):
         while True:
             try:
@@ -53,52 +141,281 @@ class Monitor(object):
             thread.start()
 
     def handle_events(self, job_queue):
+        if self.pool is None:
+            # each worker thread validates with its own copy of the schema,
+            # compiled before the first package is taken.
+            checkin.schema_registry.preload(checkin.SPS_XSD)
+
         while True:
-            filepath = job_queue.get()
-            logger.debug('Started handling event for %s' % filepath)
+            priority, sequence, enqueued_at, filepath = job_queue.get()
+
+            started = time.time()
+            with self._stats_lock:
+                wait = started - enqueued_at
+                self.total_wait += wait
+                self.max_wait = max(self.max_wait, wait)
+                self.busy_workers += 1
 
             try:
-                attempt = checkin.get_attempt(filepath)
+                self.handle_event(filepath)
+            except Exception as e:
+                logger.exception('Unexpected error handling event for %s: %s' % (filepath, e))
+            finally:
+                with self._stats_lock:
+                    self.busy_workers -= 1
+                    self.busy_time += time.time() - started
+                    self.processed += 1
 
-            except ValueError as e:
-                try:
-                    utils.mark_as_failed(filepath)
-                except OSError as e:
-                    logger.debug('The file is gone before marked as failed. %s' % e)
+            logger.debug('Monitor stats: %s' % self.stats())
 
-                logger.debug('Failed during checkin: %s: %s' % (filepath, e))
+    def handle_event(self, filepath):
+        logger.debug('Started handling event for %s' % filepath)
 
-            except excepts.DuplicatedPackage as e:
-                try:
-                    utils.mark_as_duplicated(filepath)
-                except OSError as e:
-                    logger.debug('The file is gone before marked as duplicated. %s' % e)
+        try:
+            attempt = self.get_attempt(filepath)
 
+        except ValueError as e:
+            try:
+                utils.mark_as_failed(filepath)
+            except OSError as e:
+                logger.debug('The file is gone before marked as failed. %s' % e)
+
+            logger.debug('Failed during checkin: %s: %s' % (filepath, e))
+
+        except excepts.DuplicatedPackage as e:
+            try:
+                utils.mark_as_duplicated(filepath)
+            except OSError as e:
+                logger.debug('The file is gone before marked as duplicated. %s' % e)
+
+        else:
+            # Create a notification to keep track of the checkin process
+            session = models.Session()
+            checkin_notifier = self.CheckinNotifier(attempt, session)
+            checkin_notifier.start()
+
+            if attempt.is_valid:
+                notification_msg = 'Attempt ready to be validated'
+                notification_status = models.Status.ok
             else:
-                # Create a notification to keep track of the checkin process
-                session = models.Session()
-                checkin_notifier = self.CheckinNotifier(attempt, session)
-                checkin_notifier.start()
+                notification_msg = 'Attempt cannot be validated'
+                notification_status = models.Status.error
+
+            checkin_notifier.tell(notification_msg, notification_status, 'Checkin')
+            checkin_notifier.end()
+
+            transaction.commit()
+
+            #Send stream
+            utils.send_message(self.stream, attempt, utils.make_digest)
+            logging.debug('Message sent for %s: %s, %s' % (filepath,
+                repr(attempt), repr(utils.make_digest)))
 
-                if attempt.is_valid:
-                    notification_msg = 'Attempt ready to be validated'
-                    notification_status = models.Status.ok
-                else:
-                    notification_msg = 'Attempt cannot be validated'
-                    notification_status = models.Status.error
+    def get_priority(self, filepath):
+        """
+        Returns the priority of the package at `filepath`, the lowest first.
+
+        Packages of `priority_journals`, identified by the ISSN that prefixes
+        their filenames, come before the others. Then the packages are ordered
+        according to :attr:`priority`.
+        """
+        journal = 0 if os.path.basename(filepath).startswith(self.priority_journals) else 1
 
-                checkin_notifier.tell(notification_msg, notification_status, 'Checkin')
-                checkin_notifier.end()
+        if self.priority == 'fifo':
+            return (journal, 0)
 
-                transaction.commit()
+        try:
+            st = os.stat(filepath)
+        except OSError:
+            return (journal, 0)
 
-                #Send stream
-                utils.send_message(self.stream, attempt, utils.make_digest)
-                logging.debug('Message sent for %s: %s, %s' % (filepath,
-                    repr(attempt), repr(utils.make_digest)))
+        return (journal, st.st_mtime if self.priority == 'age' else st.st_size)
 
     def trigger_event(self, filepath):
-        self.job_queue.put(filepath)
+        """
+        Enqueues the package to be analyzed. The caller is blocked
+        while the queue is full.
+        """
+        item = (self.get_priority(filepath), next(self._sequence), time.time(), filepath)
+        try:
+            self.job_queue.put_nowait(item)
+        except Queue.Full:
+            logger.info('The job queue is full. Waiting to enqueue %s' % filepath)
+            self.job_queue.put(item)
+
+    def stats(self):
+        """
+        Returns the queue depth, the time packages waited in the
+        queue, in seconds, and the utilization of the workers.
+        """
+        with self._stats_lock:
+            elapsed = time.time() - self.started_at
+            dequeued = self.processed + self.busy_workers
+            return {
+                'queue_depth': self.job_queue.qsize(),
+                'queue_size': self.job_queue.maxsize,
+                'processed': self.processed,
+                'avg_wait': self.total_wait / dequeued if dequeued else 0.0,
+                'max_wait': self.max_wait,
+                'busy_workers': self.busy_workers,
+                'utilization': self.busy_time / (elapsed * self.total_workers) if elapsed else 0.0,
+            }
+
+
+class EventCoalescer(object):
+    """
+    Coalesces the filesystem events of the uploaded packages.
+
+    Events are queued by the inotify thread without touching the files.
+    A background thread dispatches each package after `window` seconds
+    without new events for its path, so an upload that triggers many
+    events is dispatched once. Files that were already dispatched,
+    identified by device, inode, size and mtime, are ignored.
+
+    While `dispatch` blocks, events are kept queued up to `maxsize`.
+    Events beyond that are dropped, and `on_overflow` is called once
+    the queue is drained, so the dropped packages can be looked up.
+
+    :param dispatch: callable that receives the filepath of a package.
+    :param window: (optional) seconds to wait for more events of a path.
+    :param history: (optional) number of dispatched files remembered.
+    :param maxsize: (optional) max number of queued events.
+    :param on_overflow: (optional) callable that receives nothing.
+    :param clock: (optional) callable that returns the current time.
+    """
+    def __init__(self, dispatch, window=1.0, history=4096, maxsize=10000,
+                 on_overflow=None, clock=time.time):
+        self._dispatch = dispatch
+        self.window = window
+        self._on_overflow = on_overflow
+        self._clock = clock
+        self._queue = Queue.Queue(maxsize=maxsize)
+        self._overflowed = False
+        # filepath -> time of its last event, the oldest first.
+        self._pending = OrderedDict()
+        self._dispatched = cache.LRUCache(maxsize=history)
+        self._thread = None
+
+        self.received = 0
+        self.coalesced = 0
+        self.ignored = 0
+        self.dispatched = 0
+        self.dropped = 0
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stops the background thread. Pending events are discarded.
+        """
+        self._queue.put(None)
+        self._thread.join()
+
+    def push(self, filepath):
+        """
+        Enqueues an event for `filepath`. Safe to be called from the
+        inotify thread, as it never blocks.
+        """
+        try:
+            self._queue.put_nowait((filepath, self._clock()))
+        except Queue.Full:
+            self.dropped += 1
+            self._overflowed = True
+
+    def _run(self):
+        # module globals may be gone during the interpreter shutdown.
+        Empty = Queue.Empty
+
+        while True:
+            try:
+                item = self._queue.get(timeout=self._time_to_flush())
+            except Empty:
+                item = ()
+
+            if item is None:
+                break
+
+            if item:
+                self.add(*item)
+
+            try:
+                self.flush()
+            except Exception as e:
+                logger.exception('Unexpected error dispatching packages: %s' % e)
+
+            if self._overflowed and self._queue.empty():
+                self._overflowed = False
+                logger.warning('Events were dropped while the job queue was full. Stats: %s' % self.stats())
+                if self._on_overflow is not None:
+                    self._on_overflow()
+
+    def _time_to_flush(self):
+        """
+        Seconds until the oldest pending event is due, or ``None``
+        if there is nothing pending.
+        """
+        if not self._pending:
+            return None
+
+        seen_at = next(self._pending.itervalues())
+        return max(seen_at + self.window - self._clock(), 0)
+
+    def add(self, filepath, seen_at):
+        self.received += 1
+        if self._pending.pop(filepath, None) is not None:
+            self.coalesced += 1
+
+        self._pending[filepath] = seen_at
+
+    def flush(self):
+        """
+        Dispatches the packages without events in the last `window` seconds.
+        """
+        now = self._clock()
+        while self._pending:
+            filepath, seen_at = next(self._pending.iteritems())
+            if seen_at + self.window > now:
+                break
+
+            del self._pending[filepath]
+            self._dispatch_once(filepath)
+
+    def _dispatch_once(self, filepath):
+        try:
+            st = os.stat(filepath)
+        except OSError as e:
+            logger.debug('The file is gone before being dispatched. %s' % e)
+            self.ignored += 1
+            return None
+
+        key = (st.st_dev, st.st_ino, st.st_size, st.st_mtime)
+        if key in self._dispatched:
+            logger.debug('%s had already been dispatched' % filepath)
+            self.ignored += 1
+            return None
+
+        self._dispatched.set(key, filepath)
+
+        if not zipfile.is_zipfile(filepath):
+            logger.info('Invalid zipfile: %s' % filepath)
+            self.ignored += 1
+            return None
+
+        self._dispatch(filepath)
+        self.dispatched += 1
+
+    def stats(self):
+        return {
+            'received': self.received,
+            'coalesced': self.coalesced,
+            'ignored': self.ignored,
+            'dispatched': self.dispatched,
+            'dropped': self.dropped,
+            'pending': len(self._pending),
+        }
 
 
 class EventHandler(pyinotify.ProcessEvent):
@@ -109,8 +426,37 @@ class EventHandler(pyinotify.ProcessEvent):
         if not config:
             raise TypeError(u'__init__() expects a config kwarg')
 
+        self.config = config
         self.monitor = Monitor(config)
 
+        window = config.getfloat('monitor', 'event_window') if config.has_option('monitor', 'event_window') else 1.0
+        self.coalescer = EventCoalescer(self.monitor.trigger_event, window=window,
+                                        on_overflow=self.rescan)
+        self.coalescer.start()
+
+        self._rescan_lock = threading.Lock()
+        self._scanner = None
+
+    def rescan(self):
+        """
+        Looks for pending packages on a background thread, unless
+        a scan is already running. See :func:`reconcile`.
+        """
+        with self._rescan_lock:
+            if self._scanner is not None and self._scanner.is_alive():
+                return None
+
+            rate = self.config.getfloat('monitor', 'backlog_rate') if self.config.has_option('monitor', 'backlog_rate') else 10
+            self._scanner = threading.Thread(target=reconcile,
+                args=(self.config.get('monitor', 'watch_path').split(','), self.coalescer.push),
+                kwargs={'recursive': self.config.getboolean('monitor', 'recursive'), 'rate': rate})
+            self._scanner.daemon = True
+            self._scanner.start()
+
+    def process_IN_Q_OVERFLOW(self, event):
+        logger.warning('The inotify queue overflowed and events were lost. Looking for pending packages.')
+        self.rescan()
+
     def process_IN_CLOSE_WRITE(self, event):
         logger.debug('IN_CLOSE_WRITE event handler for %s' % event)
         self._do_the_job(event)
@@ -125,18 +471,154 @@ class EventHandler(pyinotify.ProcessEvent):
 
     def _do_the_job(self, event):
         """
-        Add the package in a processing queue.
+        Add the package in a processing queue, through the :class:`EventCoalescer`.
 
         All filenames prefixed with `_` are identified as special packages
         and are ignored by the system.
         """
         filepath = event.pathname
         if not os.path.basename(filepath).startswith('_'):
+            self.coalescer.push(filepath)
+
+
+def _list_dir(path):
+    """
+    Returns a list of tuples (filepath, is_dir) for the entries of `path`.
+
+    `scandir`, listed in the requirements, gets the entry types along
+    with the directory read, without a stat call per entry. Without it,
+    each entry is stat'ed by `os.path.isdir`.
+    """
+    if scandir is not None:
+        return [(entry.path, entry.is_dir()) for entry in scandir(path)]
+    else:
+        return [(os.path.join(path, name), os.path.isdir(os.path.join(path, name)))
+                for name in os.listdir(path)]
+
+
+def walk_packages(paths, recursive=True):
+    """
+    Yields the filepaths of the files under `paths`, except the special
+    packages, prefixed with `_`.
+
+    :param paths: list of directories.
+    :param recursive: (optional) if the subdirectories must be walked too.
+    """
+    dirs = list(reversed(paths))
+    while dirs:
+        path = dirs.pop()
+        try:
+            entries = _list_dir(path)
+        except OSError as e:
+            logger.error('Could not read the directory %s: %s' % (path, e))
+            continue
+
+        for filepath, is_dir in sorted(entries):
+            if is_dir:
+                if recursive:
+                    dirs.append(filepath)
+            elif not os.path.basename(filepath).startswith('_'):
+                yield filepath
+
+
+def package_checksum(filepath):
+    """
+    Returns the checksum of the package, the same way it is stored
+    on :attr:`models.Attempt.package_checksum`.
+    """
+    pkg = checkin.PackageAnalyzer(filepath)
+    try:
+        return pkg.checksum
+    finally:
+        pkg._cleanup_package_fp()
+
+
+def find_backlog(filepaths, Session=models.Session, checksum=package_checksum, batch_size=500):
+    """
+    Yields the packages of `filepaths` that were never checked in.
+
+    Packages are compared by checksum, with a single query against
+    :attr:`models.Attempt.package_checksum` for each batch of packages.
+
+    :param filepaths: iterable of filepaths of packages.
+    :param Session: (optional) Reference to a Session class.
+    :param checksum: (optional) callable that returns the checksum of a package.
+    :param batch_size: (optional) max number of packages looked up at once.
+    """
+    filepaths = iter(filepaths)
+    while True:
+        batch = list(itertools.islice(filepaths, batch_size))
+        if not batch:
+            break
+
+        checksums = OrderedDict()
+        for filepath in batch:
             if not zipfile.is_zipfile(filepath):
                 logger.info('Invalid zipfile: %s' % filepath)
-                return None
+                continue
+
+            try:
+                checksums[filepath] = checksum(filepath)
+            except (IOError, OSError, zipfile.BadZipfile) as e:
+                logger.info('Could not read the package %s: %s' % (filepath, e))
+
+        if not checksums:
+            continue
+
+        session = Session()
+        try:
+            known = set(row.package_checksum for row in session.query(models.Attempt.package_checksum).filter(
+                models.Attempt.package_checksum.in_(checksums.values())))
+        finally:
+            session.close()
+            transaction.abort()
+
+        for filepath, pkg_checksum in checksums.items():
+            if pkg_checksum not in known:
+                yield filepath
 
-            self.monitor.trigger_event(filepath)
+
+def feed_backlog(filepaths, dispatch, rate=10, clock=time.time, sleep=time.sleep):
+    """
+    Dispatches `filepaths` at no more than `rate` packages per second.
+
+    :param filepaths: iterable of filepaths of packages.
+    :param dispatch: callable that receives the filepath of a package.
+    :param rate: (optional) packages per second. ``0`` means unlimited.
+    :returns: the number of dispatched packages.
+    """
+    interval = 1.0 / rate if rate else 0
+    next_at = clock()
+    total = 0
+
+    for filepath in filepaths:
+        now = clock()
+        if next_at > now:
+            sleep(next_at - now)
+            now = next_at
+
+        dispatch(filepath)
+        total += 1
+        next_at = now + interval
+
+    return total
+
+
+def reconcile(paths, dispatch, recursive=True, rate=10, Session=models.Session):
+    """
+    Dispatches the packages that arrived while the monitor was down.
+
+    Must be started after the directories are being watched, so no
+    package is missed. Packages that are dispatched by both means
+    are deduplicated by the :class:`EventCoalescer`.
+    """
+    started = time.time()
+    logger.info('Looking for pending packages in %s' % ', '.join(paths))
+
+    total = feed_backlog(find_backlog(walk_packages(paths, recursive=recursive), Session=Session),
+                         dispatch, rate=rate)
+
+    logger.info('Found %s pending packages in %.1fs' % (total, time.time() - started))
 
 
 if __name__ == '__main__':
@@ -146,6 +628,10 @@ if __name__ == '__main__':
     utils.setup_logging()
     models.Session.configure(bind=models.create_engine_from_config(config))
 
+    # Compiling the schema before the checkin processes are forked.
+    # On threads mode, each worker thread compiles its own copy on start-up.
+    checkin.schema_registry.preload(checkin.SPS_XSD)
+
     # Setting up PyInotify event watcher.
     wm = pyinotify.WatchManager()
     handler = EventHandler(config=config)
@@ -158,5 +644,9 @@ if __name__ == '__main__':
 
     logger.info('Watching %s' % config.get('monitor', 'watch_path'))
 
+    # Checking in the packages that arrived while the monitor was down.
+    if not config.has_option('monitor', 'backlog_scan') or config.getboolean('monitor', 'backlog_scan'):
+        handler.rescan()
+
     notifier.loop()
 
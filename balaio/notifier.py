@@ -1,5 +1,13 @@
 # coding: utf-8
+import os
+import time
+import socket
+import datetime
 import logging
+import threading
+import itertools
+import multiprocessing.util
+import Queue
 
 import scieloapi
 import sqlalchemy
@@ -35,17 +43,20 @@ class Notifier(object):
     """
 
     def __init__(self, checkpoint, scieloapi_client,
-                 db_session, manager_integration=True):
+                 db_session, manager_integration=True, dispatcher=None):
         """
         :param checkpoint: is a :class:`models.Checkpoint` instance.
         :param scieloapi_client: instance of `scieloapi.Client`.
         :param db_session: sqlalchemy session.
         :param manager_integration: (optional) if notifications must be sent to manager.
+        :param dispatcher: (optional) :class:`NoticeDispatcher` used to deliver
+        notices asynchronously. Notices are delivered synchronously by default.
         """
         self.scieloapi = scieloapi_client
         self.checkpoint = checkpoint
         self.db_session = db_session
         self.manager_integration = manager_integration
+        self.dispatcher = dispatcher
 
         # make sure checkpoint is held by the session
         if self.checkpoint not in self.db_session:
@@ -156,17 +167,404 @@ class Notifier(object):
             'status': status.name,
         }
 
+        if self.dispatcher is not None:
+            self.dispatcher.put(data)
+            return None
+
         try:
             self.scieloapi.notices.post(data)
         except scieloapi.exceptions.APIError as e:
             logger.error('Error posting data to Manager. Message: %s' % e)
 
 
+class NoticeDispatcher(object):
+    """
+    Delivers notices to SciELO Manager on a background thread.
+
+    Queued notices are taken from the queue in groups, ordered by checkin.
+    The Manager API has no bulk endpoint, so each notice is still sent
+    by its own request. Transient errors are retried with exponential
+    backoff, and notices that could not be delivered are persisted as
+    :class:`models.PendingNotice`, to be delivered again when the queue
+    is idle.
+
+    Pending notices are claimed before being delivered again, so each
+    one is redelivered by a single dispatcher, even if many processes
+    share the database.
+    """
+    # errors that may not happen again in a later try.
+    transient_errors = (
+        scieloapi.exceptions.ConnectionError,
+        scieloapi.exceptions.Timeout,
+        scieloapi.exceptions.HTTPError,
+        scieloapi.exceptions.InternalServerError,
+        scieloapi.exceptions.BadGateway,
+        scieloapi.exceptions.ServiceUnavailable,
+    )
+
+    def __init__(self, scieloapi_client, Session=None, batch_size=50,
+                 max_retries=4, backoff=0.5, idle_interval=60,
+                 max_pending_retries=10, claim_ttl=600, pending_chunk_size=None):
+        """
+        :param scieloapi_client: instance of `scieloapi.Client`.
+        :param Session: (optional) Session class used to persist undelivered
+        notices. If missing, undelivered notices are discarded.
+        :param batch_size: (optional) max number of notices taken from the
+        queue at once.
+        :param max_retries: (optional) retries before giving up a notice.
+        :param backoff: (optional) seconds to wait before the first retry. The
+        interval is doubled on each retry.
+        :param idle_interval: (optional) seconds of idleness before trying to
+        deliver the pending notices.
+        :param max_pending_retries: (optional) deliveries of a pending notice
+        before discarding it.
+        :param claim_ttl: (optional) seconds after which pending notices claimed
+        by a dispatcher, e.g. one that died, can be claimed by others.
+        :param pending_chunk_size: (optional) max number of pending notices
+        claimed at once. Defaults to `batch_size`.
+        """
+        self.scieloapi = scieloapi_client
+        self.Session = Session
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.idle_interval = idle_interval
+        self.max_pending_retries = max_pending_retries
+        self.claim_ttl = claim_ttl
+        self.pending_chunk_size = pending_chunk_size or batch_size
+
+        self.delivered = 0
+        self.discarded = 0
+        self.persisted = 0
+        self.total_latency = 0.0
+        self.last_latency = None
+
+        self._pid = None
+        self._logged_stats = None
+        self._lock = threading.Lock()
+        self._flushing = threading.Event()
+
+    def _ensure_running(self):
+        """
+        Starts the sender thread. Threads do not survive a fork, so
+        each process runs its own.
+
+        The queued notices are flushed when the process exits. Pool
+        workers leave through `os._exit`, skipping `atexit`, but run the
+        finalizers of `multiprocessing.util`, as does the main process.
+        """
+        with self._lock:
+            if self._pid != os.getpid():
+                self._queue = Queue.Queue()
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+                self._pid = os.getpid()
+                multiprocessing.util.Finalize(self, self.flush, exitpriority=10)
+
+    def put(self, data, pending_id=None):
+        """
+        Enqueues a notice to be delivered.
+
+        :param data: the notice payload.
+        :param pending_id: (optional) id of the persisted :class:`models.PendingNotice`.
+        """
+        self._ensure_running()
+        self._queue.put({'data': data, 'enqueued_at': time.time(), 'pending_id': pending_id})
+
+    def _run(self):
+        # module globals may be gone during the interpreter shutdown.
+        Empty = Queue.Empty
+        # whether there may be pending notices left to claim, e.g. the
+        # ones persisted before the process started.
+        more_pending = True
+
+        while True:
+            try:
+                item = self._queue.get(timeout=self.idle_interval)
+            except Empty:
+                self._log_stats()
+                more_pending = self._load_next_chunk()
+                continue
+
+            if item is None:
+                break
+
+            batch = [item]
+
+            while len(batch) < self.batch_size:
+                try:
+                    item = self._queue.get_nowait()
+                except Empty:
+                    break
+
+                if item is None:
+                    # put it back to stop the thread after the delivery.
+                    self._queue.put(None)
+                    break
+
+                batch.append(item)
+
+            try:
+                delivered = self.deliver(batch)
+            except Exception as e:
+                logger.exception('Unexpected error delivering notices: %s' % e)
+                delivered = False
+
+            # claims the next chunk of pending notices as the queue drains,
+            # unless Manager seems to be unreachable.
+            if (more_pending and delivered and self._queue.empty()
+                    and not self._flushing.is_set()):
+                more_pending = self._load_next_chunk()
+            elif not delivered:
+                more_pending = False
+
+            logger.debug('Notice delivery stats: %s' % self.stats())
+
+    def _load_next_chunk(self):
+        """
+        Loads pending notices from the sender thread.
+
+        :returns: True if there may be more pending notices to claim.
+        """
+        try:
+            return self.load_pending() == self.pending_chunk_size
+        except Exception as e:
+            logger.exception('Unexpected error loading pending notices: %s' % e)
+            return False
+
+    def deliver(self, batch):
+        """
+        Delivers a batch of queued notices, ordered by checkin.
+
+        Once a notice is given up, the remaining notices of the batch are
+        persisted without being sent, as Manager is probably unreachable.
+        It also preserves the order of the notices of a checkin.
+
+        :returns: False if some notices must be delivered later.
+        """
+        undelivered = []
+        keyfunc = lambda item: item['data'].get('checkin')
+        for checkin, items in itertools.groupby(sorted(batch, key=keyfunc), keyfunc):
+            for item in items:
+                if undelivered or self._flushing.is_set() or not self._post(item):
+                    undelivered.append(item)
+
+        if undelivered:
+            self._persist(undelivered)
+
+        return not undelivered
+
+    def _post(self, item):
+        """
+        Posts a notice to Manager, retrying on transient errors.
+
+        :returns: False if the notice must be delivered later.
+        """
+        item['tried'] = True
+        for retry in range(self.max_retries + 1):
+            try:
+                self.scieloapi.notices.post(item['data'])
+            except self.transient_errors as e:
+                logger.warning('Error posting notice to Manager (try %s). Message: %s' % (retry + 1, e))
+                if self._flushing.is_set():
+                    break
+                if retry < self.max_retries:
+                    time.sleep(self.backoff * 2 ** retry)
+            except scieloapi.exceptions.APIError as e:
+                logger.error('Error posting notice to Manager. Discarding it. Message: %s' % e)
+                self.discarded += 1
+                self._forget(item)
+                return True
+            else:
+                latency = time.time() - item['enqueued_at']
+                self.delivered += 1
+                self.total_latency += latency
+                self.last_latency = latency
+                self._forget(item)
+                return True
+
+        return False
+
+    def _persist(self, items):
+        """
+        Stores undelivered notices.
+
+        Pending notices are released to be claimed again, and discarded
+        once they were tried `max_pending_retries` times.
+        """
+        if self.Session is None:
+            logger.error('Discarding %s undelivered notices.' % len(items))
+            self.discarded += len(items)
+            return None
+
+        discarded = 0
+        session = self.Session()
+        try:
+            for item in items:
+                if item['pending_id'] is None:
+                    session.add(models.PendingNotice(data=item['data']))
+                else:
+                    pending = session.query(models.PendingNotice).get(item['pending_id'])
+                    if pending is None:
+                        continue
+
+                    if item.get('tried'):
+                        pending.retries += 1
+
+                    if pending.retries >= self.max_pending_retries:
+                        logger.error('Discarding the pending notice %s after %s retries.' % (
+                            pending.id, pending.retries))
+                        session.delete(pending)
+                        discarded += 1
+                    else:
+                        pending.claimed_by = None
+                        pending.claimed_at = None
+            transaction.commit()
+        except Exception as e:
+            transaction.abort()
+            logger.error('Could not persist %s undelivered notices: %s' % (len(items), e))
+            self.discarded += len(items)
+        else:
+            self.discarded += discarded
+            self.persisted += len(items) - discarded
+        finally:
+            session.close()
+
+    def _forget(self, item):
+        """
+        Removes a delivered notice from the pending notices.
+        """
+        if item['pending_id'] is None or self.Session is None:
+            return None
+
+        session = self.Session()
+        try:
+            session.query(models.PendingNotice).filter_by(id=item['pending_id']).delete()
+            transaction.commit()
+        except Exception as e:
+            transaction.abort()
+            logger.error('Could not remove the pending notice %s: %s' % (item['pending_id'], e))
+        finally:
+            session.close()
+
+    def load_pending(self):
+        """
+        Claims a chunk of the persisted notices not claimed by other
+        dispatchers, and enqueues them to be delivered again.
+
+        :returns: the number of claimed notices.
+        """
+        if self.Session is None:
+            return 0
+
+        PendingNotice = models.PendingNotice
+        token = '%s:%s:%s' % (socket.gethostname(), os.getpid(), id(self))
+        now = datetime.datetime.now()
+        expired = now - datetime.timedelta(seconds=self.claim_ttl)
+
+        session = self.Session()
+        try:
+            # the rows are claimed by a single statement, so concurrent
+            # dispatchers never claim the same row. The claim condition is
+            # repeated out of the subquery to be checked again on rows
+            # updated by a concurrent claim.
+            claimable = sqlalchemy.or_(PendingNotice.claimed_at == None,
+                                       PendingNotice.claimed_at < expired)
+            chunk = session.query(PendingNotice.id).filter(claimable).order_by(
+                PendingNotice.id).limit(self.pending_chunk_size).subquery()
+            session.query(PendingNotice).filter(PendingNotice.id.in_(chunk)).filter(
+                claimable).update({'claimed_by': token, 'claimed_at': now},
+                                  synchronize_session=False)
+            transaction.commit()
+
+            # the notices of earlier chunks are already enqueued.
+            pending_notices = session.query(PendingNotice).filter_by(
+                claimed_by=token, claimed_at=now).order_by(PendingNotice.id).all()
+            for pending in pending_notices:
+                self.put(pending.data, pending_id=pending.id)
+        except Exception:
+            transaction.abort()
+            raise
+        finally:
+            session.close()
+
+        if pending_notices:
+            logger.info('%s pending notices enqueued for delivery' % len(pending_notices))
+
+        return len(pending_notices)
+
+    def stop(self):
+        """
+        Stops the sender thread after the delivery of the queued notices.
+        """
+        if self._pid == os.getpid():
+            self._queue.put(None)
+            self._thread.join()
+            self._pid = None
+
+    def flush(self, timeout=10):
+        """
+        Persists all notices still on the queue, including the batch being
+        delivered, without sending them. Used at process exit.
+
+        :param timeout: (optional) seconds to wait for the sender thread.
+        """
+        if self._pid != os.getpid():
+            return None
+
+        # the sender thread persists the rest of its batch and the
+        # queued notices, instead of posting them.
+        self._flushing.set()
+        self._queue.put(None)
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            logger.error('Timed out persisting the undelivered notices.')
+        self._pid = None
+        self._log_stats()
+
+    def _log_stats(self):
+        """
+        Logs the delivery metrics, if they changed since they were last
+        logged. Called when the queue is idle and at process exit.
+        """
+        stats = self.stats()
+        if stats != self._logged_stats:
+            logger.info('Notice delivery stats: %s' % stats)
+            self._logged_stats = stats
+
+    def stats(self):
+        """
+        Delivery metrics. They are logged when the queue is idle and
+        at process exit.
+        """
+        return {
+            'queue_depth': self._queue.qsize() if self._pid == os.getpid() else 0,
+            'delivered': self.delivered,
+            'discarded': self.discarded,
+            'persisted': self.persisted,
+            'mean_latency': self.total_latency / self.delivered if self.delivered else None,
+            'last_latency': self.last_latency,
+        }
+
+
 def create_checkpoint_notifier(config, point):
     scieloapi_client = scieloapi.Client(config.get('manager', 'api_username'),
                                         config.get('manager', 'api_key'),
                                         api_uri=config.get('manager', 'api_url'))
 
+    if config.has_option('manager', 'async_notifications') and config.getboolean(
+            'manager', 'async_notifications'):
+        if config.has_option('manager', 'pending_max_retries'):
+            max_pending_retries = config.getint('manager', 'pending_max_retries')
+        else:
+            max_pending_retries = 10
+
+        dispatcher = NoticeDispatcher(scieloapi_client, Session=models.Session,
+                                      max_pending_retries=max_pending_retries)
+    else:
+        dispatcher = None
+
     def _checkin_notifier_factory(attempt, session):
         try:
             checkpoint = session.query(models.Checkpoint).filter(
@@ -182,7 +580,8 @@ def create_checkpoint_notifier(config, point):
         return Notifier(checkpoint,
                         scieloapi_client,
                         session,
-                        manager_integration=config.getboolean('manager', 'notifications'))
+                        manager_integration=config.getboolean('manager', 'notifications'),
+                        dispatcher=dispatcher)
 
     return _checkin_notifier_factory
 
@@ -62,26 +62,43 @@ class GtwMetaFactory(JSONP):
             return None
         return new_offset
 
-    def _current_resource_path(self, filters, offset=None, limit=None):
+    def _current_resource_path(self, filters, offset=None, limit=None, after_id=None):
         """
         Returns the current resource path excluding filters containing ``None`` as value.
 
         :param filters: a dict to be returned as querystring params.
         :param offset: (optional) an int. Default is ``None``.
         :param limit: (optional) an int. Default is ``None``.
+        :param after_id: (optional) an int. Default is ``None``.
         """
         filters.update({'offset': offset})
         filters.update({'limit': limit})
-        return self.request.current_route_path(_query={k: v for k, v in filters.items() if v})
+        filters.update({'after_id': after_id})
+        return self.request.current_route_path(_query={k: v for k, v in filters.items() if v is not None})
 
     def format_response(self, data):
         """
         Format response
         To a single document, add resource_uri to the object
-        To a set of documents, add meta and add resource_uri to all objects
+        To a set of documents, add meta and add resource_uri to all objects.
+        Pages selected by ``after_id`` link to the next page by the id of its
+        last object
 
         """
-        if 'objects' in data:
+        if 'objects' in data and 'after_id' in data:
+            dct_meta = {}
+            next_after_id = data['next_after_id']
+
+            dct_meta['meta'] = {
+                'limit': self._positive_int_or_zero(data['limit']),
+                'after_id': data['after_id'],
+                'total': data['total'],
+                'previous': None,
+                'next': self._current_resource_path(data.get('filters', {}), limit=data['limit'], after_id=next_after_id) if next_after_id is not None else None,
+            }
+            dct_meta['objects'] = [self.add_resource_uri(obj) for obj in data['objects']]
+            return dct_meta
+        elif 'objects' in data:
             dct_meta = {}
             prev_offset = self._prev_offset(data['offset'], data['limit'])
             next_offset = self._next_offset(data['offset'], data['limit'], data['total'])
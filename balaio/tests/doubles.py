@@ -1,9 +1,10 @@
 # coding: utf-8
 from StringIO import StringIO
 import datetime
-from xml.etree.ElementTree import ElementTree
 import types
 
+from lxml import etree
+
 
 class Patch(object):
     """
@@ -87,7 +88,6 @@ class PackageAnalyzerStub(object):
 
     @property
     def xml(self):
-        etree = ElementTree()
         return etree.parse(StringIO(self._xml_string))
 
     def lock_package(self):
@@ -175,6 +175,7 @@ class AttemptStub(object):
         self.collection_uri = '/api/v1/collection/xxx/'
         self.package_checksum = 'ol9j27n3f52kne7hbn'
         self.articlepkg = ArticlePkgStub()
+        self.analysis = None
 
     def to_dict(self):
         return dict(id=self.id,
@@ -255,10 +256,25 @@ class QueryStub(object):
             o.offset = lambda params: [self.model(), self.model()]
         return o
 
+    def options(self, *args):
+        return self
+
+    def order_by(self, *args):
+        return self
+
+    def keyset_limit(self, args):
+        o = ObjectStub()
+        o.all = lambda: [self.model(), self.model()] if self.found else []
+        return o
+
     def filter_by(self, **kwargs):
         o = ObjectStub()
         o.limit = self.limit
         o.scalar = self.scalar
+        keyset = ObjectStub()
+        keyset.limit = self.keyset_limit
+        o.filter = lambda *args: o
+        o.order_by = lambda *args: keyset
         return o
 
     def get(self, id):
@@ -303,3 +319,10 @@ class SessionStub(object):
     def add(self, item):
         self._items.append(item)
 
+
+class ClockStub(object):
+    def __init__(self, now=0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
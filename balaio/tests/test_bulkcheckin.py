@@ -0,0 +1,219 @@
+# coding: utf-8
+import os
+import shutil
+import tempfile
+import unittest
+
+from balaio import bulkcheckin, checkin, models
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import sessionmaker
+
+from . import doubles
+from .utils import db_bootstrap, DB_READY
+
+
+class IterPackagesTests(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+
+        for filename in ['a.zip', '_failed_b.zip']:
+            open(os.path.join(self.path, filename), 'w').close()
+
+    def test_directories_are_walked(self):
+        self.assertEqual(list(bulkcheckin.iter_packages([self.path])),
+                         [os.path.join(self.path, 'a.zip')])
+
+    def test_packages(self):
+        self.assertEqual(list(bulkcheckin.iter_packages(['/tmp/c.zip'])), ['/tmp/c.zip'])
+
+    def test_file_list(self):
+        file_list = os.path.join(self.path, 'packages.txt')
+        with open(file_list, 'w') as fp:
+            fp.write('/tmp/c.zip\n\n/tmp/d.zip\n')
+
+        self.assertEqual(list(bulkcheckin.iter_packages([], file_list=file_list)),
+                         ['/tmp/c.zip', '/tmp/d.zip'])
+
+
+class AnalyzeTests(unittest.TestCase):
+
+    def test_missing_package(self):
+        filepath, analysis, error = bulkcheckin.analyze('/tmp/missing/bla.zip')
+
+        self.assertEqual(filepath, '/tmp/missing/bla.zip')
+        self.assertIsNone(analysis)
+        self.assertTrue(error)
+
+
+class BulkCheckinTests(unittest.TestCase):
+
+    def test_failed_packages_are_marked(self):
+        fp = tempfile.NamedTemporaryFile(suffix='.zip', delete=False)
+        self.addCleanup(os.remove, os.path.join(os.path.dirname(fp.name),
+                                                '_failed_' + os.path.basename(fp.name)))
+
+        bulk = bulkcheckin.BulkCheckin(doubles.NotifierStub)
+        bulk.checkin_batch([(fp.name, None, 'Invalid package')])
+
+        self.assertEqual(bulk.failed, 1)
+        self.assertFalse(os.path.exists(fp.name))
+
+    def test_packages_missing_required_meta_are_marked(self):
+        fp = tempfile.NamedTemporaryFile(suffix='.zip', delete=False)
+        self.addCleanup(os.remove, os.path.join(os.path.dirname(fp.name),
+                                                '_failed_' + os.path.basename(fp.name)))
+        analysis = checkin.AnalyzedPackage(fp.name, 'c1', {'article_title': None},
+                                           None, True, True, True)
+
+        bulk = bulkcheckin.BulkCheckin(doubles.NotifierStub)
+        bulk.checkin_batch([(fp.name, analysis, None)])
+
+        self.assertEqual(bulk.failed, 1)
+        self.assertEqual(bulk.checked_in, 0)
+
+    def _checkin_failing(self, errors, checked_in=False):
+        """
+        Checks in a package whose inserts raise `errors`, in order.
+        `checked_in` tells if its checksum is found afterwards.
+        """
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        filepath = os.path.join(tmpdir, 'c1.zip')
+        open(filepath, 'w').close()
+        analysis = checkin.AnalyzedPackage(filepath, 'c1', {}, None, True, True, True)
+
+        errors = list(errors)
+        bulk = bulkcheckin.BulkCheckin(doubles.NotifierStub)
+
+        def _insert(analyses):
+            if errors:
+                raise IntegrityError('INSERT INTO attempt (package_checksum) ...', {}, errors.pop(0))
+            return [], []
+        bulk._insert = _insert
+        bulk._is_checked_in = lambda analysis: checked_in
+
+        bulk._checkin([analysis])
+        return bulk, sorted(os.listdir(tmpdir))
+
+    def test_checksum_violations_are_duplicated(self):
+        bulk, files = self._checkin_failing([Exception(
+            'duplicate key value violates unique constraint "attempt_package_checksum_key"')],
+            checked_in=True)
+
+        self.assertEqual(bulk.duplicated, 1)
+        self.assertEqual(files, ['_duplicated_c1.zip'])
+
+    def test_not_null_violations_are_failed(self):
+        bulk, files = self._checkin_failing([Exception(
+            'null value in column "aid" violates not-null constraint')])
+
+        self.assertEqual(bulk.failed, 1)
+        self.assertEqual(bulk.duplicated, 0)
+        self.assertEqual(files, ['_failed_c1.zip'])
+
+    def test_other_violations_are_tried_again(self):
+        bulk, files = self._checkin_failing([Exception(
+            'duplicate key value violates unique constraint "articlepkg_identity_key"')])
+
+        self.assertEqual(bulk.failed, 0)
+        self.assertEqual(bulk.duplicated, 0)
+        self.assertEqual(files, ['c1.zip'])
+
+    def test_other_violations_are_failed_after_the_retry(self):
+        error = Exception('duplicate key value violates unique constraint "articlepkg_identity_key"')
+        bulk, files = self._checkin_failing([error, error])
+
+        self.assertEqual(bulk.failed, 1)
+        self.assertEqual(files, ['_failed_c1.zip'])
+
+    def test_packages_per_second(self):
+        clock = doubles.ClockStub()
+        bulk = bulkcheckin.BulkCheckin(doubles.NotifierStub, clock=clock)
+
+        bulk.run([], workers=1)
+        bulk.analyzed = 50
+        clock.now = 10
+
+        self.assertEqual(bulk.stats()['packages_per_second'], 5.0)
+
+
+@unittest.skipUnless(DB_READY, u'DB must be set. Make sure `app_balaio_tests` is properly configured.')
+class BulkCheckinDBTests(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = db_bootstrap()
+        self.session = models.Session()
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.session.close()
+        models.Base.metadata.drop_all(self.engine)
+        shutil.rmtree(self.path)
+
+    def _makeResult(self, checksum, article_title='Title'):
+        filepath = os.path.join(self.path, '%s.zip' % checksum)
+        open(filepath, 'w').close()
+        meta = {'article_title': article_title,
+                'journal_pissn': '0100-879X',
+                'journal_eissn': '1414-431X',
+                'journal_title': 'Brazilian Journal of Medical and Biological Research',
+                'issue_year': 2013,
+                'issue_volume': '46',
+                'issue_number': '1',
+                'issue_suppl_volume': None,
+                'issue_suppl_number': None}
+        analysis = checkin.AnalyzedPackage(filepath, checksum, meta, None, True, True, True)
+        return (filepath, analysis, None)
+
+    def test_attempts_are_checked_in(self):
+        results = [self._makeResult('c1'), self._makeResult('c2', 'Other')]
+
+        bulk = bulkcheckin.BulkCheckin(doubles.NotifierStub)
+        bulk.checkin_batch(results)
+
+        self.assertEqual(bulk.checked_in, 2)
+        self.assertEqual(self.session.query(models.Attempt).count(), 2)
+        self.assertEqual(self.session.query(models.ArticlePkg).count(), 2)
+
+    def test_attempts_of_the_same_article_share_the_articlepkg(self):
+        results = [self._makeResult('c1'), self._makeResult('c2')]
+
+        bulkcheckin.BulkCheckin(doubles.NotifierStub).checkin_batch(results)
+
+        self.assertEqual(self.session.query(models.ArticlePkg).count(), 1)
+
+    def test_checkins_are_notified_after_the_commit(self):
+        committed = []
+        Session = sessionmaker(bind=self.engine)
+
+        class CheckinNotifierStub(doubles.NotifierStub):
+            def __init__(self, attempt, session):
+                self.attempt = attempt
+
+            def start(self):
+                session = Session()
+                committed.append(session.query(models.Attempt).get(self.attempt.id) is not None)
+                session.close()
+
+        bulkcheckin.BulkCheckin(CheckinNotifierStub).checkin_batch(
+            [self._makeResult('c1'), self._makeResult('c2', 'Other')])
+
+        self.assertEqual(committed, [True, True])
+
+    def test_duplicated_packages(self):
+        bulkcheckin.BulkCheckin(doubles.NotifierStub).checkin_batch([self._makeResult('c1')])
+
+        bulk = bulkcheckin.BulkCheckin(doubles.NotifierStub)
+        bulk.checkin_batch([self._makeResult('c1')])
+
+        self.assertEqual(bulk.duplicated, 1)
+        self.assertEqual(self.session.query(models.Attempt).count(), 1)
+
+    def test_is_checked_in(self):
+        bulk = bulkcheckin.BulkCheckin(doubles.NotifierStub)
+        bulk.checkin_batch([self._makeResult('c1')])
+
+        self.assertTrue(bulk._is_checked_in(self._makeResult('c1')[1]))
+        self.assertFalse(bulk._is_checked_in(self._makeResult('c2')[1]))
@@ -0,0 +1,228 @@
+# coding: utf-8
+import time
+import unittest
+import datetime
+import threading
+
+from sqlalchemy.orm import sessionmaker
+
+from balaio import cache, models
+from . import doubles
+from .utils import db_bootstrap, DB_READY
+
+
+class LRUCacheTests(unittest.TestCase):
+
+    def test_get_missing_key(self):
+        lru = cache.LRUCache()
+        self.assertIsNone(lru.get('foo'))
+        self.assertEqual(lru.get('foo', 'bar'), 'bar')
+
+    def test_set_and_get(self):
+        lru = cache.LRUCache()
+        lru.set('foo', False)
+        self.assertIs(lru.get('foo'), False)
+        self.assertIn('foo', lru)
+
+    def test_least_recently_used_are_discarded(self):
+        lru = cache.LRUCache(maxsize=2)
+        lru.set('a', 1)
+        lru.set('b', 2)
+        lru.get('a')
+        lru.set('c', 3)
+
+        self.assertEqual(len(lru), 2)
+        self.assertNotIn('b', lru)
+        self.assertIn('a', lru)
+        self.assertIn('c', lru)
+
+    def test_expired_entries(self):
+        clock = doubles.ClockStub()
+        lru = cache.LRUCache(ttl=10, clock=clock)
+        lru.set('foo', 1)
+        lru.set('bar', 1, ttl=20)
+
+        clock.now = 15
+        self.assertNotIn('foo', lru)
+        self.assertIn('bar', lru)
+
+    def test_clear(self):
+        lru = cache.LRUCache()
+        lru.set('foo', 1)
+        lru.clear()
+        self.assertEqual(len(lru), 0)
+
+
+class CoalescingCacheTests(unittest.TestCase):
+
+    def test_missing_entries_are_fetched_once(self):
+        coalescing_cache = cache.CoalescingCache()
+        fetched = []
+        fetch = lambda: fetched.append(1) or 'data'
+
+        self.assertEqual(coalescing_cache.get('foo', fetch), 'data')
+        self.assertEqual(coalescing_cache.get('foo', fetch), 'data')
+        self.assertEqual(len(fetched), 1)
+
+    def test_expired_entries_are_fetched_again(self):
+        clock = doubles.ClockStub()
+        coalescing_cache = cache.CoalescingCache(ttl=10, clock=clock)
+        fetched = []
+        fetch = lambda: fetched.append(1) or 'data'
+
+        coalescing_cache.get('foo', fetch)
+        clock.now = 20
+        coalescing_cache.get('foo', fetch)
+        self.assertEqual(len(fetched), 2)
+
+    def test_errors_are_not_cached(self):
+        coalescing_cache = cache.CoalescingCache()
+
+        def fetch():
+            raise ValueError()
+
+        self.assertRaises(ValueError, lambda: coalescing_cache.get('foo', fetch))
+        self.assertEqual(coalescing_cache.get('foo', lambda: 'data'), 'data')
+
+    def test_concurrent_lookups_share_the_fetch(self):
+        coalescing_cache = cache.CoalescingCache()
+        release = threading.Event()
+        fetched = []
+        results = []
+
+        def fetch():
+            fetched.append(1)
+            release.wait(5)
+            return 'data'
+
+        threads = [threading.Thread(target=lambda: results.append(coalescing_cache.get('foo', fetch)))
+                   for i in range(4)]
+        for thread in threads:
+            thread.start()
+
+        # waits until all lookups are blocked on the fetch.
+        for i in range(500):
+            if coalescing_cache.coalesced == 3:
+                break
+            time.sleep(0.01)
+
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(fetched), 1)
+        self.assertEqual(results, ['data'] * 4)
+
+    def test_hit_ratio(self):
+        coalescing_cache = cache.CoalescingCache()
+        self.assertEqual(coalescing_cache.hit_ratio, 0.0)
+
+        for i in range(4):
+            coalescing_cache.get('foo', lambda: 'data')
+
+        self.assertEqual(coalescing_cache.hit_ratio, 0.75)
+        self.assertEqual(coalescing_cache.stats()['misses'], 1)
+
+
+class ResolverStub(object):
+    def __init__(self, result=200):
+        self.result = result
+        self.calls = []
+
+    def __call__(self, doi):
+        self.calls.append(doi)
+        if isinstance(self.result, Exception):
+            raise self.result
+        return self.result
+
+
+class DOIValidatorTests(unittest.TestCase):
+
+    def test_resolver_is_called_once(self):
+        resolver = ResolverStub()
+        validator = cache.DOIValidator(resolver=resolver)
+
+        self.assertTrue(validator('10.1590/S0100-879X2006000400004'))
+        self.assertTrue(validator('10.1590/S0100-879X2006000400004'))
+        self.assertEqual(len(resolver.calls), 1)
+
+    def test_dois_are_case_insensitive(self):
+        resolver = ResolverStub()
+        validator = cache.DOIValidator(resolver=resolver)
+
+        validator('10.1590/S0100-879X2006000400004')
+        validator('10.1590/s0100-879x2006000400004 ')
+        self.assertEqual(len(resolver.calls), 1)
+
+    def test_negative_results_are_cached(self):
+        resolver = ResolverStub(result=404)
+        validator = cache.DOIValidator(resolver=resolver)
+
+        self.assertFalse(validator('10.1590/foo'))
+        self.assertFalse(validator('10.1590/foo'))
+        self.assertEqual(len(resolver.calls), 1)
+
+    def test_server_errors_are_not_cached(self):
+        for status in [500, 503, 429]:
+            resolver = ResolverStub(result=status)
+            validator = cache.DOIValidator(resolver=resolver)
+
+            self.assertFalse(validator('10.1590/foo'))
+            resolver.result = 200
+            self.assertTrue(validator('10.1590/foo'))
+            self.assertEqual(len(resolver.calls), 2)
+
+    def test_negative_results_expire_first(self):
+        clock = doubles.ClockStub()
+        resolver = ResolverStub(result=404)
+        validator = cache.DOIValidator(resolver=resolver, positive_ttl=100,
+            negative_ttl=10, lru=cache.LRUCache(clock=clock))
+
+        validator('10.1590/foo')
+        clock.now = 50
+        resolver.result = 200
+        validator('10.1590/foo')
+        validator('10.1590/foo')
+
+        self.assertEqual(len(resolver.calls), 2)
+
+    def test_errors_are_not_cached(self):
+        resolver = ResolverStub(result=ValueError())
+        validator = cache.DOIValidator(resolver=resolver)
+
+        self.assertRaises(ValueError, lambda: validator('10.1590/foo'))
+        resolver.result = 200
+        self.assertTrue(validator('10.1590/foo'))
+
+
+@unittest.skipUnless(DB_READY, u'DB must be set. Make sure `app_balaio_tests` is properly configured.')
+class DOIValidatorDBTests(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = db_bootstrap()
+        self.Session = sessionmaker(bind=self.engine, expire_on_commit=False)
+
+    def test_results_are_shared_through_the_db(self):
+        resolver = ResolverStub()
+        cache.DOIValidator(Session=self.Session, resolver=resolver)('10.1590/foo')
+        cache.DOIValidator(Session=self.Session, resolver=resolver)('10.1590/foo')
+
+        self.assertEqual(len(resolver.calls), 1)
+
+    def test_expired_results_are_ignored(self):
+        session = self.Session()
+        resolution = models.DOIResolution(doi='10.1590/foo', is_valid=False)
+        resolution.checked_at = datetime.datetime.now() - datetime.timedelta(days=2)
+        session.add(resolution)
+        session.commit()
+        session.close()
+
+        resolver = ResolverStub()
+        validator = cache.DOIValidator(Session=self.Session, resolver=resolver,
+            negative_ttl=24*60*60)
+
+        self.assertTrue(validator('10.1590/foo'))
+        self.assertEqual(len(resolver.calls), 1)
+        session = self.Session()
+        self.assertTrue(session.query(models.DOIResolution).get('10.1590/foo').is_valid)
+        session.close()
@@ -63,6 +63,13 @@ class PackageAnalyzerTests(mocker.MockerTestCase):
             for forbidden_val in ['3', '6', '7']:
                 self.assertNotEqual(in_context_perm[1], forbidden_val)
 
+    def test_xml_is_parsed_once(self):
+        data = [('bar.xml', b'<root><name>bar</name></root>')]
+        arch = self._make_test_archive(data)
+        pkg = self._makeOne(arch.name)
+
+        self.assertIs(pkg.xml, pkg.xml)
+
     def test_is_valid_schema_with_valid_xml(self):
         data = [('bar.xml', b'''<?xml version="1.0" encoding="utf-8"?>
                 <article article-type="in-brief" dtd-version="1.0" xml:lang="en" xmlns:xlink="http://www.w3.org/1999/xlink" xmlns:mml="http://www.w3.org/1998/Math/MathML">
@@ -225,6 +232,132 @@ class PackageAnalyzerTests(mocker.MockerTestCase):
         self.assertFalse(pkg.is_valid_schema())
 
 
+class AnalyzedPackageTests(unittest.TestCase):
+
+    def _makeOne(self, filename='/tmp/bla.zip', xml_bytes=b'<root><name>bar</name></root>'):
+        return checkin.AnalyzedPackage(filename,
+                                       checksum='5a74db5db860f2f8e3c6a5c64acdbf04',
+                                       meta={'article_title': 'foo'},
+                                       xml_bytes=xml_bytes,
+                                       is_valid_package=True,
+                                       is_valid_meta=True,
+                                       is_valid_schema=False)
+
+    def test_xml_is_parsed_once(self):
+        analyzed = self._makeOne()
+
+        self.assertEqual(analyzed.xml.findtext('name'), 'bar')
+        self.assertIs(analyzed.xml, analyzed.xml)
+
+    def test_missing_xml_raises_AttributeError(self):
+        analyzed = self._makeOne(xml_bytes=None)
+
+        self.assertRaises(AttributeError, lambda: analyzed.xml)
+
+    def test_validations(self):
+        analyzed = self._makeOne()
+
+        self.assertTrue(analyzed.is_valid_package())
+        self.assertTrue(analyzed.is_valid_meta())
+        self.assertFalse(analyzed.is_valid_schema())
+
+    def test_meta_cannot_be_changed(self):
+        analyzed = self._makeOne()
+        analyzed.meta['article_title'] = 'bar'
+
+        self.assertEqual(analyzed.meta, {'article_title': 'foo'})
+
+    def test_can_be_pickled(self):
+        import pickle
+        analyzed = self._makeOne()
+        analyzed.xml
+
+        unpickled = pickle.loads(pickle.dumps(analyzed))
+        self.assertEqual(unpickled.checksum, analyzed.checksum)
+        self.assertEqual(unpickled.xml.findtext('name'), 'bar')
+
+    def test_package_is_locked_and_restored(self):
+        import os, stat
+        fp = NamedTemporaryFile()
+        os.chmod(fp.name, 0644)
+        analyzed = self._makeOne(filename=fp.name)
+
+        analyzed.lock_package()
+        self.assertFalse(stat.S_IMODE(os.stat(fp.name).st_mode) & stat.S_IWUSR)
+
+        analyzed.restore_perms()
+        self.assertEqual(stat.S_IMODE(os.stat(fp.name).st_mode), 0644)
+
+    def test_restore_perms_without_lock(self):
+        analyzed = self._makeOne(filename='/tmp/missing/bla.zip')
+        analyzed.restore_perms()
+
+
+class SchemaRegistryTests(unittest.TestCase):
+
+    def _make_xsd(self):
+        fp = NamedTemporaryFile(suffix='.xsd')
+        fp.write(b'''<xs:schema xmlns:xs="http://www.w3.org/2001/XMLSchema">
+                      <xs:element name="root" type="xs:string"/>
+                    </xs:schema>''')
+        fp.flush()
+        return fp
+
+    def test_schemas_are_compiled_once(self):
+        xsd = self._make_xsd()
+        registry = checkin.SchemaRegistry()
+
+        self.assertIs(registry.get(xsd.name), registry.get(xsd.name))
+
+    def test_validate(self):
+        xsd = self._make_xsd()
+        registry = checkin.SchemaRegistry()
+
+        self.assertTrue(registry.validate(xsd.name, etree.fromstring('<root>foo</root>').getroottree()))
+        self.assertFalse(registry.validate(xsd.name, etree.fromstring('<foo/>').getroottree()))
+
+    def test_preload(self):
+        xsd = self._make_xsd()
+        registry = checkin.SchemaRegistry()
+        registry.preload(xsd.name)
+
+        self.assertIn(xsd.name, registry._schemas)
+
+    def test_concurrent_validations(self):
+        import threading
+        xsd = self._make_xsd()
+        registry = checkin.SchemaRegistry()
+        results = []
+
+        def validate(i):
+            xml = '<root>foo</root>' if i % 2 else '<foo/>'
+            for j in range(50):
+                results.append((i % 2 == 1) == registry.validate(xsd.name, etree.fromstring(xml).getroottree()))
+
+        threads = [threading.Thread(target=validate, args=(i,)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertTrue(all(results))
+        self.assertEqual(len(results), 200)
+
+    def test_schemas_are_compiled_once_per_thread(self):
+        import threading
+        xsd = self._make_xsd()
+        registry = checkin.SchemaRegistry()
+        registry.preload(xsd.name)
+        schemas = []
+
+        thread = threading.Thread(target=lambda: schemas.append(registry.get(xsd.name)))
+        thread.start()
+        thread.join()
+
+        self.assertIsNot(schemas[0], registry.get(xsd.name))
+        self.assertIs(registry.get(xsd.name), registry.get(xsd.name))
+
+
 @unittest.skipUnless(DB_READY, u'DB must be set. Make sure `app_balaio_tests` is properly configured.')
 class CheckinTests(unittest.TestCase):
 
@@ -297,6 +430,14 @@ class CheckinTests(unittest.TestCase):
         pkg = self._make_test_archive([('texto.xml', b'<root/>')])
         self.assertRaises(ValueError, lambda: checkin.get_attempt(pkg.name))
 
+    def test_get_attempt_missing_fields_are_reported(self):
+        """
+        The missing fields reach the caller
+        """
+        pkg = self._make_test_archive([('texto.xml', b'<root/>')])
+        with self.assertRaisesRegexp(ValueError, 'is missing'):
+            checkin.get_attempt(pkg.name)
+
     def test_get_attempt_inexisting_package(self):
         """
         The package is missing
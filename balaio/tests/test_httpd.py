@@ -10,7 +10,7 @@ sys.path.insert(0, os.path.join(os.path.abspath(os.path.dirname(__file__)), '..'
 from pyramid import testing
 from pyramid.httpexceptions import HTTPNotFound,HTTPAccepted, HTTPCreated
 from sqlalchemy.exc import OperationalError
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, text
 from webtest import TestApp
 import transaction
 
@@ -994,6 +994,91 @@ class PackageFunctionalAPITest(unittest.TestCase):
         self.assertEqual(json.loads(res.body), json.loads(expected))
 
 
+class KeysetConfigStub(ConfigStub):
+    def items(self):
+        return [('http_server', {'after_id_total_count': 'estimated'})]
+
+
+@unittest.skipUnless(DB_READY, u'DB must be set. Make sure `app_balaio_tests` is properly configured.')
+class QueryCountFunctionalAPITest(unittest.TestCase):
+    """
+    The number of queries must not grow with the number of serialized objects.
+    """
+    statements = []
+
+    def setUp(self):
+        cls = self.__class__
+        if not getattr(cls, '_listening', False):
+            # listeners cannot be removed from engines.
+            event.listen(global_engine, 'before_cursor_execute',
+                lambda conn, cursor, statement, *args: cls.statements.append(statement))
+            cls._listening = True
+
+        for i in range(5):
+            attempt = modelfactories.AttemptFactory.create()
+            for point in (models.Point.checkin, models.Point.validation):
+                checkpoint = modelfactories.CheckpointFactory.create(attempt=attempt, point=point)
+                checkpoint.start()
+                checkpoint.tell('foo', models.Status.ok)
+                checkpoint.tell('bar', models.Status.ok)
+
+            ticket = modelfactories.TicketFactory.create(articlepkg=attempt.articlepkg)
+            ticket.comments.append(models.Comment(author='foo', message='bar'))
+
+        self.attempt_id = attempt.id
+        self.articlepkg_id = attempt.articlepkg.id
+        self.ticket_id = ticket.id
+
+        # the views must load everything from the db.
+        models.ScopedSession.flush()
+        models.ScopedSession.expunge_all()
+
+        self.config = testing.setUp()
+        app = httpd.main(KeysetConfigStub(), global_engine)
+        self.testapp = TestApp(app)
+        # the health status is checked on the first request.
+        self.testapp.get('/', status=200)
+
+    def tearDown(self):
+        transaction.abort()
+        models.ScopedSession.remove()
+        testing.tearDown()
+
+    def assertQueryCount(self, url, expected):
+        del self.statements[:]
+        self.testapp.get(url, status=200)
+        models.ScopedSession.expunge_all()
+        self.assertEqual(len(self.statements), expected)
+
+    def test_attempts(self):
+        # objects, checkpoints, notices and total.
+        self.assertQueryCount('/api/v1/attempts/', 4)
+
+    def test_attempts_after_id(self):
+        # the total is estimated from the statistics of the table, which
+        # count the rows inserted by the transaction of the test.
+        models.ScopedSession.execute(text('ANALYZE attempt'))
+        self.assertQueryCount('/api/v1/attempts/?after_id=0', 4)
+        self.assertFalse([statement for statement in self.statements if 'count(' in statement])
+
+    def test_attempt(self):
+        self.assertQueryCount('/api/v1/attempts/%s/' % self.attempt_id, 3)
+
+    def test_packages(self):
+        # objects, attempts, tickets and total.
+        self.assertQueryCount('/api/v1/packages/', 4)
+
+    def test_package(self):
+        self.assertQueryCount('/api/v1/packages/%s/' % self.articlepkg_id, 3)
+
+    def test_tickets(self):
+        # objects, comments and total.
+        self.assertQueryCount('/api/v1/tickets/', 3)
+
+    def test_ticket(self):
+        self.assertQueryCount('/api/v1/tickets/%s/' % self.ticket_id, 2)
+
+
 class AttemptsAPITest(unittest.TestCase):
 
     def setUp(self):
@@ -1003,6 +1088,11 @@ class AttemptsAPITest(unittest.TestCase):
         self.req.db.query = QueryStub
         self.req.db.query.model = AttemptStub
 
+        bind = ObjectStub()
+        bind.dialect = ObjectStub()
+        bind.dialect.name = 'sqlite'
+        self.req.db.get_bind = lambda: bind
+
     def test_view_attempts(self):
         expected = {'limit': 20,
                     'offset': 0,
@@ -1031,6 +1121,76 @@ class AttemptsAPITest(unittest.TestCase):
             httpd.attempts(self.req),
             expected)
 
+    def test_view_attempts_after_id(self):
+        expected = {'limit': 2,
+                    'after_id': 0,
+                    'next_after_id': 1,
+                    'filters': {'articlepkg_id': 1},
+                    'total': 200,
+                    'objects': [AttemptStub().to_dict(), AttemptStub().to_dict()]}
+
+        self.req.params = {'limit': '2', 'after_id': '0', 'articlepkg_id': 1}
+        self.req.db.query.found = True
+
+        self.assertEqual(
+            httpd.attempts(self.req),
+            expected)
+
+    def test_view_attempts_after_id_last_page(self):
+        self.req.params = {'limit': '2', 'after_id': '1'}
+        self.req.db.query.found = False
+
+        result = httpd.attempts(self.req)
+        self.assertEqual(result['objects'], [])
+        self.assertIsNone(result['next_after_id'])
+
+    def test_view_attempts_after_id_estimated_total(self):
+        result = ObjectStub()
+        result.scalar = lambda: 1000
+        self.req.db.get_bind().dialect.name = 'postgresql'
+        self.req.db.execute = lambda statement, params: result
+        self.req.registry.settings['http_server']['after_id_total_count'] = 'estimated'
+        self.req.params = {'limit': '2', 'after_id': '1'}
+        self.req.db.query.found = False
+
+        self.assertEqual(httpd.attempts(self.req)['total'], 1000)
+
+    def test_view_attempts_after_id_honors_total_count(self):
+        self.req.db.get_bind().dialect.name = 'postgresql'
+        self.req.db.execute = lambda statement, params: self.fail('the total must be exact')
+        self.req.params = {'limit': '2', 'after_id': '1'}
+        self.req.db.query.found = False
+
+        self.assertEqual(httpd.attempts(self.req)['total'], 200)
+
+    def test_view_attempts_empty_estimate_is_not_trusted(self):
+        result = ObjectStub()
+        result.scalar = lambda: 0
+        self.req.db.get_bind().dialect.name = 'postgresql'
+        self.req.db.execute = lambda statement, params: result
+        self.req.registry.settings['http_server']['total_count'] = 'estimated'
+        self.req.params = {'limit': '2', 'offset': '0'}
+        self.req.db.query.found = False
+
+        self.assertEqual(httpd.attempts(self.req)['total'], 200)
+
+    def test_view_attempts_invalid_after_id(self):
+        from pyramid.httpexceptions import HTTPBadRequest
+        self.req.params = {'after_id': 'foo'}
+
+        self.assertRaises(HTTPBadRequest, lambda: httpd.attempts(self.req))
+
+    def test_view_attempts_cached_total(self):
+        from balaio import cache
+        self.req.registry.settings['http_server']['total_count'] = 'cached'
+        self.req.registry.total_counts = cache.CoalescingCache()
+        self.req.params = {'limit': 20, 'offset': 0}
+        self.req.db.query.found = True
+
+        for i in range(2):
+            self.assertEqual(httpd.attempts(self.req)['total'], 200)
+        self.assertEqual(self.req.registry.total_counts.hits, 1)
+
     def test_view_attempt(self):
         expected = AttemptStub().to_dict()
 
@@ -1,9 +1,11 @@
 import unittest
+import contextlib
 from datetime import datetime
 
 import mocker
 import enum
 
+from balaio import models
 from balaio.models import (
     Point,
     Checkpoint,
@@ -179,7 +181,7 @@ class ArticlePkgTests(mocker.MockerTestCase):
         mock_session.query(ArticlePkg)
         self.mocker.result(mock_session)
 
-        mock_session.filter_by(article_title='foo')
+        mock_session.filter_by(identity=ArticlePkg.make_identity(pkg_analyzer.meta))
         self.mocker.result(mock_session)
 
         mock_session.one()
@@ -191,3 +193,167 @@ class ArticlePkgTests(mocker.MockerTestCase):
 
         self.assertIsInstance(article_pkg, ArticlePkg)
 
+    def test_get_or_create_from_package_creates_with_identity(self):
+        from sqlalchemy.orm.exc import NoResultFound
+        mock_session = self.mocker.mock()
+
+        pkg_analyzer = doubles.PackageAnalyzerStub()
+
+        mock_session.query(ArticlePkg)
+        self.mocker.result(mock_session)
+
+        mock_session.filter_by(identity=mocker.ANY)
+        self.mocker.result(mock_session)
+
+        mock_session.one()
+        self.mocker.throw(NoResultFound)
+
+        mock_savepoint = self.mocker.mock()
+        mock_session.begin_nested()
+        self.mocker.result(mock_savepoint)
+
+        mock_session.add(mocker.ANY)
+        mock_savepoint.commit()
+
+        self.mocker.replay()
+
+        article_pkg = ArticlePkg.get_or_create_from_package(pkg_analyzer, mock_session)
+
+        self.assertEqual(article_pkg.article_title, 'foo')
+        self.assertEqual(article_pkg.identity, ArticlePkg.make_identity(pkg_analyzer.meta))
+
+    def test_get_or_create_from_package_created_concurrently(self):
+        from sqlalchemy.exc import IntegrityError
+        from sqlalchemy.orm.exc import NoResultFound
+        mock_session = self.mocker.mock()
+        existing = ArticlePkg()
+
+        pkg_analyzer = doubles.PackageAnalyzerStub()
+
+        mock_session.query(ArticlePkg)
+        self.mocker.result(mock_session)
+        self.mocker.count(2)
+
+        mock_session.filter_by(identity=ArticlePkg.make_identity(pkg_analyzer.meta))
+        self.mocker.result(mock_session)
+        self.mocker.count(2)
+
+        mock_session.one()
+        self.mocker.throw(NoResultFound)
+
+        mock_savepoint = self.mocker.mock()
+        mock_session.begin_nested()
+        self.mocker.result(mock_savepoint)
+
+        mock_session.add(mocker.ANY)
+        mock_savepoint.commit()
+        self.mocker.throw(IntegrityError('INSERT', {}, Exception('duplicate key')))
+        mock_savepoint.rollback()
+
+        mock_session.first()
+        self.mocker.result(existing)
+
+        self.mocker.replay()
+
+        article_pkg = ArticlePkg.get_or_create_from_package(pkg_analyzer, mock_session)
+
+        self.assertIs(article_pkg, existing)
+
+    def test_identity_is_normalized(self):
+        meta = {'article_title': 'Foo  bar ', 'journal_pissn': '1234-4321', 'issue_year': 2013}
+
+        self.assertEqual(ArticlePkg.make_identity(meta),
+                         ArticlePkg.make_identity(dict(meta, article_title='FOO BAR', issue_year='2013')))
+
+    def test_identity_of_byte_strings(self):
+        meta = {'article_title': u'Caf\xe9 no Brasil', 'journal_pissn': '1234-4321'}
+
+        self.assertEqual(ArticlePkg.make_identity(meta),
+                         ArticlePkg.make_identity(dict(meta, article_title=u'CAF\xc9 NO BRASIL'.encode('utf-8'))))
+
+    def test_identity_depends_on_issue(self):
+        meta = {'article_title': 'Foo', 'journal_pissn': '1234-4321', 'issue_number': '1'}
+
+        self.assertNotEqual(ArticlePkg.make_identity(meta),
+                            ArticlePkg.make_identity(dict(meta, issue_number='2')))
+
+    def test_missing_fields(self):
+        meta = {'article_title': 'Foo', 'journal_title': None, 'issue_number': '1'}
+
+        self.assertEqual(ArticlePkg.missing_fields(meta), ['journal_title', 'issue_year'])
+
+
+class AidSessionStub(object):
+    """
+    Session with an aid sequence, and `in_use` aids.
+    """
+    def __init__(self, supports_sequences=True, in_use=()):
+        self.dialect = doubles.ObjectStub()
+        self.dialect.supports_sequences = supports_sequences
+        self.in_use = set(in_use)
+        self.sequence_calls = 0
+        self.queries = 0
+
+    def get_bind(self, mapper=None):
+        return self
+
+    def execute(self, statement):
+        self.sequence_calls += 1
+        result = doubles.ObjectStub()
+        result.scalar = lambda: self.sequence_calls
+        return result
+
+    @property
+    @contextlib.contextmanager
+    def no_autoflush(self):
+        yield self
+
+    def query(self, column):
+        return self
+
+    def filter(self, criterion):
+        self.queries += 1
+        candidates = set(bindparam.value for bindparam in criterion.right.clauses)
+        return [(aid,) for aid in candidates & self.in_use]
+
+
+class AidAllocatorTests(unittest.TestCase):
+
+    def test_aids_are_unique(self):
+        allocator = models.AidAllocator(block_size=10)
+        session = AidSessionStub()
+        aids = allocator.allocate(session, 25) + allocator.allocate(session, 25)
+
+        self.assertEqual(len(set(aids)), 50)
+        self.assertTrue(all(len(aid) == 10 for aid in aids))
+
+    def test_one_sequence_call_per_block(self):
+        allocator = models.AidAllocator(block_size=10)
+        session = AidSessionStub()
+        allocator.allocate(session, 25)
+
+        self.assertEqual(session.sequence_calls, 3)
+
+    def test_one_query_per_allocation(self):
+        allocator = models.AidAllocator(block_size=10)
+        session = AidSessionStub()
+        allocator.allocate(session, 25)
+
+        self.assertEqual(session.queries, 1)
+
+    def test_aids_in_use_are_skipped(self):
+        allocator = models.AidAllocator(block_size=10)
+        in_use = models.AidAllocator(block_size=10).allocate(AidSessionStub(), 2)
+        session = AidSessionStub(in_use=in_use)
+
+        aids = allocator.allocate(session, 5)
+        self.assertEqual(len(aids), 5)
+        self.assertFalse(set(aids) & set(in_use))
+
+    def test_random_aids_without_sequences(self):
+        allocator = models.AidAllocator()
+        session = AidSessionStub(supports_sequences=False)
+        aids = allocator.allocate(session, 5)
+
+        self.assertEqual(len(set(aids)), 5)
+        self.assertEqual(session.sequence_calls, 0)
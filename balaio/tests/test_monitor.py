@@ -0,0 +1,397 @@
+import os
+import shutil
+import datetime
+import tempfile
+import unittest
+
+import mocker
+import transaction
+
+from balaio import monitor, models
+from . import doubles
+from .utils import db_bootstrap, DB_READY
+
+
+class MonitorTests(mocker.MockerTestCase):
+
+    def _makeOne(self, pool=None, priority='fifo', priority_journals=(), queue_size=10):
+        # bypasses __init__ to avoid the socket and workers setup.
+        mon = monitor.Monitor.__new__(monitor.Monitor)
+        mon.pool = pool
+        mon.priority = priority
+        mon.priority_journals = priority_journals
+        mon.job_queue = monitor.Queue.PriorityQueue(maxsize=queue_size)
+        mon._sequence = monitor.itertools.count()
+        mon._stats_lock = monitor.threading.Lock()
+        mon.started_at = monitor.time.time()
+        mon.total_workers = 1
+        mon.processed = mon.busy_workers = 0
+        mon.busy_time = mon.total_wait = mon.max_wait = 0.0
+        return mon
+
+    def _make_file(self, size, mtime):
+        fp = tempfile.NamedTemporaryFile(suffix='.zip')
+        fp.write(b'x' * size)
+        fp.flush()
+        os.utime(fp.name, (mtime, mtime))
+        return fp
+
+    def _dequeue_all(self, mon):
+        filepaths = []
+        while not mon.job_queue.empty():
+            filepaths.append(mon.job_queue.get_nowait()[-1])
+        return filepaths
+
+    def test_unknown_mode_raises_ValueError(self):
+        self.assertRaises(ValueError,
+            lambda: monitor.Monitor(doubles.ConfigStub(), workers=1, mode='foo'))
+
+    def test_get_attempt_on_threads_mode(self):
+        mock_checkin = self.mocker.replace('balaio.checkin.get_attempt')
+        mock_checkin('/tmp/foo.zip')
+        self.mocker.result('attempt')
+        self.mocker.replay()
+
+        self.assertEqual(self._makeOne().get_attempt('/tmp/foo.zip'), 'attempt')
+
+    def test_get_attempt_on_processes_mode(self):
+        mock_pool = self.mocker.mock()
+        mock_pool.apply(monitor.checkin.get_attempt, ('/tmp/foo.zip',))
+        self.mocker.result('attempt')
+        self.mocker.replay()
+
+        mon = self._makeOne(pool=mock_pool)
+        self.assertEqual(mon.get_attempt('/tmp/foo.zip'), 'attempt')
+
+    def test_fifo_priority(self):
+        mon = self._makeOne()
+        for filepath in ['/tmp/b.zip', '/tmp/a.zip', '/tmp/c.zip']:
+            mon.trigger_event(filepath)
+
+        self.assertEqual(self._dequeue_all(mon), ['/tmp/b.zip', '/tmp/a.zip', '/tmp/c.zip'])
+
+    def test_size_priority(self):
+        mon = self._makeOne(priority='size')
+        big, small = self._make_file(20, 100), self._make_file(10, 200)
+        mon.trigger_event(big.name)
+        mon.trigger_event(small.name)
+
+        self.assertEqual(self._dequeue_all(mon), [small.name, big.name])
+
+    def test_age_priority(self):
+        mon = self._makeOne(priority='age')
+        new, old = self._make_file(10, 200), self._make_file(10, 100)
+        mon.trigger_event(new.name)
+        mon.trigger_event(old.name)
+
+        self.assertEqual(self._dequeue_all(mon), [old.name, new.name])
+
+    def test_priority_journals_come_first(self):
+        mon = self._makeOne(priority_journals=('0042-9686',))
+        mon.trigger_event('/tmp/0100-879X-bjmbr-1.zip')
+        mon.trigger_event('/tmp/0042-9686-bwho-91-08-545.zip')
+
+        self.assertEqual(self._dequeue_all(mon),
+            ['/tmp/0042-9686-bwho-91-08-545.zip', '/tmp/0100-879X-bjmbr-1.zip'])
+
+    def test_trigger_event_blocks_while_the_queue_is_full(self):
+        import threading
+        mon = self._makeOne(queue_size=1)
+        mon.trigger_event('/tmp/a.zip')
+
+        producer = threading.Thread(target=mon.trigger_event, args=('/tmp/b.zip',))
+        producer.start()
+        producer.join(0.1)
+        self.assertTrue(producer.is_alive())
+
+        mon.job_queue.get()
+        producer.join(5)
+        self.assertFalse(producer.is_alive())
+        self.assertEqual(self._dequeue_all(mon), ['/tmp/b.zip'])
+
+    def _stop_when_empty(self, mon, job_queue):
+        # handle_events runs forever, so the queue is stopped by an error.
+        def get():
+            if job_queue.empty():
+                raise StopIteration()
+            return job_queue.get()
+        mon.job_queue.get = get
+
+    def test_worker_threads_compile_the_schema_on_start_up(self):
+        mock_registry = self.mocker.replace('balaio.checkin.schema_registry')
+        mock_registry.preload(monitor.checkin.SPS_XSD)
+        self.mocker.replay()
+
+        mon = self._makeOne()
+        self._stop_when_empty(mon, monitor.Queue.Queue())
+
+        self.assertRaises(StopIteration, lambda: mon.handle_events(mon.job_queue))
+
+    def test_worker_threads_leave_the_schema_to_the_pool(self):
+        mon = self._makeOne(pool=self.mocker.mock())
+        self.mocker.replay()
+        self._stop_when_empty(mon, monitor.Queue.Queue())
+
+        self.assertRaises(StopIteration, lambda: mon.handle_events(mon.job_queue))
+
+    def test_stats(self):
+        mon = self._makeOne()
+        mon.handle_event = lambda filepath: None
+        mon.trigger_event('/tmp/a.zip')
+        mon.trigger_event('/tmp/b.zip')
+
+        job_queue = monitor.Queue.Queue()
+        for i in range(2):
+            job_queue.put(mon.job_queue.get())
+        self._stop_when_empty(mon, job_queue)
+
+        self.assertRaises(StopIteration, lambda: mon.handle_events(mon.job_queue))
+
+        stats = mon.stats()
+        self.assertEqual(stats['processed'], 2)
+        self.assertEqual(stats['queue_depth'], 0)
+        self.assertEqual(stats['busy_workers'], 0)
+        self.assertTrue(stats['max_wait'] >= stats['avg_wait'] >= 0)
+        self.assertTrue(0 <= stats['utilization'] <= 1)
+
+
+class EventCoalescerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dispatched = []
+        self.clock = doubles.ClockStub()
+
+    def _makeOne(self, **kwargs):
+        return monitor.EventCoalescer(self.dispatched.append, window=1,
+                                      clock=self.clock, **kwargs)
+
+    def _make_package(self):
+        import zipfile
+        from tempfile import NamedTemporaryFile
+        fp = NamedTemporaryFile(suffix='.zip')
+        with zipfile.ZipFile(fp, 'w') as zipfp:
+            zipfp.writestr('bar.xml', b'<root/>')
+        fp.flush()
+        return fp
+
+    def test_events_are_dispatched_after_the_window(self):
+        pkg = self._make_package()
+        coalescer = self._makeOne()
+        coalescer.add(pkg.name, 0)
+
+        coalescer.flush()
+        self.assertEqual(self.dispatched, [])
+
+        self.clock.now = 1
+        coalescer.flush()
+        self.assertEqual(self.dispatched, [pkg.name])
+
+    def test_events_of_the_same_path_are_coalesced(self):
+        pkg = self._make_package()
+        coalescer = self._makeOne()
+        coalescer.add(pkg.name, 0)
+        coalescer.add(pkg.name, 0.5)
+
+        self.clock.now = 1
+        coalescer.flush()
+        self.assertEqual(self.dispatched, [])
+
+        self.clock.now = 1.5
+        coalescer.flush()
+        self.assertEqual(self.dispatched, [pkg.name])
+        self.assertEqual(coalescer.coalesced, 1)
+
+    def test_files_are_dispatched_once(self):
+        pkg = self._make_package()
+        coalescer = self._makeOne()
+        coalescer.add(pkg.name, 0)
+        self.clock.now = 1
+        coalescer.flush()
+
+        coalescer.add(pkg.name, 1)
+        self.clock.now = 2
+        coalescer.flush()
+
+        self.assertEqual(self.dispatched, [pkg.name])
+        self.assertEqual(coalescer.ignored, 1)
+
+    def test_links_to_dispatched_files_are_ignored(self):
+        import os
+        pkg = self._make_package()
+        link = pkg.name + '.link.zip'
+        os.link(pkg.name, link)
+        self.addCleanup(os.remove, link)
+
+        coalescer = self._makeOne()
+        coalescer.add(pkg.name, 0)
+        coalescer.add(link, 0)
+        self.clock.now = 1
+        coalescer.flush()
+
+        self.assertEqual(self.dispatched, [pkg.name])
+
+    def test_invalid_zipfiles_are_ignored(self):
+        from tempfile import NamedTemporaryFile
+        fp = NamedTemporaryFile(suffix='.zip')
+        fp.write(b'foo')
+        fp.flush()
+
+        coalescer = self._makeOne()
+        coalescer.add(fp.name, 0)
+        self.clock.now = 1
+        coalescer.flush()
+
+        self.assertEqual(self.dispatched, [])
+
+    def test_missing_files_are_ignored(self):
+        coalescer = self._makeOne()
+        coalescer.add('/tmp/missing/bla.zip', 0)
+        self.clock.now = 1
+        coalescer.flush()
+
+        self.assertEqual(self.dispatched, [])
+        self.assertEqual(coalescer.stats()['ignored'], 1)
+
+    def test_events_are_dropped_while_the_queue_is_full(self):
+        import threading
+        overflowed = threading.Event()
+        coalescer = monitor.EventCoalescer(self.dispatched.append, maxsize=1,
+                                           on_overflow=overflowed.set)
+        coalescer.push('/tmp/a.zip')
+        coalescer.push('/tmp/b.zip')
+
+        self.assertEqual(coalescer.stats()['dropped'], 1)
+
+        coalescer.start()
+        overflowed.wait(5)
+        coalescer.stop()
+        self.assertTrue(overflowed.is_set())
+
+    def test_background_thread(self):
+        import threading
+        pkg = self._make_package()
+        dispatched = threading.Event()
+        coalescer = monitor.EventCoalescer(lambda filepath: dispatched.set(), window=0.01)
+        coalescer.start()
+
+        coalescer.push(pkg.name)
+        dispatched.wait(5)
+        coalescer.stop()
+
+        self.assertTrue(dispatched.is_set())
+
+
+class EventHandlerTests(unittest.TestCase):
+
+    def _makeOne(self):
+        # bypasses __init__ to avoid the monitor setup.
+        handler = monitor.EventHandler.__new__(monitor.EventHandler)
+        handler.coalescer = monitor.EventCoalescer(lambda filepath: None)
+        return handler
+
+    def _makeEvent(self, pathname):
+        event = type('EventStub', (object,), {})()
+        event.pathname = pathname
+        return event
+
+    def test_events_are_queued_without_touching_the_file(self):
+        handler = self._makeOne()
+        handler._do_the_job(self._makeEvent('/tmp/missing/bla.zip'))
+
+        self.assertEqual(handler.coalescer._queue.qsize(), 1)
+
+    def test_special_packages_are_ignored(self):
+        handler = self._makeOne()
+        handler._do_the_job(self._makeEvent('/tmp/missing/_failed_bla.zip'))
+
+        self.assertEqual(handler.coalescer._queue.qsize(), 0)
+
+
+class WalkPackagesTests(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+
+        os.mkdir(os.path.join(self.path, 'sub'))
+        for filename in ['a.zip', '_failed_b.zip', '_duplicated_c.zip', 'sub/d.zip']:
+            open(os.path.join(self.path, filename), 'w').close()
+
+    def test_special_packages_are_skipped(self):
+        self.assertEqual(list(monitor.walk_packages([self.path])),
+            [os.path.join(self.path, 'a.zip'), os.path.join(self.path, 'sub', 'd.zip')])
+
+    def test_not_recursive(self):
+        self.assertEqual(list(monitor.walk_packages([self.path], recursive=False)),
+            [os.path.join(self.path, 'a.zip')])
+
+    def test_without_scandir(self):
+        with doubles.Patch(monitor, 'scandir', None):
+            self.assertEqual(len(list(monitor.walk_packages([self.path]))), 2)
+
+    def test_missing_directories_are_skipped(self):
+        self.assertEqual(list(monitor.walk_packages(['/tmp/missing/dir'])), [])
+
+
+class FeedBacklogTests(unittest.TestCase):
+
+    def test_packages_are_dispatched_at_the_rate(self):
+        clock = doubles.ClockStub()
+        sleeps = []
+
+        def sleep(seconds):
+            sleeps.append(seconds)
+            clock.now += seconds
+
+        dispatched = []
+        total = monitor.feed_backlog(['a.zip', 'b.zip', 'c.zip'], dispatched.append,
+                                     rate=2, clock=clock, sleep=sleep)
+
+        self.assertEqual(total, 3)
+        self.assertEqual(dispatched, ['a.zip', 'b.zip', 'c.zip'])
+        self.assertEqual(sleeps, [0.5, 0.5])
+
+    def test_unlimited_rate(self):
+        sleeps = []
+        monitor.feed_backlog(['a.zip', 'b.zip'], lambda filepath: None,
+                             rate=0, clock=doubles.ClockStub(), sleep=sleeps.append)
+
+        self.assertEqual(sleeps, [])
+
+
+@unittest.skipUnless(DB_READY, u'DB must be set. Make sure `app_balaio_tests` is properly configured.')
+class FindBacklogTests(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = db_bootstrap()
+
+        session = models.Session()
+        session.add(models.Attempt(package_checksum='known', started_at=datetime.datetime.now()))
+        transaction.commit()
+
+    def tearDown(self):
+        models.Base.metadata.drop_all(self.engine)
+
+    def _make_package(self):
+        import zipfile
+        fp = tempfile.NamedTemporaryFile(suffix='.zip')
+        with zipfile.ZipFile(fp, 'w') as zipfp:
+            zipfp.writestr('bar.xml', b'<root/>')
+        fp.flush()
+        return fp
+
+    def test_known_packages_are_skipped(self):
+        known = self._make_package()
+        unknown = self._make_package()
+        checksums = {known.name: 'known', unknown.name: 'unknown'}
+
+        backlog = monitor.find_backlog([known.name, unknown.name],
+                                       checksum=checksums.get, batch_size=1)
+
+        self.assertEqual(list(backlog), [unknown.name])
+
+    def test_invalid_zipfiles_are_skipped(self):
+        fp = tempfile.NamedTemporaryFile(suffix='.zip')
+        backlog = monitor.find_backlog([fp.name], checksum=lambda filepath: 'unknown')
+
+        self.assertEqual(list(backlog), [])
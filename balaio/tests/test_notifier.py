@@ -1,9 +1,12 @@
+import logging
 import unittest
+import threading
 
 import mocker
+import transaction
 from sqlalchemy.exc import OperationalError
 
-from balaio.notifier import Notifier
+from balaio.notifier import Notifier, NoticeDispatcher
 from balaio import models
 from . import doubles, modelfactories
 from .utils import db_bootstrap, DB_READY
@@ -177,3 +180,338 @@ class NotifierTests(mocker.MockerTestCase):
         self.assertIsNone(notifier._send_notice_notification(
             'foo', models.Status.ok, label='bar'))
 
+
+    def test_send_notice_notification_enqueues_on_dispatcher(self):
+        checkpoint = models.Checkpoint(models.Point.validation)
+        checkpoint.attempt = models.Attempt(checkin_uri='/api/v1/checkins/1/')
+
+        expected = {
+            'checkin': '/api/v1/checkins/1/',
+            'stage': 'bar',
+            'checkpoint': 'validation',
+            'message': 'foo',
+            'status': 'ok',
+        }
+
+        mock_scieloapi = self.mocker.mock()
+        mock_dispatcher = self.mocker.mock()
+        mock_dispatcher.put(expected)
+        self.mocker.result(None)
+        self.mocker.replay()
+
+        notifier = Notifier(checkpoint, mock_scieloapi, doubles.SessionStub(),
+                            dispatcher=mock_dispatcher)
+        self.assertIsNone(notifier._send_notice_notification(
+            'foo', models.Status.ok, label='bar'))
+
+
+class NoticeDispatcherTests(mocker.MockerTestCase):
+
+    def _makeOne(self, scieloapi, **kwargs):
+        kwargs.setdefault('backoff', 0)
+        return NoticeDispatcher(scieloapi, **kwargs)
+
+    def _make_item(self, checkin='/api/v1/checkins/1/', message='foo'):
+        import time
+        return {'data': {'checkin': checkin, 'message': message},
+                'enqueued_at': time.time(),
+                'pending_id': None}
+
+    def test_notices_are_delivered(self):
+        mock_scieloapi = self.mocker.mock()
+        mock_scieloapi.notices.post(mocker.ANY)
+        self.mocker.result('1')
+        self.mocker.count(2)
+        self.mocker.replay()
+
+        dispatcher = self._makeOne(mock_scieloapi)
+        dispatcher.deliver([self._make_item(), self._make_item()])
+
+        self.assertEqual(dispatcher.stats()['delivered'], 2)
+        self.assertIsNotNone(dispatcher.stats()['mean_latency'])
+
+    def test_notices_are_grouped_by_checkin(self):
+        sent = []
+
+        class NoticesStub(object):
+            def post(self, data):
+                sent.append(data['message'])
+
+        scieloapi = doubles.ObjectStub()
+        scieloapi.notices = NoticesStub()
+
+        dispatcher = self._makeOne(scieloapi)
+        dispatcher.deliver([self._make_item('/api/v1/checkins/2/', 'a'),
+                            self._make_item('/api/v1/checkins/1/', 'b'),
+                            self._make_item('/api/v1/checkins/2/', 'c')])
+
+        self.assertEqual(sent, ['b', 'a', 'c'])
+
+    def test_transient_errors_are_retried(self):
+        from scieloapi.exceptions import ConnectionError
+
+        mock_scieloapi = self.mocker.mock()
+        mock_scieloapi.notices.post(mocker.ANY)
+        self.mocker.throw(ConnectionError)
+        mock_scieloapi.notices.post(mocker.ANY)
+        self.mocker.result('1')
+        self.mocker.replay()
+
+        dispatcher = self._makeOne(mock_scieloapi)
+        dispatcher.deliver([self._make_item()])
+
+        self.assertEqual(dispatcher.stats()['delivered'], 1)
+
+    def test_other_errors_are_discarded(self):
+        from scieloapi.exceptions import BadRequest
+
+        mock_scieloapi = self.mocker.mock()
+        mock_scieloapi.notices.post(mocker.ANY)
+        self.mocker.throw(BadRequest)
+        self.mocker.replay()
+
+        dispatcher = self._makeOne(mock_scieloapi)
+        dispatcher.deliver([self._make_item()])
+
+        self.assertEqual(dispatcher.stats()['discarded'], 1)
+
+    def test_batch_is_given_up_after_max_retries(self):
+        from scieloapi.exceptions import ConnectionError
+
+        mock_scieloapi = self.mocker.mock()
+        mock_scieloapi.notices.post(mocker.ANY)
+        self.mocker.throw(ConnectionError)
+        self.mocker.count(3)
+        self.mocker.replay()
+
+        dispatcher = self._makeOne(mock_scieloapi, max_retries=2)
+        dispatcher.deliver([self._make_item(), self._make_item()])
+
+        self.assertEqual(dispatcher.stats()['discarded'], 2)
+        self.assertEqual(dispatcher.stats()['delivered'], 0)
+
+    def test_undelivered_notices_are_persisted(self):
+        from scieloapi.exceptions import ConnectionError
+
+        mock_scieloapi = self.mocker.mock()
+        mock_scieloapi.notices.post(mocker.ANY)
+        self.mocker.throw(ConnectionError)
+
+        mock_session = self.mocker.mock()
+        mock_session.add(mocker.ANY)
+        self.mocker.result(None)
+        mock_session.close()
+        self.mocker.result(None)
+        self.mocker.replay()
+
+        dispatcher = self._makeOne(mock_scieloapi, max_retries=0,
+                                   Session=lambda: mock_session)
+        dispatcher.deliver([self._make_item()])
+
+        self.assertEqual(dispatcher.stats()['persisted'], 1)
+
+    def test_queued_notices_are_delivered_on_background(self):
+        delivered = threading.Event()
+
+        class NoticesStub(object):
+            def post(self, data):
+                delivered.set()
+
+        scieloapi = doubles.ObjectStub()
+        scieloapi.notices = NoticesStub()
+
+        dispatcher = self._makeOne(scieloapi)
+        dispatcher.put({'checkin': '/api/v1/checkins/1/'})
+
+        delivered.wait(5)
+        dispatcher.stop()
+        self.assertTrue(delivered.is_set())
+
+    def test_flush_persists_the_batch_being_delivered(self):
+        from scieloapi.exceptions import ConnectionError
+        posting = threading.Event()
+        flushing = threading.Event()
+
+        class NoticesStub(object):
+            def post(self, data):
+                posting.set()
+                flushing.wait(5)
+                raise ConnectionError()
+
+        scieloapi = doubles.ObjectStub()
+        scieloapi.notices = NoticesStub()
+
+        dispatcher = self._makeOne(scieloapi, max_retries=100)
+        persisted = []
+        dispatcher._persist = persisted.extend
+
+        dispatcher.put({'checkin': '/api/v1/checkins/1/', 'message': 'a'})
+        dispatcher.put({'checkin': '/api/v1/checkins/1/', 'message': 'b'})
+        posting.wait(5)
+
+        timer = threading.Timer(0.05, flushing.set)
+        timer.start()
+        dispatcher.flush()
+        timer.join()
+
+        self.assertEqual(sorted(item['data']['message'] for item in persisted), ['a', 'b'])
+
+    def test_stats_are_logged_on_flush(self):
+        from balaio import notifier
+        delivered = threading.Event()
+
+        class NoticesStub(object):
+            def post(self, data):
+                delivered.set()
+
+        scieloapi = doubles.ObjectStub()
+        scieloapi.notices = NoticesStub()
+
+        logged = []
+
+        class HandlerStub(logging.Handler):
+            def emit(self, record):
+                if record.levelno == logging.INFO:
+                    logged.append(record.getMessage())
+
+        handler = HandlerStub()
+        notifier.logger.addHandler(handler)
+        self.addCleanup(notifier.logger.removeHandler, handler)
+
+        dispatcher = self._makeOne(scieloapi)
+        dispatcher.put({'checkin': '/api/v1/checkins/1/'})
+        delivered.wait(5)
+        dispatcher.flush()
+
+        self.assertIn("'delivered': 1", logged[-1])
+
+    def test_queued_notices_are_persisted_when_a_worker_process_exits(self):
+        import os
+        import tempfile
+        import multiprocessing
+        from scieloapi.exceptions import ConnectionError
+
+        class NoticesStub(object):
+            def post(self, data):
+                dispatcher._flushing.wait(5)
+                raise ConnectionError()
+
+        scieloapi = doubles.ObjectStub()
+        scieloapi.notices = NoticesStub()
+
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+
+        def persist(items):
+            with open(path, 'a') as f:
+                for item in items:
+                    f.write(item['data']['message'] + '\n')
+
+        dispatcher = self._makeOne(scieloapi, max_retries=100)
+        dispatcher._persist = persist
+
+        # pool workers leave through `os._exit` too.
+        process = multiprocessing.Process(
+            target=dispatcher.put, args=({'checkin': '/api/v1/checkins/1/', 'message': 'a'},))
+        process.start()
+        process.join(15)
+
+        with open(path) as f:
+            self.assertEqual(f.read(), 'a\n')
+
+    def test_next_pending_chunk_is_claimed_as_the_queue_drains(self):
+        done = threading.Event()
+        sent = []
+
+        class NoticesStub(object):
+            def post(self, data):
+                sent.append(data['message'])
+                if len(sent) == 3:
+                    done.set()
+
+        scieloapi = doubles.ObjectStub()
+        scieloapi.notices = NoticesStub()
+
+        dispatcher = self._makeOne(scieloapi, batch_size=2)
+        chunks = [['a', 'b'], ['c']]
+
+        def load_pending():
+            chunk = chunks.pop(0) if chunks else []
+            for message in chunk:
+                dispatcher.put({'checkin': '/api/v1/checkins/1/', 'message': message})
+            return len(chunk)
+        dispatcher.load_pending = load_pending
+
+        dispatcher.put({'checkin': '/api/v1/checkins/1/', 'message': 'x'})
+        done.wait(5)
+        dispatcher.stop()
+
+        self.assertEqual(sent[1:], ['a', 'b', 'c'])
+
+
+@unittest.skipUnless(DB_READY, u'DB must be set. Make sure `app_balaio_tests` is properly configured.')
+class NoticeDispatcherDBTests(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = db_bootstrap()
+        self.session = models.Session()
+        self.session.add(models.PendingNotice(data={'checkin': '/api/v1/checkins/1/'}))
+        transaction.commit()
+
+    def tearDown(self):
+        self.session.close()
+        # the schema is kept to the module-wide tests, e.g. `NotifierTests`.
+        db_bootstrap()
+
+    def _makeOne(self, **kwargs):
+        dispatcher = NoticeDispatcher(doubles.ObjectStub(), Session=models.Session, **kwargs)
+        dispatcher.put = lambda data, pending_id=None: dispatcher.loaded.append(pending_id)
+        dispatcher.loaded = []
+        return dispatcher
+
+    def test_pending_notices_are_claimed_once(self):
+        dispatchers = [self._makeOne(), self._makeOne()]
+        for dispatcher in dispatchers:
+            dispatcher.load_pending()
+
+        self.assertEqual(sum(len(dispatcher.loaded) for dispatcher in dispatchers), 1)
+
+    def test_pending_notices_are_claimed_in_chunks(self):
+        for i in range(2):
+            self.session.add(models.PendingNotice(data={'checkin': '/api/v1/checkins/1/'}))
+        transaction.commit()
+
+        dispatcher = self._makeOne(pending_chunk_size=2)
+
+        self.assertEqual(dispatcher.load_pending(), 2)
+        self.assertEqual(dispatcher.load_pending(), 1)
+        self.assertEqual(dispatcher.load_pending(), 0)
+        self.assertEqual(len(set(dispatcher.loaded)), 3)
+
+    def test_expired_claims_are_claimed_again(self):
+        self._makeOne().load_pending()
+
+        dispatcher = self._makeOne(claim_ttl=-1)
+        dispatcher.load_pending()
+
+        self.assertEqual(len(dispatcher.loaded), 1)
+
+    def test_undelivered_pending_notices_are_released(self):
+        dispatcher = self._makeOne()
+        dispatcher.load_pending()
+        dispatcher._persist([{'data': {}, 'pending_id': dispatcher.loaded[0], 'tried': True}])
+
+        other = self._makeOne()
+        other.load_pending()
+
+        self.assertEqual(len(other.loaded), 1)
+        self.assertEqual(self.session.query(models.PendingNotice).one().retries, 1)
+
+    def test_pending_notices_are_discarded_after_max_retries(self):
+        dispatcher = self._makeOne(max_pending_retries=1)
+        dispatcher.load_pending()
+        dispatcher._persist([{'data': {}, 'pending_id': dispatcher.loaded[0], 'tried': True}])
+
+        self.assertEqual(self.session.query(models.PendingNotice).count(), 0)
+        self.assertEqual(dispatcher.stats()['discarded'], 1)
@@ -128,6 +128,21 @@ class TestRenderer(unittest.TestCase):
 
         self.assertEqual(result, '/script_name/1/2/3?foo=bar&limit=15&offset=50')
 
+    def test_current_resource_path_keeps_falsy_values(self):
+        from pyramid.interfaces import IRoutesMapper
+        route = DummyRoute('/1/2/3')
+        mapper = DummyRoutesMapper(route=route)
+        self.req.matched_route = route
+        self.req.matchdict = {}
+        self.req.script_name = '/script_name'
+        self.req.registry.registerUtility(mapper, IRoutesMapper)
+
+        renderer = GtwMetaFactory()
+        renderer.request = self.req
+        result = renderer._current_resource_path({}, limit=15, after_id=0)
+
+        self.assertIn('after_id=0', result)
+
     def test_format_response_for_a_single_object(self):
         data = AttemptStub().to_dict()
         expected = data
@@ -173,6 +188,44 @@ class TestRenderer(unittest.TestCase):
                     ]
                     })
 
+    def test_format_response_for_a_page_after_id(self):
+        data = {'limit': 1,
+                'after_id': 10,
+                'next_after_id': 11,
+                'total': 200,
+                'filters': {},
+                'objects': [{'id': 11, 'data': 1}]}
+
+        self.req.path = "/api/v1/packages/"
+        renderer = GtwMetaFactory()
+        renderer.request = self.req
+        renderer._current_resource_path = lambda filters, offset=None, limit=None, after_id=None: \
+            self.req.path + '?after_id=%s&limit=%s' % (after_id, limit)
+
+        self.assertEqual(renderer.format_response(data), {
+                'meta': {
+                        'total': 200,
+                        'limit': 1,
+                        'after_id': 10,
+                        'next': "/api/v1/packages/?after_id=11&limit=1",
+                        'previous': None,
+                        },
+                'objects': [{'id': 11, 'data': 1, 'resource_uri': '/api/v1/packages/11/'}]
+                })
+
+    def test_format_response_for_the_last_page_after_id(self):
+        data = {'limit': 20,
+                'after_id': 10,
+                'next_after_id': None,
+                'total': 200,
+                'objects': []}
+
+        self.req.path = "/api/v1/packages/"
+        renderer = GtwMetaFactory()
+        renderer.request = self.req
+
+        self.assertIsNone(renderer.format_response(data)['meta']['next'])
+
     def test_add_resource_to_object_without_related_resources(self):
         data = {
                     'collection_uri': '/api/v1/collection/xxx/',
@@ -1,8 +1,19 @@
+import os
+import stat
+import shutil
+import hashlib
 import unittest
+import tempfile
+import threading
+from StringIO import StringIO
+
+from sqlalchemy.orm import sessionmaker
 
 import mocker
 
-from balaio import uploader
+from balaio import uploader, models
+from . import doubles
+from .utils import db_bootstrap, DB_READY
 
 
 class LoadModuleTests(unittest.TestCase):
@@ -58,6 +69,50 @@ class BlobBackendTests(unittest.TestCase):
 
         self.assertIsInstance(Foo(), Foo)
 
+    def _makeSender(self):
+        class Foo(uploader.BlobBackend):
+            def connect(self): pass
+            def cleanup(self): pass
+
+            def send(self, fp, path):
+                if path == u'/fail':
+                    raise IOError('Failure')
+                return u'http://foo/' + fp.read()
+
+        return Foo()
+
+    def test_send_many_keeps_the_order_of_items(self):
+        items = [(StringIO(str(i)), u'/%s' % i) for i in range(20)]
+
+        results = self._makeSender().send_many(items, workers=4)
+
+        self.assertEqual([result.resource_uri for result in results],
+                         [u'http://foo/%s' % i for i in range(20)])
+        self.assertEqual([result.path for result in results], [u'/%s' % i for i in range(20)])
+
+    def test_send_many_reports_failures(self):
+        items = [(StringIO('a'), u'/fail'), (StringIO('b'), u'/b')]
+
+        results = self._makeSender().send_many(items)
+
+        self.assertIsInstance(results[0].error, IOError)
+        self.assertIsNone(results[0].resource_uri)
+        self.assertEqual(results[1].resource_uri, u'http://foo/b')
+        self.assertIsNone(results[1].error)
+
+    def test_send_many_opens_the_filepaths(self):
+        fp = tempfile.NamedTemporaryFile()
+        fp.write('bar')
+        fp.flush()
+
+        results = self._makeSender().send_many([(fp.name, u'/bar')])
+
+        self.assertEqual(results[0].resource_uri, u'http://foo/bar')
+        self.assertTrue(results[0].elapsed >= 0)
+
+    def test_send_many_without_items(self):
+        self.assertEqual(self._makeSender().send_many([]), [])
+
 
 class StaticScieloBackendTests(mocker.MockerTestCase):
 
@@ -86,3 +141,599 @@ class StaticScieloBackendTests(mocker.MockerTestCase):
         self.assertEqual(st._get_resource_uri(u'/journals/art1/foo.pdf'),
             u'http://static.scielo.org/journals/art1/foo.pdf')
 
+
+    def test_backends_of_the_same_host_share_the_pool(self):
+        st = uploader.StaticScieloBackend(u'some.user', u'some.pass',
+            u'/var/www/', host=u'shared.host')
+        st2 = uploader.StaticScieloBackend(u'some.user', u'some.pass',
+            u'/var/www/', host=u'shared.host')
+
+        self.assertIs(st.pool, st2.pool)
+
+    def test_backends_with_other_settings_have_their_own_pool(self):
+        st = uploader.StaticScieloBackend(u'some.user', u'some.pass',
+            u'/var/www/', host=u'shared.host')
+
+        for settings in [{'password': u'other.pass'}, {'keepalive': 10}, {'list_basepath': True}]:
+            kwargs = dict({'username': u'some.user', 'password': u'some.pass',
+                           'basepath': u'/var/www/', 'host': u'shared.host'}, **settings)
+            self.assertIsNot(uploader.StaticScieloBackend(**kwargs).pool, st.pool)
+
+    def test_waiting_for_a_connection_times_out(self):
+        pool = uploader.ConnectionPool(lambda: uploader.PooledConnection(TransportStub(), SFTPStub()),
+            maxsize=1)
+        st = uploader.StaticScieloBackend(u'some.user', u'some.pass',
+            u'/var/www/', pool=pool, acquire_timeout=0.01)
+
+        with st:
+            results = st.send_many([(None, u'/foo.pdf')])
+
+        self.assertIsInstance(results[0].error, RuntimeError)
+
+    def test_send_borrows_a_connection_from_the_pool(self):
+        pool = uploader.ConnectionPool(lambda: uploader.PooledConnection(TransportStub(), SFTPStub()))
+        st = uploader.StaticScieloBackend(u'some.user', u'some.pass',
+            u'/var/www/', pool=pool)
+
+        st.send(None, u'/journals/art1/foo.pdf')
+        st.send(None, u'/journals/art1/bar.pdf')
+
+        self.assertEqual(pool.stats()['created'], 1)
+        self.assertEqual(pool.stats()['reused'], 1)
+
+    def test_context_manager_uses_a_single_connection(self):
+        sftp = SFTPStub()
+        pool = uploader.ConnectionPool(lambda: uploader.PooledConnection(TransportStub(), sftp))
+        st = uploader.StaticScieloBackend(u'some.user', u'some.pass',
+            u'/var/www/', pool=pool)
+
+        with st:
+            st.send(None, u'/journals/art1/foo.pdf')
+            self.assertEqual(pool.stats()['idle'], 0)
+
+        self.assertEqual(sftp.sent, [u'/var/www/journals/art1/foo.pdf'])
+        self.assertEqual(pool.stats()['idle'], 1)
+
+    def test_ensure_parent_dir_skips_known_dirs(self):
+        st = uploader.StaticScieloBackend(u'some.user', u'some.pass',
+            u'/var/www/journals')
+        sftp = SFTPStub()
+        known_dirs = set([u'/var', u'/var/www', u'/var/www/journals'])
+
+        st._ensure_parent_dir(u'/var/www/journals/art1/foo.pdf', sftp=sftp, known_dirs=known_dirs)
+        st._ensure_parent_dir(u'/var/www/journals/art1/bar.pdf', sftp=sftp, known_dirs=known_dirs)
+
+        self.assertEqual(sftp.mkdirs, [u'/var/www/journals/art1'])
+        self.assertIn(u'/var/www/journals/art1', known_dirs)
+
+    def test_sending_to_the_same_dir_creates_it_once(self):
+        sftp = SFTPStub()
+        pool = uploader.ConnectionPool(lambda: uploader.PooledConnection(TransportStub(), sftp))
+        st = uploader.StaticScieloBackend(u'some.user', u'some.pass',
+            u'/var/www/', pool=pool)
+
+        for i in range(500):
+            st.send(None, u'/journals/issue1/%s.pdf' % i)
+
+        self.assertEqual(sftp.mkdirs, [u'/var', u'/var/www', u'/var/www/journals',
+                                       u'/var/www/journals/issue1'])
+
+    def test_basepath_and_parents_are_known(self):
+        st = uploader.StaticScieloBackend(u'some.user', u'some.pass',
+            u'/var/www/')
+
+        self.assertEqual(st._list_known_dirs(SFTPStub()), set([u'/var', u'/var/www']))
+
+    def test_listing_of_basepath(self):
+        st = uploader.StaticScieloBackend(u'some.user', u'some.pass',
+            u'/var/www/', list_basepath=True)
+
+        sftp = self.mocker.mock()
+        sftp.listdir_attr(u'.')
+        self.mocker.result([DirAttrStub(u'journals', 0o40755), DirAttrStub(u'index.html', 0o100644)])
+        self.mocker.replay()
+
+        self.assertEqual(st._list_known_dirs(sftp),
+                         set([u'/var', u'/var/www', u'/var/www/journals']))
+
+    def test_listing_of_root_basepath(self):
+        st = uploader.StaticScieloBackend(u'some.user', u'some.pass',
+            u'/', list_basepath=True)
+
+        sftp = self.mocker.mock()
+        sftp.listdir_attr(u'.')
+        self.mocker.result([DirAttrStub(u'journals', 0o40755)])
+        self.mocker.replay()
+
+        known_dirs = st._list_known_dirs(sftp)
+        self.assertEqual(known_dirs, set([u'/journals']))
+
+        stub = SFTPStub()
+        st._ensure_parent_dir(u'/journals/foo.pdf', sftp=stub, known_dirs=known_dirs)
+        self.assertEqual(stub.mkdirs, [])
+
+    def test_send_many_borrows_a_connection_per_transfer(self):
+        transports = []
+        def factory():
+            transports.append(TransportStub())
+            return uploader.PooledConnection(transports[-1], SFTPStub())
+        pool = uploader.ConnectionPool(factory, maxsize=2)
+        st = uploader.StaticScieloBackend(u'some.user', u'some.pass',
+            u'/var/www/', pool=pool)
+
+        with st:
+            results = st.send_many([(None, u'/journals/%s.pdf' % i) for i in range(10)], workers=4)
+
+        self.assertEqual(len(transports), 2)
+        self.assertTrue(all(result.error is None for result in results))
+
+
+class DirAttrStub(object):
+    def __init__(self, filename, st_mode):
+        self.filename = filename
+        self.st_mode = st_mode
+
+
+class TransportStub(object):
+    def __init__(self):
+        self.active = True
+
+    def is_active(self):
+        return self.active
+
+    def close(self):
+        self.active = False
+
+
+class SFTPStub(object):
+    def __init__(self):
+        self.sent = []
+        self.mkdirs = []
+        self.ops = []
+
+    def mkdir(self, path):
+        self.mkdirs.append(path)
+
+    def putfo(self, fp, path, confirm=True):
+        self.sent.append(path)
+
+    def remove(self, path):
+        self.ops.append(('remove', path))
+
+    def rename(self, oldpath, newpath):
+        self.ops.append(('rename', oldpath, newpath))
+
+    def symlink(self, source, dest):
+        self.ops.append(('symlink', source, dest))
+
+
+class StreamStub(object):
+    """
+    A file object that can only be read, e.g. a socket.
+    """
+    def __init__(self, data):
+        self._fp = StringIO(data)
+
+    def read(self, size=-1):
+        return self._fp.read(size)
+
+
+class ManifestStub(object):
+    """
+    In-memory :class:`uploader.AssetManifest`.
+    """
+    def __init__(self):
+        self.assets = {}
+
+    def get(self, host, path):
+        return self.assets.get((host, path))
+
+    def find(self, host, checksum):
+        for asset in sorted(self.assets.values(), key=lambda asset: asset.path):
+            if asset.host == host and asset.checksum == checksum and asset.link_target is None:
+                return asset
+
+    def links_to(self, host, path):
+        return sorted([asset for asset in self.assets.values()
+                       if asset.host == host and asset.link_target == path],
+                      key=lambda asset: asset.path)
+
+    def record(self, host, path, checksum, size, link_target=None):
+        self.assets[(host, path)] = models.UploadedAsset(host=host, path=path,
+            checksum=checksum, size=size, link_target=link_target)
+
+    def move_links(self, host, path, new_target):
+        for asset in self.links_to(host, path):
+            asset.link_target = None if asset.path == new_target else new_target
+
+
+class ConnectionPoolTests(unittest.TestCase):
+
+    def _makeOne(self, **kwargs):
+        self.clock = doubles.ClockStub()
+        factory = lambda: uploader.PooledConnection(TransportStub(), None, clock=self.clock)
+        return uploader.ConnectionPool(factory, clock=self.clock, **kwargs)
+
+    def test_released_connections_are_reused(self):
+        pool = self._makeOne()
+
+        conn = pool.acquire()
+        pool.release(conn)
+
+        self.assertIs(pool.acquire(), conn)
+        self.assertEqual(pool.stats()['created'], 1)
+
+    def test_connections_are_created_up_to_maxsize(self):
+        pool = self._makeOne(maxsize=2)
+
+        pool.acquire()
+        pool.acquire()
+
+        self.assertRaises(RuntimeError, lambda: pool.acquire(timeout=0))
+
+    def test_waits_for_a_released_connection(self):
+        pool = self._makeOne(maxsize=1)
+        conn = pool.acquire()
+        timer = threading.Timer(0.05, pool.release, [conn])
+        timer.start()
+        self.addCleanup(timer.join)
+
+        self.assertIs(pool.acquire(), conn)
+
+    def test_inactive_connections_are_replaced(self):
+        pool = self._makeOne()
+        conn = pool.acquire()
+        pool.release(conn)
+
+        conn.transport.active = False
+
+        self.assertIsNot(pool.acquire(), conn)
+        self.assertEqual(pool.stats()['size'], 1)
+
+    def test_discarded_connections_free_their_slots(self):
+        pool = self._makeOne(maxsize=1)
+        conn = pool.acquire()
+        pool.release(conn, discard=True)
+
+        self.assertFalse(conn.transport.is_active())
+        self.assertIsNot(pool.acquire(timeout=0), conn)
+
+    def test_idle_connections_are_evicted(self):
+        pool = self._makeOne(max_idle=10)
+        conn = pool.acquire()
+        pool.release(conn)
+
+        self.clock.now = 11
+        pool.evict_idle()
+
+        self.assertFalse(conn.transport.is_active())
+        self.assertEqual(pool.stats()['size'], 0)
+        self.assertEqual(pool.stats()['evicted'], 1)
+
+    def test_health_check_after_inactivity(self):
+        def health_check(conn):
+            raise IOError('Socket is closed')
+
+        pool = self._makeOne(check_after=5, health_check=health_check)
+        conn = pool.acquire()
+        pool.release(conn)
+
+        self.clock.now = 6
+
+        self.assertIsNot(pool.acquire(), conn)
+
+    def test_connection_is_discarded_on_errors(self):
+        pool = self._makeOne()
+
+        try:
+            with pool.connection() as conn:
+                raise IOError()
+        except IOError:
+            pass
+
+        self.assertFalse(conn.transport.is_active())
+        self.assertEqual(pool.stats()['size'], 0)
+
+    def test_factory_errors_free_the_slot(self):
+        def factory():
+            raise IOError()
+        pool = uploader.ConnectionPool(factory, maxsize=1)
+
+        self.assertRaises(IOError, pool.acquire)
+        self.assertEqual(pool.stats()['size'], 0)
+
+
+class FileChecksumTests(unittest.TestCase):
+
+    def test_checksum_and_size(self):
+        fp = StringIO('foo bar')
+
+        self.assertEqual(uploader.file_checksum(fp, chunk_size=2),
+                         (hashlib.sha1('foo bar').hexdigest(), 7))
+
+    def test_file_is_rewound(self):
+        fp = StringIO('foo bar')
+        fp.seek(4)
+
+        uploader.file_checksum(fp)
+
+        self.assertEqual(fp.read(), 'bar')
+
+
+class DeduplicationTests(unittest.TestCase):
+
+    def _makeOne(self, **kwargs):
+        self.sftp = SFTPStub()
+        self.manifest = ManifestStub()
+        pool = uploader.ConnectionPool(lambda: uploader.PooledConnection(TransportStub(), self.sftp))
+        return uploader.StaticScieloBackend(u'some.user', u'some.pass', u'/var/www/',
+            pool=pool, manifest=self.manifest, **kwargs)
+
+    def test_unchanged_files_are_not_sent(self):
+        st = self._makeOne()
+
+        st.send(StringIO('foo'), u'/journals/a.pdf')
+        uri = st.send(StringIO('foo'), u'/journals/a.pdf')
+
+        self.assertEqual(self.sftp.sent, [u'/var/www/journals/a.pdf'])
+        self.assertEqual(uri, u'http://static.scielo.org/journals/a.pdf')
+
+    def test_changed_files_are_sent(self):
+        st = self._makeOne()
+
+        st.send(StringIO('foo'), u'/journals/a.pdf')
+        st.send(StringIO('bar'), u'/journals/a.pdf')
+
+        self.assertEqual(len(self.sftp.sent), 2)
+        self.assertEqual(self.manifest.get(st.host, u'/var/www/journals/a.pdf').checksum,
+                         uploader.file_checksum(StringIO('bar'))[0])
+
+    def test_duplicates_are_linked(self):
+        st = self._makeOne()
+
+        st.send(StringIO('foo'), u'/journals/a.pdf')
+        st.send(StringIO('foo'), u'/journals/b.pdf')
+
+        self.assertEqual(self.sftp.sent, [u'/var/www/journals/a.pdf'])
+        self.assertIn(('symlink', u'a.pdf', u'/var/www/journals/b.pdf'), self.sftp.ops)
+        self.assertEqual(self.manifest.get(st.host, u'/var/www/journals/b.pdf').link_target,
+                         u'/var/www/journals/a.pdf')
+
+    def test_duplicates_are_sent_when_linking_is_disabled(self):
+        st = self._makeOne(link_duplicates=False)
+
+        st.send(StringIO('foo'), u'/journals/a.pdf')
+        st.send(StringIO('foo'), u'/journals/b.pdf')
+
+        self.assertEqual(len(self.sftp.sent), 2)
+
+    def test_replacing_a_link_removes_it_first(self):
+        st = self._makeOne()
+        st.send(StringIO('foo'), u'/journals/a.pdf')
+        st.send(StringIO('foo'), u'/journals/b.pdf')
+
+        st.send(StringIO('bar'), u'/journals/b.pdf')
+
+        self.assertEqual(self.sftp.ops[-1], ('remove', u'/var/www/journals/b.pdf'))
+        self.assertEqual(self.sftp.sent[-1], u'/var/www/journals/b.pdf')
+        self.assertIsNone(self.manifest.get(st.host, u'/var/www/journals/b.pdf').link_target)
+
+    def test_replacing_a_linked_file_keeps_the_contents_of_the_links(self):
+        st = self._makeOne()
+        st.send(StringIO('foo'), u'/journals/a.pdf')
+        st.send(StringIO('foo'), u'/journals/b.pdf')
+        st.send(StringIO('foo'), u'/journals/c.pdf')
+        del self.sftp.ops[:]
+
+        st.send(StringIO('bar'), u'/journals/a.pdf')
+
+        self.assertEqual(self.sftp.ops, [
+            ('remove', u'/var/www/journals/b.pdf'),
+            ('rename', u'/var/www/journals/a.pdf', u'/var/www/journals/b.pdf'),
+            ('remove', u'/var/www/journals/c.pdf'),
+            ('symlink', u'b.pdf', u'/var/www/journals/c.pdf'),
+        ])
+        self.assertIsNone(self.manifest.get(st.host, u'/var/www/journals/b.pdf').link_target)
+        self.assertEqual(self.manifest.get(st.host, u'/var/www/journals/c.pdf').link_target,
+                         u'/var/www/journals/b.pdf')
+
+    def test_links_to_other_dirs_are_relative(self):
+        st = self._makeOne()
+
+        st.send(StringIO('foo'), u'/journals/issue1/a.pdf')
+        st.send(StringIO('foo'), u'/journals/issue2/img/a.pdf')
+
+        self.assertIn(('symlink', u'../../issue1/a.pdf', u'/var/www/journals/issue2/img/a.pdf'),
+                      self.sftp.ops)
+
+    def test_streams_replacing_a_link_remove_it_first(self):
+        st = self._makeOne()
+        st.send(StringIO('foo'), u'/journals/a.pdf')
+        st.send(StringIO('foo'), u'/journals/b.pdf')
+
+        st.send(StreamStub('bar'), u'/journals/b.pdf')
+
+        self.assertEqual(self.sftp.ops[-1], ('remove', u'/var/www/journals/b.pdf'))
+        self.assertEqual(self.sftp.sent[-1], u'/var/www/journals/b.pdf')
+        self.assertEqual(self.manifest.get(st.host, u'/var/www/journals/b.pdf').checksum,
+                         hashlib.sha1('bar').hexdigest())
+
+    def test_unchanged_streams_are_not_sent(self):
+        st = self._makeOne()
+
+        st.send(StreamStub('foo'), u'/journals/a.pdf')
+        st.send(StreamStub('foo'), u'/journals/a.pdf')
+
+        self.assertEqual(len(self.sftp.sent), 1)
+
+    def test_files_are_sent_without_manifest(self):
+        st = self._makeOne()
+        st.manifest = None
+
+        st.send(StringIO('foo'), u'/journals/a.pdf')
+        st.send(StringIO('foo'), u'/journals/a.pdf')
+
+        self.assertEqual(len(self.sftp.sent), 2)
+
+
+@unittest.skipUnless(DB_READY, u'DB must be set. Make sure `app_balaio_tests` is properly configured.')
+class AssetManifestDBTests(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = db_bootstrap()
+        self.manifest = uploader.AssetManifest(
+            Session=sessionmaker(bind=self.engine, expire_on_commit=False))
+
+    def test_record_and_get(self):
+        self.manifest.record(u'host', u'/a.pdf', u'c1', 10)
+        first_upload = self.manifest.get(u'host', u'/a.pdf').uploaded_at
+        self.manifest.record(u'host', u'/a.pdf', u'c2', 20)
+
+        asset = self.manifest.get(u'host', u'/a.pdf')
+        self.assertEqual((asset.checksum, asset.size), (u'c2', 20))
+        self.assertTrue(asset.uploaded_at > first_upload)
+        self.assertIsNone(self.manifest.get(u'other.host', u'/a.pdf'))
+
+    def test_find_ignores_links(self):
+        self.manifest.record(u'host', u'/b.pdf', u'c1', 10, link_target=u'/a.pdf')
+        self.assertIsNone(self.manifest.find(u'host', u'c1'))
+
+        self.manifest.record(u'host', u'/a.pdf', u'c1', 10)
+        self.assertEqual(self.manifest.find(u'host', u'c1').path, u'/a.pdf')
+
+    def test_move_links(self):
+        self.manifest.record(u'host', u'/a.pdf', u'c1', 10)
+        self.manifest.record(u'host', u'/b.pdf', u'c1', 10, link_target=u'/a.pdf')
+        self.manifest.record(u'host', u'/c.pdf', u'c1', 10, link_target=u'/a.pdf')
+
+        self.manifest.move_links(u'host', u'/a.pdf', u'/b.pdf')
+
+        self.assertIsNone(self.manifest.get(u'host', u'/b.pdf').link_target)
+        self.assertEqual([asset.path for asset in self.manifest.links_to(u'host', u'/b.pdf')],
+                         [u'/c.pdf'])
+
+
+class FileSystemBackendTests(unittest.TestCase):
+
+    def setUp(self):
+        self.basepath = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.basepath)
+
+    def _makeSource(self, data='foo', mode=0644):
+        source = tempfile.NamedTemporaryFile(dir=self.basepath)
+        source.write(data)
+        source.flush()
+        source.seek(0)
+        os.chmod(source.name, mode)
+        return source
+
+    def test_send(self):
+        fs = uploader.FileSystemBackend(self.basepath)
+
+        uri = fs.send(StringIO('foo'), u'/journals/art1/foo.pdf')
+
+        with open(os.path.join(self.basepath, 'journals', 'art1', 'foo.pdf')) as fp:
+            self.assertEqual(fp.read(), 'foo')
+        self.assertEqual(uri, u'file://%s/journals/art1/foo.pdf' % self.basepath)
+
+    def test_resource_uri_with_base_url(self):
+        fs = uploader.FileSystemBackend(self.basepath, base_url=u'http://staging/')
+
+        self.assertEqual(fs.send(StringIO('foo'), u'/foo.pdf'), u'http://staging/foo.pdf')
+
+    def test_existing_files_are_replaced(self):
+        fs = uploader.FileSystemBackend(self.basepath)
+
+        fs.send(StringIO('foo'), u'/foo.pdf')
+        fs.send(StringIO('bar'), u'/foo.pdf')
+
+        with open(os.path.join(self.basepath, 'foo.pdf')) as fp:
+            self.assertEqual(fp.read(), 'bar')
+        self.assertEqual(os.listdir(self.basepath), ['foo.pdf'])
+
+    def test_files_are_hardlinked(self):
+        fs = uploader.FileSystemBackend(self.basepath)
+        source = self._makeSource()
+
+        fs.send(source, u'/foo.pdf')
+
+        self.assertEqual(os.stat(source.name).st_ino,
+                         os.stat(os.path.join(self.basepath, 'foo.pdf')).st_ino)
+
+    def test_private_files_are_copied_readable(self):
+        fs = uploader.FileSystemBackend(self.basepath)
+        source = self._makeSource(mode=0600)
+
+        fs.send(source, u'/foo.pdf')
+
+        dest = os.stat(os.path.join(self.basepath, 'foo.pdf'))
+        self.assertNotEqual(os.stat(source.name).st_ino, dest.st_ino)
+        self.assertEqual(stat.S_IMODE(dest.st_mode), 0644)
+        self.assertEqual(stat.S_IMODE(os.stat(source.name).st_mode), 0600)
+
+    def test_files_are_copied_if_hardlinks_are_disabled(self):
+        fs = uploader.FileSystemBackend(self.basepath, hardlink=False)
+        source = self._makeSource()
+
+        fs.send(source, u'/foo.pdf')
+
+        dest = os.path.join(self.basepath, 'foo.pdf')
+        self.assertNotEqual(os.stat(source.name).st_ino, os.stat(dest).st_ino)
+        with open(dest) as fp:
+            self.assertEqual(fp.read(), 'foo')
+
+    def test_partially_read_files_are_copied_from_the_position(self):
+        fs = uploader.FileSystemBackend(self.basepath)
+        source = self._makeSource('foo bar')
+        source.seek(4)
+
+        fs.send(source, u'/foo.pdf')
+
+        with open(os.path.join(self.basepath, 'foo.pdf')) as fp:
+            self.assertEqual(fp.read(), 'bar')
+
+    def test_copy_without_sendfile(self):
+        fs = uploader.FileSystemBackend(self.basepath, hardlink=False)
+        source = self._makeSource()
+
+        with doubles.Patch(uploader, 'sendfile', None):
+            fs.send(source, u'/foo.pdf')
+
+        with open(os.path.join(self.basepath, 'foo.pdf')) as fp:
+            self.assertEqual(fp.read(), 'foo')
+
+    def test_copy_with_sendfile(self):
+        calls = []
+        def sendfile(out_fd, in_fd, offset, count):
+            # copies at most 2 bytes per call.
+            calls.append(offset)
+            os.lseek(in_fd, offset, os.SEEK_SET)
+            return os.write(out_fd, os.read(in_fd, 2))
+
+        fs = uploader.FileSystemBackend(self.basepath, hardlink=False)
+        source = self._makeSource('foo bar')
+
+        with doubles.Patch(uploader, 'sendfile', sendfile):
+            fs.send(source, u'/foo.pdf')
+
+        self.assertEqual(calls, [0, 2, 4, 6])
+        with open(os.path.join(self.basepath, 'foo.pdf')) as fp:
+            self.assertEqual(fp.read(), 'foo bar')
+
+    def test_paths_outside_of_basepath(self):
+        fs = uploader.FileSystemBackend(self.basepath)
+
+        self.assertRaises(ValueError, lambda: fs.send(StringIO('foo'), u'/../foo.pdf'))
+
+    def test_root_basepath(self):
+        fs = uploader.FileSystemBackend(u'/')
+
+        self.assertEqual(fs._get_fqpath(u'/tmp/foo.pdf'), u'/tmp/foo.pdf')
+
+    def test_send_many(self):
+        fs = uploader.FileSystemBackend(self.basepath)
+
+        results = fs.send_many([(StringIO(str(i)), u'/issue/%s.pdf' % i) for i in range(10)])
+
+        self.assertTrue(all(result.error is None for result in results))
+        self.assertEqual(len(os.listdir(os.path.join(self.basepath, 'issue'))), 10)
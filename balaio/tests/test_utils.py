@@ -152,7 +152,6 @@ class SendMessageFunctionTests(mocker.MockerTestCase):
 
         mock_stream.write(mocker.ANY)
         self.mocker.result(None)
-        self.mocker.count(2)
 
         mock_stream.flush()
         self.mocker.result(None)
@@ -165,7 +164,7 @@ class SendMessageFunctionTests(mocker.MockerTestCase):
     def test_serialized_data_digest_in_header(self):
         """
         The data header is formed by:
-        <serialized data digest> <serialized data length>\n
+        <serialized data digest><serialized data length>
         """
         mock_digest = self.mocker.mock()
         mock_digest(mocker.ANY)
@@ -175,15 +174,16 @@ class SendMessageFunctionTests(mocker.MockerTestCase):
         stream = StringIO()
 
         utils.send_message(stream, 'message', mock_digest)
+        header = stream.getvalue()[:utils.MESSAGE_OVERHEAD]
         self.assertEqual(
-            stream.getvalue().split('\n')[0].split(' ')[0],
+            utils.MESSAGE_HEADER.unpack(header)[0],
             'e5fcf4f4606df6368779205e29b22e5851355de3'
         )
 
     def test_serialized_data_length_in_header(self):
         """
         The data header is formed by:
-        <serialized data digest> <serialized data length>\n
+        <serialized data digest><serialized data length>
         """
         mock_digest = self.mocker.mock()
         mock_pickle = self.mocker.mock()
@@ -202,11 +202,33 @@ class SendMessageFunctionTests(mocker.MockerTestCase):
 
         utils.send_message(stream, 'message', mock_digest, pickle_dep=mock_pickle)
 
+        header = stream.getvalue()[:utils.MESSAGE_OVERHEAD]
         self.assertEqual(
-            int(stream.getvalue().split('\n')[0].split(' ')[1]),
+            utils.MESSAGE_HEADER.unpack(header)[1],
             len('serialized-data-byte-string')
         )
 
+    def test_serialized_data_follows_the_header(self):
+        mock_digest = self.mocker.mock()
+        mock_pickle = self.mocker.mock()
+        mock_digest(mocker.ANY)
+        self.mocker.result('e5fcf4f4606df6368779205e29b22e5851355de3')
+
+        mock_pickle.HIGHEST_PROTOCOL
+        self.mocker.result('foo')
+
+        mock_pickle.dumps(mocker.ANY, mocker.ANY)
+        self.mocker.result('serialized-data-byte-string')
+
+        self.mocker.replay()
+
+        stream = StringIO()
+
+        utils.send_message(stream, 'message', mock_digest, pickle_dep=mock_pickle)
+
+        self.assertEqual(stream.getvalue()[utils.MESSAGE_OVERHEAD:],
+                         'serialized-data-byte-string')
+
     def test_socket_stream_support(self):
         import socket
         sock_one, sock_two = socket.socketpair()
@@ -225,8 +247,9 @@ class SendMessageFunctionTests(mocker.MockerTestCase):
         self.mocker.replay()
 
         utils.send_message(sock_one, 'message', mock_digest, pickle_dep=mock_pickle)
+        header = sock_two.recv(utils.MESSAGE_OVERHEAD)
         self.assertEqual(
-            int(sock_two.recv(1024).split('\n')[0].split(' ')[1]),
+            utils.MESSAGE_HEADER.unpack(header)[1],
             len('serialized-data-byte-string')
         )
 
@@ -252,14 +275,16 @@ class SendMessageFunctionTests(mocker.MockerTestCase):
 
         utils.send_message(in_stream, 'message', mock_digest, pickle_dep=mock_pickle)
         conn, _ = out_stream.accept()
+        header = conn.recv(utils.MESSAGE_OVERHEAD)
         self.assertEqual(
-            int(conn.recv(1024).split('\n')[0].split(' ')[1]),
+            utils.MESSAGE_HEADER.unpack(header)[1],
             len('serialized-data-byte-string')
         )
 
 
 class RecvMessageFunctionTests(mocker.MockerTestCase):
-    serialized_message = 'e5fcf4f4606df6368779205e29b22e5851355de3 14\n\x80\x02U\x07messageq\x01.'
+    serialized_message = utils.MESSAGE_HEADER.pack(
+        'e5fcf4f4606df6368779205e29b22e5851355de3', 14) + '\x80\x02U\x07messageq\x01.'
     sock_path = 'balaio-tests.sock'
 
     def tearDown(self):
@@ -287,12 +312,34 @@ class RecvMessageFunctionTests(mocker.MockerTestCase):
 
         self.assertRaises(StopIteration, lambda: messages.next())
 
+    def test_truncated_data_stops_the_iteration(self):
+        in_stream = StringIO(self.serialized_message[:-3])
+        messages = utils.recv_messages(in_stream, utils.make_digest)
+
+        self.assertRaises(StopIteration, lambda: messages.next())
+
+    def test_truncated_header_stops_the_iteration(self):
+        in_stream = StringIO(self.serialized_message[:10])
+        messages = utils.recv_messages(in_stream, utils.make_digest)
+
+        self.assertRaises(StopIteration, lambda: messages.next())
+
     def test_raises_StopIteration_while_the_stream_is_exhausted(self):
         in_stream = StringIO()
         messages = utils.recv_messages(in_stream, utils.make_digest)
 
         self.assertRaises(StopIteration, lambda: messages.next())
 
+    def test_roundtrip_of_many_messages(self):
+        stream = StringIO()
+        for i in range(100):
+            utils.send_message(stream, {'seq': i}, utils.make_digest)
+
+        stream.seek(0)
+        messages = utils.recv_messages(stream, utils.make_digest)
+
+        self.assertEqual([msg['seq'] for msg in messages], range(100))
+
     def test_socket_stream_support(self):
         import socket
         mock_digest = self.mocker.mock()
@@ -321,6 +368,89 @@ class RecvMessageFunctionTests(mocker.MockerTestCase):
         self.assertEqual(messages.next(), 'message')
 
 
+class MessageReaderTests(unittest.TestCase):
+
+    def _make_frames(self, *messages):
+        stream = StringIO()
+        for message in messages:
+            utils.send_message(stream, message, utils.make_digest)
+        return stream.getvalue()
+
+    def test_complete_messages_are_deserialized(self):
+        reader = utils.MessageReader(utils.make_digest)
+        reader.feed(self._make_frames('foo', 'bar'))
+
+        self.assertEqual(list(reader), ['foo', 'bar'])
+
+    def test_incomplete_messages_are_kept_pending(self):
+        data = self._make_frames('foo')
+        reader = utils.MessageReader(utils.make_digest)
+        reader.feed(data[:-2])
+
+        self.assertEqual(list(reader), [])
+        self.assertEqual(reader.pending, len(data) - 2)
+
+        reader.feed(data[-2:])
+        self.assertEqual(list(reader), ['foo'])
+        self.assertEqual(reader.pending, 0)
+
+    def test_messages_fed_byte_by_byte(self):
+        reader = utils.MessageReader(utils.make_digest)
+        messages = []
+        for byte in self._make_frames('foo', 'bar'):
+            reader.feed(byte)
+            messages.extend(reader)
+
+        self.assertEqual(messages, ['foo', 'bar'])
+
+    def test_corrupted_messages_are_bypassed(self):
+        reader = utils.MessageReader(lambda data: 'e5fcf4f4606df6368779205e29b22e5851355de3')
+        reader.feed(self._make_frames('foo'))
+
+        self.assertEqual(list(reader), [])
+        self.assertEqual(reader.pending, 0)
+
+
+class RecvMultiplexedMessagesTests(unittest.TestCase):
+    sock_path = 'balaio-tests.sock'
+
+    def tearDown(self):
+        utils.remove_unix_socket(self.sock_path)
+
+    def test_listening_sockets_are_identified(self):
+        server = utils.get_readable_socket(self.sock_path)
+        client = utils.get_writable_socket(self.sock_path)
+
+        self.assertTrue(utils.is_listening_socket(server))
+        self.assertFalse(utils.is_listening_socket(client))
+
+    def test_messages_from_many_producers_are_merged(self):
+        import itertools
+        server = utils.get_readable_socket(self.sock_path)
+        producers = [utils.get_writable_socket(self.sock_path) for i in range(3)]
+
+        for i, producer in enumerate(producers):
+            utils.send_message(producer, 'message %s' % i, utils.make_digest)
+
+        messages = utils.recv_messages(server, utils.make_digest)
+
+        self.assertEqual(sorted(itertools.islice(messages, 3)),
+                         ['message 0', 'message 1', 'message 2'])
+
+    def test_producers_may_connect_at_any_time(self):
+        server = utils.get_readable_socket(self.sock_path)
+        messages = utils.recv_multiplexed_messages(server, utils.make_digest)
+
+        first_producer = utils.get_writable_socket(self.sock_path)
+        utils.send_message(first_producer, 'foo', utils.make_digest)
+        self.assertEqual(messages.next(), 'foo')
+
+        first_producer.close()
+        second_producer = utils.get_writable_socket(self.sock_path)
+        utils.send_message(second_producer, 'bar', utils.make_digest)
+        self.assertEqual(messages.next(), 'bar')
+
+
 class ISSNFunctionsTest(unittest.TestCase):
 
     def test_calc_check_digit_issn_with_valid_ISSN(self):
@@ -428,6 +558,20 @@ class DOIFunctionsTests(mocker.MockerTestCase):
 
         self.assertFalse(utils.is_valid_doi('10.1590/S2179-975X2012005XXXX'))
 
+    def test_get_doi_status(self):
+        mock_response = self.mocker.mock()
+
+        mock_response.status_code
+        self.mocker.result(503)
+
+        requests = self.mocker.replace("requests.get")
+        requests('http://dx.doi.org/10.1590/S2179-975X2012005000031', timeout=2.5)
+        self.mocker.result(mock_response)
+
+        self.mocker.replay()
+
+        self.assertEqual(utils.get_doi_status('10.1590/S2179-975X2012005000031'), 503)
+
     def test_valid_doi_with_any_network_problem(self):
         import requests
 
@@ -544,6 +688,27 @@ class FileLikeSocketAdaperTests(unittest.TestCase):
         fsock = utils.FileLikeSocket(self.sock_two)
         self.assertEquals(fsock.read(4), 'only')
 
+    def test_read_after_readline(self):
+        self.sock_one.sendall('only fluids, the doc said.\ngimme a beer!\n')
+
+        fsock = utils.FileLikeSocket(self.sock_two)
+        fsock.readline()
+        self.assertEquals(fsock.read(5), 'gimme')
+
+    def test_read_accumulates_partial_reads(self):
+        fsock = utils.FileLikeSocket(self.sock_two, bufsize=2)
+
+        self.sock_one.sendall('only ')
+        self.sock_one.sendall('fluids')
+        self.assertEquals(fsock.read(11), 'only fluids')
+
+    def test_read_returns_less_bytes_when_closed(self):
+        self.sock_one.sendall('only')
+        self.sock_one.close()
+
+        fsock = utils.FileLikeSocket(self.sock_two)
+        self.assertEquals(fsock.read(10), 'only')
+
     def test_write(self):
         fsock = utils.FileLikeSocket(self.sock_one)
         fsock.write('foo')
@@ -53,6 +53,37 @@ class SetupPipeTests(mocker.MockerTestCase):
         # so, testing its type actualy means nothing.
         self.assertEqual(len(result), 4)
 
+    def test_transform_uses_the_checkin_analysis(self):
+        data = "<root><issn pub-type='epub'>0102-6720</issn></root>"
+
+        scieloapi = ScieloAPIClientStub()
+        scieloapi.issues.filter = lambda **kwargs: [{}]
+
+        def _pkg_analyzer(filepath):
+            raise AssertionError('the package must not be read again')
+
+        attempt = AttemptStub()
+        attempt.analysis = PackageAnalyzerStub()
+
+        vpipe = self._makeOne(data, _scieloapi=scieloapi, _pkg_analyzer=_pkg_analyzer)
+        vpipe._notifier = lambda a, b: NotifierStub()
+        result = vpipe.transform(attempt)
+
+        self.assertIs(result[1], attempt.analysis)
+
+    def test_transform_keeps_the_locked_package(self):
+        data = "<root><issn pub-type='epub'>0102-6720</issn></root>"
+
+        scieloapi = ScieloAPIClientStub()
+        scieloapi.issues.filter = lambda **kwargs: [{}]
+
+        attempt = AttemptStub()
+        vpipe = self._makeOne(data, _scieloapi=scieloapi)
+        vpipe._notifier = lambda a, b: NotifierStub()
+        result = vpipe.transform(attempt)
+
+        self.assertIs(attempt.analysis, result[1])
+
     def test_fetch_journal_data_with_valid_criteria(self):
         """
         Valid criteria means a valid querystring param.
@@ -102,6 +133,22 @@ class SetupPipeTests(mocker.MockerTestCase):
         self.assertEqual(vpipe._fetch_journal_and_issue_data(print_issn='0100-879X', **{'volume': '30', 'number': '4'}),
                          {'foo': 'bar'})
 
+    def test_fetch_journal_issue_data_from_issue_cache(self):
+        from balaio import cache
+        data = "<root><issn pub-type='epub'>0102-6720</issn></root>"
+        fetched = []
+        scieloapi = ScieloAPIClientStub()
+        scieloapi.issues.filter = lambda **kwargs: fetched.append(kwargs) or [{'foo': 'bar'}]
+
+        vpipe = self._makeOne(data, _scieloapi=scieloapi)
+        vpipe._issue_cache = cache.CoalescingCache()
+
+        for i in range(2):
+            self.assertEqual(vpipe._fetch_journal_and_issue_data(print_issn='0100-879X', **{'volume': '30', 'number': '4'}),
+                             {'foo': 'bar'})
+        self.assertEqual(len(fetched), 1)
+        self.assertEqual(vpipe._issue_cache.hits, 1)
+
     def test_fetch_journal_issue_data_with_unknown_issn_raises_ValueError(self):
         #FIXME
         data = "<root><issn pub-type='epub'>0102-6720</issn></root>"
@@ -169,6 +216,103 @@ class SetupPipeTests(mocker.MockerTestCase):
         result = vpipe.transform(stub_attempt)
 
 
+class TeardownFailedTests(unittest.TestCase):
+
+    def test_transaction_is_aborted_and_perms_are_restored(self):
+        calls = []
+        attempt = AttemptStub()
+        attempt.analysis = PackageAnalyzerStub()
+        attempt.analysis.restore_perms = lambda: calls.append('restore_perms')
+
+        with Patch(validator.transaction, 'abort', lambda: calls.append('abort')):
+            validator.teardown_failed(attempt)
+
+        self.assertEqual(calls, ['abort', 'restore_perms'])
+
+    def test_attempts_without_analysis(self):
+        calls = []
+
+        with Patch(validator.transaction, 'abort', lambda: calls.append('abort')):
+            validator.teardown_failed(AttemptStub())
+
+        self.assertEqual(calls, ['abort'])
+
+
+class FindTextTests(unittest.TestCase):
+
+    def _makeTree(self, data):
+        from lxml import etree
+        return etree.ElementTree(etree.fromstring(data))
+
+    def test_text_of_the_first_match(self):
+        xml = self._makeTree('<root><article-id pub-id-type="doi">10.1590/1</article-id>'
+                             '<article-id pub-id-type="doi">10.1590/2</article-id></root>')
+        self.assertEqual(validator._findtext(validator.DOI, xml), '10.1590/1')
+
+    def test_missing_element(self):
+        xml = self._makeTree('<root><article-id pub-id-type="other">foo</article-id></root>')
+        self.assertIsNone(validator._findtext(validator.DOI, xml))
+
+    def test_empty_element(self):
+        xml = self._makeTree('<root><article-id pub-id-type="doi"/></root>')
+        self.assertEqual(validator._findtext(validator.DOI, xml), '')
+
+
+class GetReferenceIndexTests(unittest.TestCase):
+
+    def _makePkgAnalyzerWithData(self, data):
+        pkg_analyzer_stub = PackageAnalyzerStub()
+        pkg_analyzer_stub._xml_string = data
+        return pkg_analyzer_stub
+
+    def test_one_entry_per_reference(self):
+        data = '''
+            <root>
+              <ref-list>
+                <ref id="B1">
+                  <element-citation publication-type="journal">
+                    <article-title>Title</article-title>
+                    <source>Palaeontology</source>
+                    <year>2006</year>
+                  </element-citation>
+                </ref>
+                <ref id="B2">
+                  <element-citation publication-type="book">
+                    <article-title>Title</article-title>
+                    <source></source>
+                  </element-citation>
+                </ref>
+              </ref-list>
+            </root>'''
+        pkg_analyzer = self._makePkgAnalyzerWithData(data)
+
+        self.assertEqual(validator.get_reference_index(pkg_analyzer), [
+            validator.Reference('B1', 'Palaeontology', '2006', 'Title'),
+            validator.Reference('B2', None, None, None),
+        ])
+
+    def test_references_without_id(self):
+        pkg_analyzer = self._makePkgAnalyzerWithData(
+            '<root><ref-list><ref><source>S</source></ref></ref-list></root>')
+
+        self.assertEqual(validator.get_reference_index(pkg_analyzer), [
+            validator.Reference('', 'S', None, None),
+        ])
+
+    def test_missing_references(self):
+        pkg_analyzer = self._makePkgAnalyzerWithData('<root></root>')
+
+        self.assertEqual(validator.get_reference_index(pkg_analyzer), [])
+
+    def test_index_is_memoized_on_the_analyzer(self):
+        pkg_analyzer = self._makePkgAnalyzerWithData(
+            '<root><ref-list><ref id="B1"><source>S</source></ref></ref-list></root>')
+        index = validator.get_reference_index(pkg_analyzer)
+
+        pkg_analyzer._xml_string = '<root></root>'
+        self.assertIs(validator.get_reference_index(pkg_analyzer), index)
+
+
 class ReferenceSourceValidationTests(unittest.TestCase):
 
     def _makeOne(self, data, **kwargs):
@@ -204,6 +348,22 @@ class ReferenceSourceValidationTests(unittest.TestCase):
         self.assertEquals(
             vpipe.validate([None, pkg_analyzer_stub, None]), expected)
 
+    def test_references_without_id_missing_tag_source(self):
+        expected = [models.Status.error, 'Missing data: source. (B1, )']
+        data = '''
+            <root>
+              <ref-list>
+                <ref id="B1"><element-citation publication-type="journal"/></ref>
+                <ref><element-citation publication-type="journal"/></ref>
+              </ref-list>
+            </root>'''
+
+        vpipe = self._makeOne(data)
+        pkg_analyzer_stub = self._makePkgAnalyzerWithData(data)
+
+        self.assertEquals(
+            vpipe.validate([None, pkg_analyzer_stub, None]), expected)
+
     def test_reference_list_missing_tag_source(self):
         expected = [models.Status.error, 'Missing data: source. (B23)']
         data = '''
@@ -822,7 +982,7 @@ class FundingGroupValidationPipeTests(mocker.MockerTestCase):
                          vpipe.validate(data))
 
     def test_no_funding_group_and_ack_has_no_number(self):
-        expected = [models.Status.ok, '<ack>acknowle<sub />dgements</ack>']
+        expected = [models.Status.ok, '<ack>acknowle<sub/>dgements</ack>']
         xml = '<root><ack>acknowle<sub/>dgements</ack></root>'
 
         stub_attempt = AttemptStub()
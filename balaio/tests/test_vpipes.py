@@ -53,3 +53,84 @@ class ValidationPipeTests(mocker.MockerTestCase):
         vpipe = self._makeOne([{'name': 'foo'}])
         self.assertRaises(NotImplementedError, lambda: vpipe.validate('foo'))
 
+
+
+class PipelineRunnerTests(unittest.TestCase):
+
+    def _make_pipeline_factory(self, output, fail_on=None):
+        class CollectPipe(vpipes.Pipe):
+            def transform(self, data):
+                if data == fail_on:
+                    raise ValueError(data)
+                output.put(data)
+                return data
+
+        return lambda: vpipes.Pipeline(CollectPipe())
+
+    def _drain(self, output):
+        items = []
+        while not output.empty():
+            items.append(output.get())
+        return sorted(items)
+
+    def test_unknown_mode_raises_ValueError(self):
+        self.assertRaises(ValueError,
+            lambda: vpipes.PipelineRunner(lambda: None, mode='foo'))
+
+    def test_all_messages_are_processed_on_threads(self):
+        import Queue
+        output = Queue.Queue()
+        runner = vpipes.PipelineRunner(self._make_pipeline_factory(output), workers=4)
+        runner.run(range(100))
+
+        self.assertEqual(self._drain(output), range(100))
+
+    def test_all_messages_are_processed_on_processes(self):
+        import multiprocessing
+        output = multiprocessing.Queue()
+        runner = vpipes.PipelineRunner(self._make_pipeline_factory(output),
+                                       workers=2, mode='processes')
+        runner.run(range(10))
+
+        self.assertEqual(sorted(output.get(timeout=5) for i in range(10)), range(10))
+
+    def test_workers_survive_pipeline_errors(self):
+        import Queue
+        output = Queue.Queue()
+        runner = vpipes.PipelineRunner(self._make_pipeline_factory(output, fail_on=5))
+        runner.run(range(10))
+
+        self.assertEqual(self._drain(output), [0, 1, 2, 3, 4, 6, 7, 8, 9])
+
+    def test_failed_messages_are_torn_down(self):
+        import Queue
+        output = Queue.Queue()
+        torn_down = []
+        runner = vpipes.PipelineRunner(self._make_pipeline_factory(output, fail_on=5),
+            teardown=torn_down.append)
+        runner.run(range(10))
+
+        self.assertEqual(torn_down, [5])
+        self.assertEqual(self._drain(output), [0, 1, 2, 3, 4, 6, 7, 8, 9])
+
+    def test_workers_survive_teardown_errors(self):
+        import Queue
+        output = Queue.Queue()
+        def teardown(message):
+            raise RuntimeError(message)
+
+        runner = vpipes.PipelineRunner(self._make_pipeline_factory(output, fail_on=5),
+            teardown=teardown)
+        runner.run(range(10))
+
+        self.assertEqual(self._drain(output), [0, 1, 2, 3, 4, 6, 7, 8, 9])
+
+    def test_initializer_is_called_by_each_worker(self):
+        import Queue
+        output = Queue.Queue()
+        calls = []
+        runner = vpipes.PipelineRunner(self._make_pipeline_factory(output),
+            workers=3, initializer=lambda: calls.append(1))
+        runner.run([])
+
+        self.assertEqual(len(calls), 3)
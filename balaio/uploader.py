@@ -1,8 +1,35 @@
 # coding:utf-8
+import os
 import imp
 import sys
+import errno
+import shutil
+import hashlib
+import datetime
+import posixpath
+import tempfile
+import stat
+import time
+import Queue
+import logging
+import threading
+from collections import namedtuple
+from contextlib import contextmanager
 
-from balaio import utils
+try:
+    from sendfile import sendfile
+except ImportError:
+    sendfile = None
+
+from sqlalchemy.exc import SQLAlchemyError
+
+from balaio import utils, models
+
+
+logger = logging.getLogger('balaio.uploader')
+
+# the outcome of each file of :meth:`BlobBackend.send_many`.
+SentFile = namedtuple('SentFile', 'path resource_uri elapsed error')
 
 
 def load_module(name):
@@ -84,6 +111,81 @@ class BlobBackend(object):
     def __exit__(self, exc_type, exc_value, traceback):
         self.cleanup()
 
+    def send(self, fp, path):
+        """
+        Stores the contents of `fp` at `path`, and returns its resource uri.
+        """
+        raise NotImplementedError()
+
+    def send_many(self, items, workers=4):
+        """
+        Sends many files concurrently.
+
+        Files given by their filepaths are opened only when they are
+        sent, and are streamed instead of read whole.
+
+        :param items: iterable of (fp, path) pairs, where `fp` is a file
+        object or a filepath.
+        :param workers: (optional) number of concurrent transfers.
+        :returns: list of :class:`SentFile`, in the order of `items`.
+        Failed transfers have their `error` set.
+        """
+        jobs = Queue.Queue()
+        for job in enumerate(items):
+            jobs.put(job)
+
+        results = [None] * jobs.qsize()
+
+        def work():
+            while True:
+                try:
+                    i, (fp, path) = jobs.get_nowait()
+                except Queue.Empty:
+                    return
+                results[i] = self._send_file(fp, path)
+
+        threads = [threading.Thread(target=work) for i in range(min(workers, len(results)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        return results
+
+    def _send_file(self, fp, path):
+        started = time.time()
+        try:
+            if isinstance(fp, basestring):
+                with open(fp, 'rb') as f:
+                    resource_uri = self._send_concurrently(f, path)
+            else:
+                resource_uri = self._send_concurrently(fp, path)
+        except Exception as e:
+            logger.error('Failed to send %s: %s' % (path, e))
+            return SentFile(path, None, time.time() - started, e)
+
+        return SentFile(path, resource_uri, time.time() - started, None)
+
+    def _get_resource_uri(self, path):
+        """
+        Produces a publicly accessible URL do `path`, under `base_url`.
+        """
+        base_url = self.base_url
+        if not base_url.endswith(u'/'):
+            base_url += u'/'
+
+        if path.startswith(u'/'):
+            path = path[1:]
+
+        return base_url + path
+
+    def _send_concurrently(self, fp, path):
+        """
+        Sends a file of :meth:`send_many`. Backends whose :meth:`send`
+        is not thread-safe must override it.
+        """
+        return self.send(fp, path)
+
     @classmethod
     def enabled(cls):
         """
@@ -92,60 +194,538 @@ class BlobBackend(object):
         return all(cls._modules.values())
 
 
+def file_checksum(fp, chunk_size=64*1024):
+    """
+    Returns a tuple (sha1 hexdigest, size) of the contents of `fp`.
+
+    The file is read in chunks, and rewound to its current position.
+    """
+    start = fp.tell()
+    digest = hashlib.sha1()
+    size = 0
+
+    for chunk in iter(lambda: fp.read(chunk_size), ''):
+        digest.update(chunk)
+        size += len(chunk)
+
+    fp.seek(start)
+    return digest.hexdigest(), size
+
+
+class AssetManifest(object):
+    """
+    Records the files stored at each remote host, by the checksum of
+    their contents, so unchanged files are not sent again.
+
+    :param Session: (optional) Session class not bound to the transaction
+    manager, as the records are committed on their own.
+    """
+    def __init__(self, Session=models.CacheSession):
+        self.Session = Session
+
+    def get(self, host, path):
+        """
+        Returns the :class:`models.UploadedAsset` stored at `path`, or ``None``.
+        """
+        session = self.Session()
+        try:
+            return session.query(models.UploadedAsset).filter_by(host=host, path=path).first()
+        finally:
+            session.close()
+
+    def find(self, host, checksum):
+        """
+        Returns a :class:`models.UploadedAsset` with the contents of
+        `checksum` that is not a link, or ``None``.
+        """
+        session = self.Session()
+        try:
+            return session.query(models.UploadedAsset).filter_by(
+                host=host, checksum=checksum, link_target=None).first()
+        finally:
+            session.close()
+
+    def links_to(self, host, path):
+        """
+        Returns the list of :class:`models.UploadedAsset` linked to `path`.
+        """
+        session = self.Session()
+        try:
+            return session.query(models.UploadedAsset).filter_by(
+                host=host, link_target=path).order_by(models.UploadedAsset.id).all()
+        finally:
+            session.close()
+
+    def record(self, host, path, checksum, size, link_target=None):
+        """
+        Records that the contents of `checksum` are stored at `path`.
+        """
+        session = self.Session()
+        try:
+            asset = session.query(models.UploadedAsset).filter_by(host=host, path=path).first()
+            if asset is None:
+                asset = models.UploadedAsset(host=host, path=path)
+                session.add(asset)
+            asset.checksum = checksum
+            asset.size = size
+            asset.link_target = link_target
+            asset.uploaded_at = datetime.datetime.now()
+            session.commit()
+        except SQLAlchemyError as e:
+            # the file will be sent again next time.
+            session.rollback()
+            logger.error('Could not record the upload of %s:%s: %s' % (host, path, e))
+        finally:
+            session.close()
+
+    def move_links(self, host, path, new_target):
+        """
+        Records that the contents of `path` were moved to `new_target`,
+        that was linked to it, and that the other links point to it now.
+        """
+        session = self.Session()
+        try:
+            query = session.query(models.UploadedAsset).filter_by(host=host)
+            query.filter_by(path=new_target).update({'link_target': None},
+                                                    synchronize_session=False)
+            query.filter_by(link_target=path).update({'link_target': new_target},
+                                                     synchronize_session=False)
+            session.commit()
+        except SQLAlchemyError:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+
+class PooledConnection(object):
+    """
+    A connection kept by :class:`ConnectionPool`.
+
+    :param transport: the underlying transport, that must implement `is_active`
+    and `close`.
+    :param channel: the object used to talk to the remote host, e.g. an SFTP client.
+    :param known_dirs: (optional) set of remote directories known to exist.
+    """
+    def __init__(self, transport, channel, known_dirs=None, clock=time.time):
+        self.transport = transport
+        self.channel = channel
+        self.known_dirs = known_dirs if known_dirs is not None else set()
+        self.last_used = clock()
+
+    def close(self):
+        try:
+            self.transport.close()
+        except Exception as e:
+            logger.debug('Error while closing a connection: %s' % e)
+
+
+class ConnectionPool(object):
+    """
+    Thread-safe pool of connections to a remote host.
+
+    Connections are reused in LIFO order, so the warmest ones are handed
+    out first and the others are evicted after `max_idle` seconds.
+
+    :param factory: callable that returns a new :class:`PooledConnection`.
+    :param maxsize: (optional) max number of open connections.
+    :param max_idle: (optional) seconds an unused connection is kept open.
+    :param check_after: (optional) seconds of inactivity after which a
+    connection is checked with `health_check` before being reused.
+    :param health_check: (optional) callable that receives a :class:`PooledConnection`
+    and raises if it is not usable anymore.
+    :param clock: (optional) callable that returns the current time.
+    """
+    def __init__(self, factory, maxsize=4, max_idle=300, check_after=30,
+                 health_check=None, clock=time.time):
+        self.factory = factory
+        self.maxsize = maxsize
+        self.max_idle = max_idle
+        self.check_after = check_after
+        self.health_check = health_check
+        self._clock = clock
+
+        self._idle = []
+        self._size = 0
+        self._cond = threading.Condition(threading.Lock())
+
+        self.created = 0
+        self.reused = 0
+        self.evicted = 0
+
+    def acquire(self, timeout=None):
+        """
+        Returns a connection, creating one if none is idle and the pool
+        is not full. Otherwise waits for a connection to be released.
+
+        :param timeout: (optional) seconds to wait for a connection.
+        :raises RuntimeError: if no connection is available after `timeout` seconds.
+        """
+        deadline = self._clock() + timeout if timeout is not None else None
+
+        with self._cond:
+            while True:
+                self._evict_idle()
+
+                if self._idle:
+                    conn = self._idle.pop()
+                    break
+
+                if self._size < self.maxsize:
+                    conn = None
+                    self._size += 1
+                    break
+
+                remaining = deadline - self._clock() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    raise RuntimeError('No connection available after %s seconds' % timeout)
+                self._cond.wait(remaining)
+
+        # connecting and checking are done out of the lock.
+        if conn is not None and self._is_healthy(conn):
+            self.reused += 1
+            return conn
+
+        if conn is not None:
+            conn.close()
+
+        try:
+            conn = self.factory()
+        except Exception:
+            self._discarded()
+            raise
+
+        self.created += 1
+        return conn
+
+    def release(self, conn, discard=False):
+        """
+        Returns `conn` to the pool.
+
+        :param discard: (optional) closes the connection instead, e.g.
+        when it failed while in use.
+        """
+        if discard or not conn.transport.is_active():
+            conn.close()
+            self._discarded()
+            return None
+
+        conn.last_used = self._clock()
+        with self._cond:
+            self._idle.append(conn)
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self, timeout=None):
+        """
+        Context manager that acquires a connection and releases it at the end.
+        The connection is discarded if an exception is raised.
+        """
+        conn = self.acquire(timeout=timeout)
+        try:
+            yield conn
+        except Exception:
+            self.release(conn, discard=True)
+            raise
+        else:
+            self.release(conn)
+
+    def evict_idle(self):
+        """
+        Closes the connections unused for more than `max_idle` seconds.
+        """
+        with self._cond:
+            self._evict_idle()
+
+    def close(self):
+        """
+        Closes all idle connections.
+        """
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+            self._cond.notify_all()
+
+        for conn in idle:
+            conn.close()
+
+    def stats(self):
+        return {
+            'size': self._size,
+            'idle': len(self._idle),
+            'created': self.created,
+            'reused': self.reused,
+            'evicted': self.evicted,
+        }
+
+    def _evict_idle(self):
+        # must be called with the lock held. The oldest connections are
+        # at the beginning of the list.
+        now = self._clock()
+        while self._idle and now - self._idle[0].last_used > self.max_idle:
+            conn = self._idle.pop(0)
+            conn.close()
+            self._size -= 1
+            self.evicted += 1
+
+    def _is_healthy(self, conn):
+        if not conn.transport.is_active():
+            return False
+
+        if self.health_check is not None and self._clock() - conn.last_used > self.check_after:
+            try:
+                self.health_check(conn)
+            except Exception as e:
+                logger.info('Discarding a broken connection: %s' % e)
+                return False
+
+        return True
+
+    def _discarded(self):
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+
 ####
 # Custom backends
 ####
 class StaticScieloBackend(BlobBackend):
     """
     Stores data in static.scielo.org.
+
+    SFTP connections are kept open in a :class:`ConnectionPool`, shared
+    by the backends with the same connection settings. Within the
+    context manager a single connection is used, otherwise each call
+    to :meth:`send` borrows one from the pool, so concurrent calls
+    reuse the open connections. :meth:`send_many` transfers over up to
+    `pool_size` connections at once.
+
+    Each connection remembers the remote directories it has created or
+    seen, so the parent directories of an asset are created only once.
+
+    With an :class:`AssetManifest`, files whose contents are already
+    stored at the same path are not sent again, and files with the same
+    contents of another one are stored as symlinks to it.
+
+    :param pool: (optional) instance of :class:`ConnectionPool`.
+    :param pool_size: (optional) max number of open connections.
+    :param keepalive: (optional) seconds between keepalive packets.
+    :param max_idle: (optional) seconds an unused connection is kept open.
+    :param acquire_timeout: (optional) seconds to wait for a connection
+    when all of them are in use, e.g. when `pool_size` threads within the
+    context manager call :meth:`send_many`, which would wait forever.
+    :param list_basepath: (optional) if the directories under `basepath`
+    are listed when a connection is opened, to know them in advance.
+    :param manifest: (optional) instance of :class:`AssetManifest`.
+    :param link_duplicates: (optional) if files with the same contents of
+    another one are stored as symlinks. Otherwise only the unchanged
+    files are skipped.
     """
     requires = ['paramiko']
     base_url = u'http://static.scielo.org/'
 
-    def __init__(self, username, password, basepath, host=None, port=None):
+    _pools = {}
+    _pools_lock = threading.Lock()
+
+    def __init__(self, username, password, basepath, host=None, port=None,
+                 pool=None, pool_size=4, keepalive=30, max_idle=300, acquire_timeout=60,
+                 list_basepath=False, manifest=None, link_duplicates=True):
         self.username = username
         self.password = password
         self.basepath = basepath
         self.host = host or u'static.scielo.org'
         self.port = port or 22
+        self.keepalive = keepalive
+        self.acquire_timeout = acquire_timeout
+        self.list_basepath = list_basepath
+        self.manifest = manifest
+        self.link_duplicates = link_duplicates
         self.sftp = None
-
-    def connect(self):
+        self._connection = None
+
+        if pool is None:
+            # the pool connects with the settings of its first backend.
+            key = (self.host, self.port, self.username, self.password, self.basepath,
+                   self.keepalive, self.list_basepath)
+            with self._pools_lock:
+                pool = self._pools.get(key)
+                if pool is None:
+                    pool = self._pools[key] = ConnectionPool(self._connect,
+                        maxsize=pool_size, max_idle=max_idle, check_after=keepalive,
+                        health_check=self._health_check)
+        self.pool = pool
+
+    def _connect(self):
+        """
+        Opens a new SFTP connection.
+        """
         paramiko = self._modules['paramiko']
 
-        self.transport = paramiko.Transport((self.host, self.port))
+        transport = paramiko.Transport((self.host, self.port))
+        try:
+            #raises paramiko.SSHException
+            transport.connect(username=self.username, password=self.password)
+            transport.set_keepalive(self.keepalive)
+            sftp = paramiko.SFTPClient.from_transport(transport)
+
+            # changes the current working directory to basepath
+            sftp.chdir(self.basepath)
+
+            known_dirs = self._list_known_dirs(sftp)
+        except Exception:
+            transport.close()
+            raise
+
+        return PooledConnection(transport, sftp, known_dirs=known_dirs)
+
+    def _list_known_dirs(self, sftp):
+        """
+        Returns the set of remote directories known to exist after the
+        connection is opened: `basepath`, its parents and, if `list_basepath`
+        is set, its subdirectories.
+        """
+        fq_basepath = self._get_fqpath(u'')
+
+        # the paths are normalized the same way `_ensure_parent_dir` does,
+        # even when `basepath` is the root.
+        known_dirs = set()
+        current_path = u'/'
+        for path_segment in fq_basepath.split(u'/'):
+            if path_segment:
+                current_path = posixpath.join(current_path, path_segment)
+                known_dirs.add(current_path)
+
+        if self.list_basepath:
+            for attr in sftp.listdir_attr(u'.'):
+                if stat.S_ISDIR(attr.st_mode):
+                    known_dirs.add(posixpath.join(fq_basepath, attr.filename))
+
+        return known_dirs
 
-        #raises paramiko.SSHException
-        self.transport.connect(username=self.username, password=self.password)
-        self.sftp = paramiko.SFTPClient.from_transport(self.transport)
+    def _health_check(self, conn):
+        # a cheap round trip to the server.
+        conn.channel.stat(u'.')
 
-        # changes the current working directory to basepath
-        self.sftp.chdir(self.basepath)
+    def connect(self):
+        """
+        Borrows a connection from the pool.
+        """
+        self._connection = self.pool.acquire(timeout=self.acquire_timeout)
+        self.transport = self._connection.transport
+        self.sftp = self._connection.channel
 
     def cleanup(self):
         """
-        Close the transport layer and rebind the sftp object.
+        Return the connection to the pool and rebind the sftp object.
         """
-        self.transport.close()
+        if self._connection is not None:
+            self.pool.release(self._connection)
+        self._connection = None
         self.sftp = None
 
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None and self._connection is not None:
+            # the connection may be in an unknown state.
+            self.pool.release(self._connection, discard=True)
+            self._connection = None
+        self.cleanup()
+
     def send(self, fp, path):
         """
         :param fp:
         :param path: Text string like /articles/foo/foo.pdf
         """
+        if self._connection is not None:
+            return self._send(self._connection, fp, path)
+
+        return self._send_concurrently(fp, path)
+
+    def _send_concurrently(self, fp, path):
+        # each transfer has its own connection, even within the
+        # context manager, as an SFTP channel is not shared by threads.
+        with self.pool.connection(timeout=self.acquire_timeout) as conn:
+            return self._send(conn, fp, path)
+
+    def _send(self, conn, fp, path):
         # get the full-qualified path, i.e:
         # '/art/foo.pdf' => '/var/static/art/foo.pdf'
         fqpath = self._get_fqpath(path)
 
         # make sure all expected parent directories exists
         # before start transfering `fp`.
-        self._ensure_parent_dir(fqpath)
+        self._ensure_parent_dir(fqpath, sftp=conn.channel, known_dirs=conn.known_dirs)
 
-        self.sftp.putfo(fp, fqpath, confirm=True)
+        if self.manifest is not None:
+            self._send_deduplicated(conn.channel, fp, fqpath)
+        else:
+            conn.channel.putfo(fp, fqpath, confirm=True)
 
         return self._get_resource_uri(path)
 
+    def _send_deduplicated(self, sftp, fp, fqpath):
+        try:
+            fp.tell()
+        except (AttributeError, IOError):
+            # the checksum is needed before sending, e.g. to avoid writing
+            # through a symlink, so streams are spooled first.
+            spooled = tempfile.SpooledTemporaryFile(max_size=8*1024*1024)
+            shutil.copyfileobj(fp, spooled, 64*1024)
+            spooled.seek(0)
+            fp = spooled
+
+        checksum, size = file_checksum(fp)
+
+        stored = self.manifest.get(self.host, fqpath)
+        if stored is not None:
+            if stored.checksum == checksum:
+                logger.debug('Skipping the unchanged file %s' % fqpath)
+                return None
+
+            if stored.link_target is None:
+                self._hand_over(sftp, fqpath)
+            else:
+                # writing to a symlink would change its target.
+                sftp.remove(fqpath)
+
+        original = self.manifest.find(self.host, checksum) if self.link_duplicates else None
+        if original is not None and original.path != fqpath:
+            try:
+                sftp.remove(fqpath)
+            except IOError:
+                pass # the file does not exist
+            sftp.symlink(self._link_target(original.path, fqpath), fqpath)
+            self.manifest.record(self.host, fqpath, checksum, size, link_target=original.path)
+        else:
+            sftp.putfo(fp, fqpath, confirm=True)
+            self.manifest.record(self.host, fqpath, checksum, size)
+
+    def _hand_over(self, sftp, fqpath):
+        """
+        Moves the contents of `fqpath`, that is about to be replaced, to
+        the first file linked to it, and relinks the others to that one.
+        """
+        links = self.manifest.links_to(self.host, fqpath)
+        if not links:
+            return None
+
+        heir = links[0]
+        sftp.remove(heir.path)
+        sftp.rename(fqpath, heir.path)
+        for link in links[1:]:
+            sftp.remove(link.path)
+            sftp.symlink(self._link_target(heir.path, link.path), link.path)
+
+        self.manifest.move_links(self.host, fqpath, heir.path)
+
+    def _link_target(self, target, fqpath):
+        """
+        Path of `target` relative to the directory of the link at `fqpath`.
+        The SFTP paths may not exist for the web server, e.g. on chrooted
+        accounts, so links are relative.
+        """
+        return posixpath.relpath(target, posixpath.dirname(fqpath))
+
     def _get_fqpath(self, path):
         """
         Get the full-qualified path for `path`.
@@ -161,38 +741,171 @@ class StaticScieloBackend(BlobBackend):
 
         return fqpath
 
-    def _ensure_parent_dir(self, fqpath):
+    def _ensure_parent_dir(self, fqpath, sftp=None, known_dirs=None):
         """
         Ensure all parent dirs of `fqpath` exists.
 
-        TODO: This method should be optimized for cases where the
-        basedir already exists.
+        :param sftp: (optional) SFTP client to be used instead of `self.sftp`.
+        :param known_dirs: (optional) set of directories known to exist.
+        It is updated with the directories created, and the known ones
+        are not created again.
         """
+        sftp = sftp or self.sftp
+        if known_dirs is None:
+            known_dirs = set()
+
         if fqpath.startswith('/'):
             fqpath = fqpath[1:]
 
         # only dirnames are required
         splitted_remote_path = fqpath.split('/')[:-1]
 
+        # usually the parent dir is known, and there is nothing to do.
+        if u'/' + u'/'.join(splitted_remote_path) in known_dirs:
+            return None
+
         current_path = u'/'
         for path_segment in splitted_remote_path:
             current_path += path_segment
-            try:
-                self.sftp.mkdir(current_path)
-            except IOError:
-                pass #assuming the directory already exists
+            if current_path not in known_dirs:
+                try:
+                    sftp.mkdir(current_path)
+                except IOError:
+                    pass #assuming the directory already exists
+                known_dirs.add(current_path)
             current_path += '/'
 
-    def _get_resource_uri(self, path):
+
+
+class FileSystemBackend(BlobBackend):
+    """
+    Stores data in a local directory, e.g. for staging or to exercise
+    the checkout without a remote host.
+
+    Files are written to a temporary file in the destination directory,
+    and renamed into place, so readers never see partial files. Files on
+    the same filesystem are hardlinked instead of copied, and the others
+    are copied with `sendfile` if the optional `pysendfile` package is
+    installed (the ``sendfile`` extra), or read and written otherwise.
+
+    :param basepath: the directory where files are stored.
+    :param base_url: (optional) URL where `basepath` is published.
+    Defaults to a file URL of `basepath`.
+    :param hardlink: (optional) if files are hardlinked when possible.
+    A hardlinked file changes if its source is modified in place, and
+    shares its mode, so only world-readable sources are hardlinked.
+    """
+    def __init__(self, basepath, base_url=None, hardlink=True):
+        self.basepath = os.path.abspath(basepath)
+        self.base_url = base_url or u'file://' + self.basepath
+        self.hardlink = hardlink
+
+    def connect(self):
+        pass
+
+    def cleanup(self):
+        pass
+
+    def send(self, fp, path):
         """
-        Produces a publicly accessible URL do `path`.
+        :param fp: a file object.
+        :param path: Text string like /articles/foo/foo.pdf
         """
-        base_url = self.base_url
-        if not base_url.endswith(u'/'):
-            base_url += u'/'
+        fqpath = self._get_fqpath(path)
+        parent_dir = os.path.dirname(fqpath)
+
+        try:
+            os.makedirs(parent_dir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        if self.hardlink and self._link(fp, fqpath):
+            return self._get_resource_uri(path)
+
+        fd, tmp_path = tempfile.mkstemp(dir=parent_dir, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as dest:
+                self._copy(fp, dest)
+            os.chmod(tmp_path, 0644)
+            os.rename(tmp_path, fqpath)
+        except Exception:
+            os.remove(tmp_path)
+            raise
 
-        if path.startswith(u'/'):
-            path = path[1:]
+        return self._get_resource_uri(path)
 
-        return base_url + path
+    def _link(self, fp, fqpath):
+        """
+        Hardlinks the file of `fp` at `fqpath`. Returns ``False`` if it
+        is not possible, e.g. `fp` is not a whole file on the same filesystem,
+        or is not world-readable, e.g. a temporary file created with mode 0600.
+        """
+        source = getattr(fp, 'name', None)
+        if not isinstance(source, basestring):
+            return False
+
+        try:
+            mode = os.stat(source).st_mode
+        except OSError:
+            return False
+
+        if not stat.S_ISREG(mode) or not mode & stat.S_IROTH:
+            return False
+
+        try:
+            if fp.tell() != 0:
+                return False
+        except (AttributeError, IOError):
+            return False
+
+        tmp_path = os.path.join(os.path.dirname(fqpath),
+                                '.tmp-%s-%s-%s' % (os.getpid(), threading.current_thread().ident,
+                                                    os.path.basename(fqpath)))
+        try:
+            os.link(source, tmp_path)
+        except OSError as e:
+            # e.g. EXDEV for other filesystems.
+            logger.debug('Could not hardlink %s: %s' % (source, e))
+            return False
+
+        try:
+            os.rename(tmp_path, fqpath)
+        except OSError:
+            os.remove(tmp_path)
+            raise
+
+        return True
+
+    def _copy(self, fp, dest):
+        try:
+            in_fd = fp.fileno()
+            offset = fp.tell()
+        except (AttributeError, IOError):
+            in_fd = None
+
+        if sendfile is not None and in_fd is not None:
+            # the kernel copies the data, without reading it to user space.
+            dest.flush()
+            out_fd = dest.fileno()
+            remaining = os.fstat(in_fd).st_size - offset
+            while remaining > 0:
+                sent = sendfile(out_fd, in_fd, offset, remaining)
+                if sent == 0:
+                    break
+                offset += sent
+                remaining -= sent
+            fp.seek(offset)
+        else:
+            shutil.copyfileobj(fp, dest, 64*1024)
 
+    def _get_fqpath(self, path):
+        """
+        Get the full-qualified path for `path`, that must be within `basepath`.
+        """
+        fqpath = os.path.normpath(os.path.join(self.basepath, path.lstrip(u'/')))
+        # a trailing separator, unless `basepath` is the root directory.
+        if not fqpath.startswith(os.path.join(self.basepath, u'')):
+            raise ValueError('%s is outside of %s' % (path, self.basepath))
+
+        return fqpath
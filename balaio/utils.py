@@ -3,11 +3,14 @@ import hmac
 import types
 import weakref
 import hashlib
+import struct
 import requests
 import threading
 import logging, logging.handlers
 from ConfigParser import SafeConfigParser
 import socket
+import select
+import errno
 
 try:
     import cPickle as pickle
@@ -31,6 +34,14 @@ stdin_lock = threading.Lock()
 # already defined a logger handler.
 has_logger = False
 
+# Messages are framed by a fixed-size binary header comprised of
+# the digest of the serialized data, followed by its length as an
+# unsigned int in network byte order.
+MESSAGE_HEADER = struct.Struct('!40sI')
+
+# Bytes added to each message by the framing layer.
+MESSAGE_OVERHEAD = MESSAGE_HEADER.size
+
 
 class SingletonMixin(object):
     """
@@ -108,18 +119,19 @@ def alembic_config_from_env():
     return Configuration.from_file(filepath)
 
 
-def make_digest(message, secret='sekretz'):
+def make_digest(message, secret='sekretz', chunk_size=65536):
     """
     Returns a digest for the message based on the given secret
 
     ``message`` is the file object or byte string to be calculated
     ``secret`` is a shared key used by the hash algorithm
+    ``chunk_size`` is the size of the reads from file objects
     """
     hash = hmac.new(secret, '', hashlib.sha1)
 
     if hasattr(message, 'read'):
         while True:
-            chunk = message.read(1024)
+            chunk = message.read(chunk_size)
             if not chunk:
                 break
             hash.update(chunk)
@@ -152,6 +164,9 @@ def send_message(stream, message, digest, pickle_dep=pickle):
     Writes to stream are synchronized in order to keep data
     integrity.
 
+    Each message is preceded by a header of :data:`MESSAGE_OVERHEAD`
+    bytes. See :data:`MESSAGE_HEADER`.
+
     ``stream`` is a writable socket, pipe, buffer of something like that.
     ``message`` is the object to be dispatched.
     ``digest`` is a callable that generates a hash in order to avoid
@@ -165,16 +180,18 @@ def send_message(stream, message, digest, pickle_dep=pickle):
 
     serialized = pickle_dep.dumps(message, pickle_dep.HIGHEST_PROTOCOL)
     data_digest = digest(serialized)
-    header = '%s %s\n' % (data_digest, len(serialized))
+    header = MESSAGE_HEADER.pack(data_digest, len(serialized))
 
     with stdout_lock:
         logger.debug('Stream %s is locked' % stream)
-        stream.write(header)
-        stream.write(serialized)
+        # a single write per message avoids the header and the
+        # data being sent in separate packets.
+        stream.write(header + serialized)
         stream.flush()
 
     logger.debug('Stream %s is unlocked' % stream)
-    logger.debug('Message sent with header: %s' % header)
+    logger.debug('Message sent with digest %s: %s bytes (%s bytes of framing overhead)' % (
+        data_digest, len(serialized), MESSAGE_OVERHEAD))
 
 
 def recv_messages(stream, digest, pickle_dep=pickle):
@@ -184,6 +201,10 @@ def recv_messages(stream, digest, pickle_dep=pickle):
     When the stream is exhausted the iterator stops, raising
     StopIteration.
 
+    If ``stream`` is a listening socket, connections from many producers
+    are accepted and their messages are merged into the same iterator,
+    which never gets exhausted. See :func:`recv_multiplexed_messages`.
+
     ``stream`` is a readable socket, pipe, buffer of something like that.
     ``digest`` is a callable that generates a hash in order to avoid
     data transmission corruptions.
@@ -195,33 +216,171 @@ def recv_messages(stream, digest, pickle_dep=pickle):
     # check if stream is a socket, and adapt it to
     # be handled as a file-object
     if hasattr(stream, 'getsockname'):
-        try:
-            stream, _ = stream.accept()
-        except socket.error:
-            logger.debug('%s stream is not listening. Trying to read it anyway.' % stream)
+        if is_listening_socket(stream):
+            return recv_multiplexed_messages(stream, digest, pickle_dep=pickle_dep)
 
         stream = FileLikeSocket(stream)
 
+    return _recv_stream_messages(stream, digest, pickle_dep)
+
+
+def _recv_stream_messages(stream, digest, pickle_dep):
     while True:
         # locking to prevent the message frame from being
         # corrupted
         with stdin_lock:
-            header = stream.readline()
+            header = stream.read(MESSAGE_OVERHEAD)
             if not header:
                 raise StopIteration()
 
-            in_digest, in_length = header.split(' ')
-            in_message = stream.read(int(in_length))
+            if len(header) < MESSAGE_OVERHEAD:
+                logger.error('Received a truncated message header: %r' % header)
+                raise StopIteration()
+
+            in_digest, in_length = MESSAGE_HEADER.unpack(header)
+            in_message = stream.read(in_length)
 
-        logger.debug('Received message header: %s message: %s' % (header, in_message))
+        if len(in_message) < in_length:
+            logger.error('Received a truncated message. Expected %s bytes, got %s' % (
+                in_length, len(in_message)))
+            raise StopIteration()
+
+        logger.debug('Received message with digest %s: %s bytes' % (in_digest, in_length))
 
         if in_digest == digest(in_message):
             yield pickle_dep.loads(in_message)
         else:
-            logger.error('Received a corrupted message: %s, %s' % (header, in_message))
+            logger.error('Received a corrupted message: %s, %r' % (in_digest, in_message))
             continue
 
 
+def recv_multiplexed_messages(server_sock, digest, pickle_dep=pickle, bufsize=65536):
+    """
+    Returns an iterator that retrieves messages sent by all the clients
+    connected to ``server_sock``, on its deserialized form.
+
+    New connections are accepted at any time, and the data available
+    on each connection is read as it arrives, using epoll. Messages
+    are yielded in the order they are completely received.
+
+    ``server_sock`` is a listening socket.
+    ``digest`` is a callable that generates a hash in order to avoid
+    data transmission corruptions.
+    ``bufsize`` is the max amount of bytes read from a connection at once.
+    """
+    server_sock.setblocking(0)
+    server_fd = server_sock.fileno()
+
+    poller = select.epoll()
+    poller.register(server_fd, select.EPOLLIN)
+
+    # maps file descriptors to (connection, MessageReader)
+    connections = {}
+
+    try:
+        while True:
+            try:
+                events = poller.poll()
+            except IOError as e:
+                # poll is interrupted by signals.
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+
+            for fd, event in events:
+                if fd == server_fd:
+                    try:
+                        conn, _ = server_sock.accept()
+                    except socket.error as e:
+                        if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                            continue
+                        raise
+
+                    conn.setblocking(0)
+                    connections[conn.fileno()] = (conn, MessageReader(digest, pickle_dep))
+                    poller.register(conn.fileno(), select.EPOLLIN)
+                    logger.info('New producer connected. %s producers connected.' % len(connections))
+                    continue
+
+                conn, reader = connections[fd]
+                try:
+                    data = conn.recv(bufsize)
+                except socket.error as e:
+                    if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                        continue
+                    logger.error('Error reading from producer: %s' % e)
+                    data = ''
+
+                if data:
+                    reader.feed(data)
+                    for message in reader:
+                        yield message
+                else:
+                    poller.unregister(fd)
+                    conn.close()
+                    del connections[fd]
+
+                    if reader.pending:
+                        logger.error('Producer disconnected leaving %s bytes of a truncated message.' % reader.pending)
+                    logger.info('Producer disconnected. %s producers connected.' % len(connections))
+    finally:
+        for conn, _ in connections.values():
+            conn.close()
+        poller.close()
+
+
+class MessageReader(object):
+    """
+    Decodes messages framed by :func:`send_message` from
+    chunks of bytes, as they arrive.
+
+    Usage::
+
+        >>> reader = MessageReader(make_digest)
+        >>> reader.feed(data)
+        >>> for message in reader:
+        ...     print message
+
+    It is important to note that instances are not
+    thread-safe.
+    """
+    def __init__(self, digest, pickle_dep=pickle):
+        self.digest = digest
+        self.pickle = pickle_dep
+        self._buffer = bytearray()
+
+    @property
+    def pending(self):
+        """
+        Amount of bytes of incomplete messages.
+        """
+        return len(self._buffer)
+
+    def feed(self, data):
+        self._buffer.extend(data)
+
+    def __iter__(self):
+        """
+        Yields all messages completely received so far.
+        """
+        while len(self._buffer) >= MESSAGE_OVERHEAD:
+            in_digest, in_length = MESSAGE_HEADER.unpack_from(self._buffer)
+            frame_length = MESSAGE_OVERHEAD + in_length
+
+            if len(self._buffer) < frame_length:
+                break
+
+            in_message = str(self._buffer[MESSAGE_OVERHEAD:frame_length])
+            del self._buffer[:frame_length]
+
+            logger.debug('Received message with digest %s: %s bytes' % (in_digest, in_length))
+
+            if in_digest == self.digest(in_message):
+                yield self.pickle.loads(in_message)
+            else:
+                logger.error('Received a corrupted message: %s, %r' % (in_digest, in_message))
+
+
 def prefix_file(filename, prefix):
     """
     Renames ``filename`` adding the prefix ``prefix``.
@@ -266,9 +425,9 @@ def normalize_data(data):
     return ' '.join(data.upper().split())
 
 
-def is_valid_doi(doi):
+def get_doi_status(doi):
     """
-    Verify if the DOI is valid for CrossRef
+    Returns the HTTP status code of the DOI at CrossRef
     Validate URL: ``http://dx.doi.org/<DOI>``
     Raise any connection and timeout error
     """
@@ -279,7 +438,16 @@ def is_valid_doi(doi):
         logger.error('Can not validate doi: ' + str(e))
         raise
     else:
-        return req.status_code == 200
+        return req.status_code
+
+
+def is_valid_doi(doi):
+    """
+    Verify if the DOI is valid for CrossRef
+    Validate URL: ``http://dx.doi.org/<DOI>``
+    Raise any connection and timeout error
+    """
+    return get_doi_status(doi) == 200
 
 
 def validate_issn(issn):
@@ -423,25 +591,54 @@ class FileLikeSocket(object):
     This adapters are used on :func:`send_message` and
     :func:`recv_messages`.
 
+    Reads are buffered, and :meth:`read` only returns less
+    than the requested size if the socket is closed by the peer.
+
     It is important to note that instances are not
     thread-safe.
     """
-    def __init__(self, sock):
+    def __init__(self, sock, bufsize=65536):
         self.sock = sock
+        self.bufsize = bufsize
+        self._buffer = ''
+
+    def _fill_buffer(self):
+        """
+        Reads the next chunk of data from the socket into the buffer.
+        Returns False if the peer has closed the connection.
+        """
+        chunk = self.sock.recv(self.bufsize)
+        self._buffer += chunk
+        return bool(chunk)
 
     def readline(self):
-        chars = []
-        while True:
-            char = self.sock.recv(1)
-            if char != '\n':
-                chars.append(char)
-            else:
+        while '\n' not in self._buffer:
+            if not self._fill_buffer():
+                line, self._buffer = self._buffer, ''
+                return line
+
+        line, self._buffer = self._buffer.split('\n', 1)
+        return line
+
+    def read(self, size):
+        chunks = [self._buffer[:size]]
+        missing = size - len(chunks[0])
+        self._buffer = self._buffer[size:]
+
+        # partial reads are accumulated until the requested
+        # size is reached or the connection is closed.
+        while missing > 0:
+            chunk = self.sock.recv(max(missing, self.bufsize))
+            if not chunk:
                 break
 
-        return ''.join(chars)
+            if len(chunk) > missing:
+                chunk, self._buffer = chunk[:missing], chunk[missing:]
 
-    def read(self, len):
-        return self.sock.recv(len)
+            chunks.append(chunk)
+            missing -= len(chunk)
+
+        return ''.join(chunks)
 
     def write(self, bytes):
         self.sock.sendall(bytes)
@@ -461,6 +658,16 @@ def remove_unix_socket(sock_path):
             raise
 
 
+def is_listening_socket(sock):
+    """
+    Checks if ``sock`` is accepting connections.
+    """
+    try:
+        return bool(sock.getsockopt(socket.SOL_SOCKET, socket.SO_ACCEPTCONN))
+    except socket.error:
+        return False
+
+
 def get_readable_socket(sock_path, fresh=True):
     """
     Gets a new socket server.
@@ -2,11 +2,12 @@
 import re
 import sys
 import logging
-import xml.etree.ElementTree as etree
 import calendar
+from collections import namedtuple
 
 import scieloapi
 import transaction
+from lxml import etree
 
 import vpipes
 import utils
@@ -14,20 +15,107 @@ import checkin
 import notifier
 import scieloapitoolbelt
 import models
+import cache
 
 
 logger = logging.getLogger('balaio.validator')
 
 
+Reference = namedtuple('Reference', 'id source year article_title')
+
+# XPath expressions are compiled once, and evaluated against
+# the tree parsed by the PackageAnalyzer of each attempt.
+REFERENCES = etree.XPath('.//ref-list/ref')
+PUBLISHER_NAME = etree.XPath('.//journal-meta/publisher/publisher-name')
+ABBREV_JOURNAL_TITLE = etree.XPath('.//journal-meta/abbrev-journal-title[@abbrev-type="publisher"]')
+FUNDING_GROUP = etree.XPath('.//funding-group')
+ACK = etree.XPath('.//ack')
+NLM_JOURNAL_TITLE = etree.XPath('.//journal-meta/journal-id[@journal-id-type="nlm-ta"]')
+DOI = etree.XPath('.//article-id[@pub-id-type="doi"]')
+ARTICLE_SECTION = etree.XPath('.//article-categories/subj-group[@subj-group-type="heading"]/subject')
+PUB_DATES = etree.XPath('.//article-meta//pub-date')
+
+
+def _find(xpath, xml):
+    """
+    Returns the first element matched by `xpath`, or ``None``.
+    """
+    elements = xpath(xml)
+    return elements[0] if elements else None
+
+
+def _findtext(xpath, xml):
+    """
+    Returns the text of the first element matched by `xpath`, in the
+    same way of ``ElementTree.findtext``.
+    """
+    element = _find(xpath, xml)
+    if element is None:
+        return None
+    return element.text or ''
+
+
+def _index_reference(ref):
+    """
+    Extracts the data needed by the reference validations walking
+    through the `ref` element a single time.
+
+    Each value is the text of the first matching element, or ``None``
+    if it is missing or empty. The id is an empty string if missing, as
+    the ids are joined in the validation messages.
+    """
+    source = year = article_title = None
+    seen_source = seen_year = seen_article_title = False
+
+    # the tags are filtered by lxml, without visiting the other elements.
+    for elem in ref.iter('source', 'year', 'element-citation'):
+        if elem.tag == 'source' and not seen_source:
+            source, seen_source = elem.text, True
+        elif elem.tag == 'year' and not seen_year:
+            year, seen_year = elem.text, True
+        elif (elem.tag == 'element-citation' and not seen_article_title and
+              elem.get('publication-type') == 'journal'):
+            title_elem = elem.find('article-title')
+            if title_elem is not None:
+                article_title, seen_article_title = title_elem.text, True
+
+    return Reference(ref.get('id', ''), source, year, article_title)
+
+
+def get_reference_index(pkg_analyzer):
+    """
+    Returns a list of :class:`Reference`, one for each ``.//ref-list/ref``.
+
+    The index is built in a single pass over the references and
+    memoized on `pkg_analyzer`, so it is shared by all the reference
+    validation pipes of an attempt.
+
+    :param pkg_analyzer: instance of :class:`checkin.PackageAnalyzer`.
+    """
+    try:
+        return pkg_analyzer._reference_index
+    except AttributeError:
+        index = [_index_reference(ref) for ref in REFERENCES(pkg_analyzer.xml)]
+        pkg_analyzer._reference_index = index
+        return index
+
+
 class SetupPipe(vpipes.Pipe):
 
-    def __init__(self, notifier, scieloapi, sapi_tools, pkg_analyzer, issn_validator, Session):
+    def __init__(self, notifier, scieloapi, sapi_tools, pkg_analyzer, issn_validator, Session,
+                 issue_cache=None):
+        """
+        :param issue_cache: (optional) instance of :class:`cache.CoalescingCache`
+        shared by the pipelines, to avoid fetching the same issue data
+        for each article.
+        """
         self._notifier = notifier
         self._scieloapi = scieloapi
         self._sapi_tools = sapi_tools
         self._pkg_analyzer = pkg_analyzer
         self._issn_validator = issn_validator
         self.Session = Session
+        self._issue_cache = issue_cache
 
     def _fetch_journal_data(self, criteria):
         """
@@ -50,10 +138,18 @@ class SetupPipe(vpipes.Pipe):
         :param criteria: valid criteria to retrieve issue data
         :returns: data of one issue
         """
-        #cli.fetch_relations(cli.get(i['resource_uri']))
-        found_journal_issues = self._scieloapi.issues.filter(
-            limit=1, **criteria)
-        return self._scieloapi.fetch_relations(self._sapi_tools.get_one(found_journal_issues))
+        def fetch():
+            #cli.fetch_relations(cli.get(i['resource_uri']))
+            found_journal_issues = self._scieloapi.issues.filter(
+                limit=1, **criteria)
+            return self._scieloapi.fetch_relations(self._sapi_tools.get_one(found_journal_issues))
+
+        if self._issue_cache is None:
+            return fetch()
+
+        data = self._issue_cache.get(tuple(sorted(criteria.items())), fetch)
+        logger.debug('Issue data cache stats: %s' % self._issue_cache.stats())
+        return data
 
     @vpipes.precondition(vpipes.attempt_is_valid)
     def transform(self, attempt):
@@ -69,8 +165,11 @@ class SetupPipe(vpipes.Pipe):
 
         self._notifier(attempt, db_session).start()
 
-        pkg_analyzer = self._pkg_analyzer(attempt.filepath)
+        # the package is read again only if the checkin analysis is missing.
+        pkg_analyzer = attempt.analysis or self._pkg_analyzer(attempt.filepath)
         pkg_analyzer.lock_package()
+        # kept to restore the permissions if the pipeline raises.
+        attempt.analysis = pkg_analyzer
 
         criteria = {}
 
@@ -150,6 +249,24 @@ class TearDownPipe(vpipes.Pipe):
         logger.info('Finished validating %s' % attempt)
 
 
+def teardown_failed(attempt):
+    """
+    Releases what the pipeline holds for `attempt` when one of its pipes
+    raises, as :class:`TearDownPipe` is not reached.
+
+    The transaction is aborted, which closes the db session, and the
+    package permissions are restored.
+
+    :param attempt: the models.Attempt being validated.
+    """
+    transaction.abort()
+
+    if attempt.analysis is not None:
+        attempt.analysis.restore_perms()
+
+    logger.info('Gave up validating %s' % attempt)
+
+
 class PublisherNameValidationPipe(vpipes.ValidationPipe):
     """
     Validate the publisher name in article `.//journal-meta/publisher/publisher-name`,
@@ -171,8 +288,7 @@ class PublisherNameValidationPipe(vpipes.ValidationPipe):
         attempt, pkg_analyzer, journal_and_issue_data = item[:3]
         j_publisher_name = journal_and_issue_data.get('journal', {}).get('publisher_name', None)
         if j_publisher_name:
-            data = pkg_analyzer.xml
-            xml_publisher_name = data.findtext('.//journal-meta/publisher/publisher-name')
+            xml_publisher_name = _findtext(PUBLISHER_NAME, pkg_analyzer.xml)
 
             if xml_publisher_name:
                 if self._normalize_data(xml_publisher_name) == self._normalize_data(j_publisher_name):
@@ -201,7 +317,7 @@ class ReferenceValidationPipe(vpipes.ValidationPipe):
         The article may be a editorial why return a warning if no references
         """
         attempt, pkg_analyzer, journal_and_issue_data = item[:3]
-        refs = pkg_analyzer.xml.findall(".//ref-list/ref")
+        refs = get_reference_index(pkg_analyzer)
 
         if refs:
             return [models.Status.ok, 'Found ' + str(len(refs)) + ' references']
@@ -224,17 +340,11 @@ class ReferenceSourceValidationPipe(vpipes.ValidationPipe):
     def validate(self, item):
         lst_errors = []
         attempt, pkg_analyzer, journal_and_issue_data = item[:3]
-        refs = pkg_analyzer.xml.findall(".//ref-list/ref")
-
-        if refs:
-            for ref in refs:
-                source = ref.find(".//source")
+        refs = get_reference_index(pkg_analyzer)
 
-                if source is not None:
-                    if source.text is None:
-                        lst_errors.append(ref.attrib['id'])
-                else:
-                    lst_errors.append(ref.attrib['id'])
+        for ref in refs:
+            if ref.source is None:
+                lst_errors.append(ref.id)
 
         if lst_errors:
             msg_error = 'Missing data: source. (%s)' % ', '.join(lst_errors)
@@ -261,20 +371,13 @@ class ReferenceYearValidationPipe(vpipes.ValidationPipe):
         bad_data = []
 
         attempt, pkg_analyzer, journal_and_issue_data = item[:3]
-        refs = pkg_analyzer.xml.findall(".//ref-list/ref")
+        refs = get_reference_index(pkg_analyzer)
 
-        if refs:
-            for ref in refs:
-                year = ref.find(".//year")
-
-                if year is not None:
-                    if year.text is None:
-                        missing_data_ref_id_list.append(ref.attrib['id'])
-                    else:
-                        if not re.search(r'\d{4}', year.text):
-                            bad_data.append((ref.attrib['id'], year.text))
-                else:
-                    missing_data_ref_id_list.append(ref.attrib['id'])
+        for ref in refs:
+            if ref.year is None:
+                missing_data_ref_id_list.append(ref.id)
+            elif not re.search(r'\d{4}', ref.year):
+                bad_data.append((ref.id, ref.year))
 
         msg_error = ''
         if missing_data_ref_id_list:
@@ -303,17 +406,11 @@ class ReferenceJournalTypeArticleTitleValidationPipe(vpipes.ValidationPipe):
         lst_errors = []
 
         attempt, pkg_analyzer, journal_and_issue_data = item[:3]
-        refs = pkg_analyzer.xml.findall(".//ref-list/ref")
+        refs = get_reference_index(pkg_analyzer)
 
-        if refs:
-            for ref in refs:
-                article_title = ref.find(".//element-citation[@publication-type='journal']/article-title")
-
-                if article_title is not None:
-                    if article_title.text is None:
-                        lst_errors.append(ref.attrib['id'])
-                else:
-                    lst_errors.append(ref.attrib['id'])
+        for ref in refs:
+            if ref.article_title is None:
+                lst_errors.append(ref.id)
 
         return [models.Status.error, 'Missing data: article-title. (%s)' % ', '.join(lst_errors) ] if lst_errors else [models.Status.ok, 'Valid data: article-title']
 
@@ -335,7 +432,7 @@ class JournalAbbreviatedTitleValidationPipe(vpipes.ValidationPipe):
         abbrev_title = journal_and_issue_data.get('journal').get('short_title')
 
         if abbrev_title:
-            abbrev_title_xml = pkg_analyzer.xml.find('.//journal-meta/abbrev-journal-title[@abbrev-type="publisher"]')
+            abbrev_title_xml = _find(ABBREV_JOURNAL_TITLE, pkg_analyzer.xml)
             if abbrev_title_xml is not None:
                 if self._normalize_data(abbrev_title) == self._normalize_data(abbrev_title_xml.text):
                     return [models.Status.ok, 'Valid abbrev-journal-title: %s' % abbrev_title_xml.text ]
@@ -381,11 +478,11 @@ class FundingGroupValidationPipe(vpipes.ValidationPipe):
 
         xml_tree = pkg_analyzer.xml
 
-        funding_nodes = xml_tree.findall('.//funding-group')
+        funding_nodes = FUNDING_GROUP(xml_tree)
 
         status, description = [models.Status.ok, etree.tostring(funding_nodes[0])] if funding_nodes != [] else [models.Status.warning, 'Missing data: funding-group']
         if status == models.Status.warning:
-            ack_node = xml_tree.findall('.//ack')
+            ack_node = ACK(xml_tree)
             ack_text = etree.tostring(ack_node[0]) if ack_node != [] else ''
 
             if ack_text == '':
@@ -423,7 +520,7 @@ class NLMJournalTitleValidationPipe(vpipes.ValidationPipe):
         j_nlm_title = journal_and_issue_data.get('journal').get('medline_title', '')
 
         xml_tree = pkg_analyzer.xml
-        xml_nlm_title = xml_tree.findtext('.//journal-meta/journal-id[@journal-id-type="nlm-ta"]')
+        xml_nlm_title = _findtext(NLM_JOURNAL_TITLE, xml_tree)
         if not xml_nlm_title:
             xml_nlm_title = ''
         if self._normalize_data(xml_nlm_title) == self._normalize_data(j_nlm_title):
@@ -449,7 +546,7 @@ class DOIVAlidationPipe(vpipes.ValidationPipe):
 
         attempt, pkg_analyzer, journal_data = item[:3]
 
-        doi_xml = pkg_analyzer.xml.findtext('.//article-id/[@pub-id-type="doi"]')
+        doi_xml = _findtext(DOI, pkg_analyzer.xml)
 
         if doi_xml:
             if self._doi_validator(doi_xml):
@@ -482,7 +579,7 @@ class ArticleSectionValidationPipe(vpipes.ValidationPipe):
         attempt, pkg_analyzer, issue_data = item[:3]
 
         xml_tree = pkg_analyzer.xml
-        xml_section = xml_tree.findtext('.//article-categories/subj-group[@subj-group-type="heading"]/subject')
+        xml_section = _findtext(ARTICLE_SECTION, xml_tree)
 
         if xml_section:
             if self._is_a_registered_section_title(issue_data['sections'], xml_section):
@@ -556,7 +653,7 @@ class ArticleMetaPubDateValidationPipe(vpipes.ValidationPipe):
         attempt, pkg_analyzer, issue_data = item[:3]
 
         xml_tree = pkg_analyzer.xml
-        xml_data = xml_tree.findall('.//article-meta//pub-date')
+        xml_data = PUB_DATES(xml_tree)
 
         issue_year = str(issue_data.get('publication_year'))
         issue_start_month_name = _month_abbrev_name.get(issue_data.get('publication_start_month'))
@@ -611,28 +708,54 @@ if __name__ == '__main__':
 
     Session = models.Session
     Session.configure(bind=models.create_engine_from_config(config))
-
-    ppl = vpipes.Pipeline(
-        SetupPipe(notifier_dep, scieloapi, scieloapitoolbelt,
-            checkin.PackageAnalyzer, utils.is_valid_issn, Session),
-        PublisherNameValidationPipe(notifier_dep, utils.normalize_data),
-        JournalAbbreviatedTitleValidationPipe(notifier_dep, utils.normalize_data),
-        NLMJournalTitleValidationPipe(notifier_dep, utils.normalize_data),
-        ArticleSectionValidationPipe(notifier_dep, utils.normalize_data),
-        FundingGroupValidationPipe(notifier_dep),
-        DOIVAlidationPipe(notifier_dep, utils.is_valid_doi),
-        ArticleMetaPubDateValidationPipe(notifier_dep),
-        ReferenceValidationPipe(notifier_dep),
-        ReferenceSourceValidationPipe(notifier_dep),
-        ReferenceJournalTypeArticleTitleValidationPipe(notifier_dep),
-        ReferenceYearValidationPipe(notifier_dep),
-        TearDownPipe(notifier_dep)
-    )
+    models.CacheSession.configure(bind=Session.kw['bind'])
+
+    doi_cache_options = {}
+    if config.has_option('validator', 'doi_cache_ttl'):
+        doi_cache_options['positive_ttl'] = config.getint('validator', 'doi_cache_ttl')
+    if config.has_option('validator', 'doi_cache_negative_ttl'):
+        doi_cache_options['negative_ttl'] = config.getint('validator', 'doi_cache_negative_ttl')
+
+    issue_cache = cache.CoalescingCache(
+        ttl=config.getint('validator', 'issue_cache_ttl') if config.has_option('validator', 'issue_cache_ttl') else 60*60)
+
+    doi_validator = cache.DOIValidator(Session=models.CacheSession,
+        resolver=utils.get_doi_status, **doi_cache_options)
+
+    def make_pipeline():
+        return vpipes.Pipeline(
+            SetupPipe(notifier_dep, scieloapi, scieloapitoolbelt,
+                checkin.PackageAnalyzer, utils.is_valid_issn, Session,
+                issue_cache=issue_cache),
+            PublisherNameValidationPipe(notifier_dep, utils.normalize_data),
+            JournalAbbreviatedTitleValidationPipe(notifier_dep, utils.normalize_data),
+            NLMJournalTitleValidationPipe(notifier_dep, utils.normalize_data),
+            ArticleSectionValidationPipe(notifier_dep, utils.normalize_data),
+            FundingGroupValidationPipe(notifier_dep),
+            DOIVAlidationPipe(notifier_dep, doi_validator),
+            ArticleMetaPubDateValidationPipe(notifier_dep),
+            ReferenceValidationPipe(notifier_dep),
+            ReferenceSourceValidationPipe(notifier_dep),
+            ReferenceJournalTypeArticleTitleValidationPipe(notifier_dep),
+            ReferenceYearValidationPipe(notifier_dep),
+            TearDownPipe(notifier_dep)
+        )
+
+    def setup_process():
+        # Database connections cannot be shared across processes.
+        Session.configure(bind=models.create_engine_from_config(config))
+        models.CacheSession.configure(bind=Session.kw['bind'])
+
+    # Each worker runs its own pipeline, and each message gets
+    # its own db session during the SetupPipe.
+    workers = config.getint('validator', 'workers') if config.has_option('validator', 'workers') else 1
+    mode = config.get('validator', 'mode') if config.has_option('validator', 'mode') else 'threads'
+
+    runner = vpipes.PipelineRunner(make_pipeline, workers=workers, mode=mode,
+        initializer=setup_process if mode == 'processes' else None,
+        teardown=teardown_failed)
 
     try:
-        for msg in ppl.run(messages):
-            # nothing to do here...
-            pass
+        runner.run(messages)
     except KeyboardInterrupt:
         sys.exit(0)
-
@@ -1,4 +1,8 @@
+import time
 import logging
+import threading
+import multiprocessing
+import Queue
 
 from plumber import Pipe, Pipeline, precondition, UnmetPrecondition
 import transaction
@@ -40,7 +44,10 @@ class ValidationPipe(Pipe):
         db_session = item[3]
         logger.debug('%s started processing %s' % (self.__class__.__name__, attempt))
 
+        started = time.time()
         result_status, result_description = self.validate(item)
+        logger.debug('%s validated %s in %.2fms' % (self.__class__.__name__, attempt,
+            (time.time() - started) * 1000))
 
         savepoint = transaction.savepoint()
         try:
@@ -61,3 +68,116 @@ class ValidationPipe(Pipe):
         """
         raise NotImplementedError()
 
+
+
+class PipelineRunner(object):
+    """
+    Runs a pipeline concurrently on many workers.
+
+    Each worker owns a pipeline instance produced by ``pipeline_factory``
+    and consumes messages from a shared bounded queue, so that every
+    message passes through a whole pipeline, from the setup to the
+    teardown pipes, on the same worker.
+
+    When a pipe raises, the teardown pipe is not reached, so the message
+    being processed is handed to ``teardown``, to release what the
+    pipeline holds for it.
+
+    Usage::
+
+        >>> runner = PipelineRunner(lambda: Pipeline(SetupPipe(...), ...), workers=4)
+        >>> runner.run(messages)
+    """
+    MODES = ('threads', 'processes')
+
+    def __init__(self, pipeline_factory, workers=1, mode='threads', initializer=None,
+                 teardown=None):
+        """
+        :param pipeline_factory: callable that returns a new :class:`Pipeline`.
+        :param workers: (optional) number of concurrent workers.
+        :param mode: (optional) run workers as `threads` or `processes`.
+        :param initializer: (optional) callable run by each worker before
+        building its pipeline, e.g. to set up the db engine of a process.
+        :param teardown: (optional) callable run with the message whose
+        processing raised, e.g. to close its db session.
+        """
+        if mode not in self.MODES:
+            raise ValueError('mode must be one of %s' % ', '.join(self.MODES))
+
+        self.pipeline_factory = pipeline_factory
+        self.workers = workers
+        self.mode = mode
+        self.initializer = initializer
+        self.teardown = teardown
+
+    def _consume(self, job_queue):
+        """
+        Pushes all messages from ``job_queue`` through a pipeline,
+        until a ``None`` is received.
+        """
+        if self.initializer:
+            self.initializer()
+
+        ppl = self.pipeline_factory()
+        # the pipes are lazy, so the last message taken from the
+        # queue is the one being processed.
+        current = []
+
+        def messages():
+            for message in iter(job_queue.get, None):
+                current[:] = [message]
+                yield message
+
+        messages = messages()
+
+        while True:
+            try:
+                for _ in ppl.run(messages):
+                    # nothing to do here...
+                    pass
+            except Exception as e:
+                # the message being processed is lost, but the worker
+                # keeps consuming the queue with a fresh pipeline run.
+                logger.exception('Unexpected error while running the pipeline: %s' % e)
+                if self.teardown and current:
+                    self._teardown(current.pop())
+            else:
+                break
+
+    def _teardown(self, message):
+        try:
+            self.teardown(message)
+        except Exception as e:
+            logger.exception('Unexpected error while tearing down %s: %s' % (message, e))
+
+    def run(self, messages):
+        """
+        Dispatches ``messages`` to the workers and blocks until
+        all of them had been processed.
+
+        :param messages: an iterable of messages.
+        """
+        if self.mode == 'processes':
+            job_queue = multiprocessing.Queue(self.workers * 2)
+            worker_class = multiprocessing.Process
+        else:
+            job_queue = Queue.Queue(self.workers * 2)
+            worker_class = threading.Thread
+
+        running_workers = []
+        for w in range(self.workers):
+            worker = worker_class(target=self._consume, args=(job_queue,))
+            worker.daemon = True
+            running_workers.append(worker)
+            worker.start()
+
+        logger.info('Running the pipeline on %s %s' % (self.workers, self.mode))
+
+        for message in messages:
+            job_queue.put(message)
+
+        for worker in running_workers:
+            job_queue.put(None)
+
+        for worker in running_workers:
+            worker.join()
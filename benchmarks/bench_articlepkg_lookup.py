@@ -0,0 +1,101 @@
+# coding: utf-8
+"""
+Measures the latency of ArticlePkg.get_or_create_from_package as the
+articlepkg table grows, against the former lookup by article_title.
+
+Usage::
+
+    $ python benchmarks/bench_articlepkg_lookup.py [dsn] [max rows]
+
+The default dsn is an in-memory SQLite database. Pass a PostgreSQL dsn
+to reproduce production numbers. The tables are recreated.
+"""
+import os
+import sys
+import time
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from balaio import models
+
+
+LOOKUPS = 200
+BATCH_SIZE = 10000
+
+
+class PackageStub(object):
+    def __init__(self, meta):
+        self.meta = meta
+
+
+def make_meta(i):
+    return {'article_title': 'Article title number %s' % i,
+            'journal_pissn': '0100-879X',
+            'journal_eissn': '1414-431X',
+            'journal_title': 'Brazilian Journal of Medical and Biological Research',
+            'issue_year': 1990 + i % 25,
+            'issue_volume': str(i % 50),
+            'issue_number': str(i % 12),
+            'issue_suppl_volume': None,
+            'issue_suppl_number': None}
+
+
+def populate(engine, start, end):
+    rows = []
+    for i in range(start, end):
+        meta = make_meta(i)
+        rows.append(dict(meta, id=i + 1, aid='%010d' % i,
+                         identity=models.ArticlePkg.make_identity(meta)))
+
+    for offset in range(0, len(rows), BATCH_SIZE):
+        engine.execute(models.ArticlePkg.__table__.insert(), rows[offset:offset + BATCH_SIZE])
+
+
+def measure(Session, rows, lookup):
+    session = Session()
+    samples = [random.randrange(rows) for i in range(LOOKUPS)]
+
+    started = time.time()
+    for i in samples:
+        lookup(session, make_meta(i))
+    elapsed = time.time() - started
+
+    session.close()
+    return elapsed / LOOKUPS * 1000
+
+
+def by_identity(session, meta):
+    return models.ArticlePkg.get_or_create_from_package(PackageStub(meta), session)
+
+
+def by_title(session, meta):
+    return session.query(models.ArticlePkg).filter_by(article_title=meta['article_title']).one()
+
+
+def main(dsn='sqlite://', max_rows=1000000):
+    engine = create_engine(dsn)
+    models.Base.metadata.drop_all(engine)
+    models.Base.metadata.create_all(engine)
+    Session = sessionmaker(bind=engine)
+
+    print '%10s %14s %14s' % ('rows', 'identity (ms)', 'title (ms)')
+    rows = 0
+    size = 1000
+    while size <= max_rows:
+        populate(engine, rows, size)
+        rows = size
+
+        print '%10d %14.3f %14.3f' % (rows, measure(Session, rows, by_identity),
+                                      measure(Session, rows, by_title))
+        size *= 10
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:3]
+    if len(args) > 1:
+        args[1] = int(args[1])
+    main(*args)
@@ -0,0 +1,352 @@
+# coding: utf-8
+"""
+Measures the throughput of the checkin -> validation pipeline, and of
+the http API, with synthetic SPS packages shaped like the sample package.
+
+Packages vary in size and in number of references. SciELO Manager,
+CrossRef and the notifications are replaced by the test doubles, so
+only balaio code and the database are measured.
+
+Usage::
+
+    $ python benchmarks/bench_pipeline.py [--dsn DSN] [--packages N]
+        [--references N] [--json results.json] [--baseline baseline.json]
+
+The default dsn is an in-memory SQLite database. Pass a PostgreSQL dsn
+to reproduce production numbers. The tables are recreated.
+
+With ``--baseline``, the p90 latencies are compared against a previous
+``--json`` output, and the exit status is 1 if any stage regressed more
+than ``--tolerance``.
+"""
+import os
+import sys
+import copy
+import json
+import time
+import shutil
+import zipfile
+import argparse
+import resource
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+# httpd resolves its renderers as a top level module.
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'balaio'))
+
+from lxml import etree
+from sqlalchemy import create_engine
+from webtest import TestApp
+
+from balaio import models, checkin, validator, vpipes, httpd, utils
+from balaio.tests import doubles
+
+
+SAMPLE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+    'samples', '0042-9686-bwho-91-08-545.zip')
+
+# sizes of the pdf files, in bytes. The sample pdf is about 900KB.
+PDF_SIZES = (100 * 1024, 900 * 1024, 5 * 1024 * 1024)
+
+REF_TEMPLATE = '''<ref id="B%(i)s">
+  <element-citation publication-type="journal">
+    <person-group person-group-type="author">
+      <name><surname>Surname</surname><given-names>G</given-names></name>
+    </person-group>
+    <article-title>Title of the reference %(i)s</article-title>
+    <source>Source %(i)s</source>
+    <year>19%(year)02d</year>
+    <volume>49</volume>
+    <fpage>641</fpage>
+  </element-citation>
+</ref>'''
+
+ISSUE_DATA = {
+    'publication_year': 2013,
+    'publication_start_month': 8,
+    'publication_end_month': 0,
+    'sections': [{'titles': [['en', "In This Month's Bulletin"]]}],
+    'journal': {
+        'publisher_name': 'World Health Organization',
+        'short_title': 'Bull. World Health Organ.',
+        'medline_title': 'Bull World Health Organ',
+    },
+}
+
+
+#
+# Synthetic packages
+#
+def load_sample(sample=SAMPLE):
+    """
+    Returns a tuple (name of the xml, xml tree, pdf bytes) of the sample package.
+    """
+    with zipfile.ZipFile(sample) as zfile:
+        names = zfile.namelist()
+        xml_name = [name for name in names if name.endswith('.xml')][0]
+        pdf_name = [name for name in names if name.endswith('.pdf')][0]
+        return xml_name, etree.fromstring(zfile.read(xml_name)), zfile.read(pdf_name)
+
+
+def make_package(path, i, references, sample):
+    """
+    Writes the i-th synthetic package to `path` and returns its filepath.
+    """
+    xml_name, xml, pdf = sample
+    xml = copy.deepcopy(xml)
+
+    # each package is a distinct article.
+    xml.find('.//article-meta/title-group/article-title').text = 'Synthetic article %s ' % i
+    xml.find('.//article-meta/article-id[@pub-id-type="publisher-id"]').text = 'BLT.13.%06d' % i
+
+    back = etree.SubElement(xml, 'back')
+    ref_list = etree.SubElement(back, 'ref-list')
+    for ref in range(references):
+        ref_list.append(etree.fromstring(REF_TEMPLATE % {'i': ref, 'year': ref % 100}))
+
+    size = PDF_SIZES[i % len(PDF_SIZES)]
+    pdf = (pdf * (size // len(pdf) + 1))[:size]
+
+    filepath = os.path.join(path, 'synthetic-%06d.zip' % i)
+    with zipfile.ZipFile(filepath, 'w', zipfile.ZIP_DEFLATED) as zfile:
+        zfile.writestr(xml_name, etree.tostring(xml, xml_declaration=True, encoding='utf-8'))
+        zfile.writestr(xml_name.replace('.xml', '.pdf'), pdf)
+
+    return filepath
+
+
+def make_packages(path, total, references):
+    """
+    Writes `total` packages, with 0 to `references` references.
+    """
+    sample = load_sample()
+    steps = max(total - 1, 1)
+    return [make_package(path, i, references * i // steps, sample) for i in range(total)]
+
+
+#
+# Measures
+#
+class Stage(object):
+    """
+    Latencies, in seconds, of the successful calls of a stage of the
+    pipeline. Failed calls are only counted as errors.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.latencies = []
+        self.errors = 0
+        self.elapsed = 0.0
+
+    def percentile(self, p):
+        if not self.latencies:
+            return 0.0
+        latencies = sorted(self.latencies)
+        return latencies[min(int(len(latencies) * p / 100.0), len(latencies) - 1)]
+
+    def report(self):
+        return {
+            'count': len(self.latencies),
+            'errors': self.errors,
+            'per_second': len(self.latencies) / self.elapsed if self.elapsed else 0.0,
+            'p50_ms': self.percentile(50) * 1000,
+            'p90_ms': self.percentile(90) * 1000,
+            'p99_ms': self.percentile(99) * 1000,
+            'max_ms': max(self.latencies) * 1000 if self.latencies else 0.0,
+        }
+
+
+def timed(stage, func):
+    def _timed(*args, **kwargs):
+        started = time.time()
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            stage.errors += 1
+            raise
+        stage.latencies.append(time.time() - started)
+        return result
+    return _timed
+
+
+def max_rss():
+    """
+    Peak resident memory of the process, in MB.
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+#
+# Stages
+#
+def run_checkin(filepaths, stages):
+    stage = stages.setdefault('checkin', Stage('checkin'))
+    get_attempt = timed(stage, checkin.get_attempt)
+
+    attempts = []
+    started = time.time()
+    for filepath in filepaths:
+        try:
+            attempts.append(get_attempt(filepath))
+        except Exception as e:
+            print >> sys.stderr, 'checkin failed for %s: %s' % (filepath, e)
+    stage.elapsed = time.time() - started
+
+    return attempts
+
+
+def make_scieloapi():
+    scieloapi = doubles.ScieloAPIClientStub()
+    scieloapi.journals.filter = lambda **kwargs: [ISSUE_DATA['journal']]
+    scieloapi.issues.filter = lambda **kwargs: [ISSUE_DATA]
+    return scieloapi
+
+
+def run_validation(attempts, stages):
+    notifier = lambda attempt, session: doubles.NotifierStub()
+    pipes = [
+        validator.SetupPipe(notifier, make_scieloapi(), doubles.get_ScieloAPIToolbeltStubModule(),
+            checkin.PackageAnalyzer, utils.is_valid_issn, models.Session),
+        validator.PublisherNameValidationPipe(notifier, utils.normalize_data),
+        validator.JournalAbbreviatedTitleValidationPipe(notifier, utils.normalize_data),
+        validator.NLMJournalTitleValidationPipe(notifier, utils.normalize_data),
+        validator.ArticleSectionValidationPipe(notifier, utils.normalize_data),
+        validator.FundingGroupValidationPipe(notifier),
+        validator.DOIVAlidationPipe(notifier, lambda doi: True),
+        validator.ArticleMetaPubDateValidationPipe(notifier),
+        validator.ReferenceValidationPipe(notifier),
+        validator.ReferenceSourceValidationPipe(notifier),
+        validator.ReferenceJournalTypeArticleTitleValidationPipe(notifier),
+        validator.ReferenceYearValidationPipe(notifier),
+        validator.TearDownPipe(notifier),
+    ]
+
+    for pipe in pipes:
+        name = 'validation.%s' % pipe.__class__.__name__
+        pipe.transform = timed(stages.setdefault(name, Stage(name)), pipe.transform)
+
+    stage = stages.setdefault('validation', Stage('validation'))
+    started = time.time()
+    for attempt in vpipes.Pipeline(*pipes).run(attempts):
+        stage.latencies.append(time.time() - started - sum(stage.latencies))
+    stage.elapsed = time.time() - started
+
+    for pipe in pipes:
+        stages['validation.%s' % pipe.__class__.__name__].elapsed = stage.elapsed
+
+
+class ConfigStub(object):
+    def items(self):
+        return [('http_server', {'total_count': 'exact', 'limit': 20})]
+
+
+def run_api(engine, attempts, stages, rounds=20):
+    testapp = TestApp(httpd.main(ConfigStub(), engine))
+    attempt_ids = [attempt.id for attempt in attempts][:rounds]
+
+    urls = {
+        'api.list_attempts': ['/api/v1/attempts/'] * rounds,
+        'api.list_packages': ['/api/v1/packages/'] * rounds,
+        'api.attempt': ['/api/v1/attempts/%s/' % i for i in attempt_ids],
+    }
+
+    for name, paths in sorted(urls.items()):
+        stage = stages.setdefault(name, Stage(name))
+        get = timed(stage, testapp.get)
+        started = time.time()
+        for path in paths:
+            try:
+                get(path, status=200)
+            except Exception as e:
+                print >> sys.stderr, 'GET %s failed: %s' % (path, e)
+        stage.elapsed = time.time() - started
+
+
+#
+# Reports
+#
+def print_report(results):
+    print '%-58s %7s %6s %9s %9s %9s %9s %9s' % (
+        'stage', 'count', 'errors', 'per sec', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms')
+    for name, report in sorted(results['stages'].items()):
+        print ('%-58s' % name) + (' %(count)7d %(errors)6d %(per_second)9.1f'
+            ' %(p50_ms)9.2f %(p90_ms)9.2f %(p99_ms)9.2f %(max_ms)9.2f' % report)
+
+    print
+    for name, rss in results['memory_mb']:
+        print 'peak memory after %-12s %8.1f MB' % (name, rss)
+
+
+def compare(results, baseline, tolerance):
+    """
+    Returns the names of the stages whose p90 regressed more than `tolerance`.
+    """
+    regressions = []
+    for name, report in results['stages'].items():
+        previous = baseline['stages'].get(name)
+        if previous and previous['p90_ms'] and report['p90_ms'] > previous['p90_ms'] * (1 + tolerance):
+            regressions.append(name)
+            print 'REGRESSION %s: p90 %.2fms, was %.2fms' % (name, report['p90_ms'], previous['p90_ms'])
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--dsn', default='sqlite://')
+    parser.add_argument('--packages', type=int, default=30)
+    parser.add_argument('--references', type=int, default=200,
+                        help='max number of references per package')
+    parser.add_argument('--json', help='file to write the results to')
+    parser.add_argument('--baseline', help='results of a previous run')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args(argv)
+
+    engine = create_engine(args.dsn)
+    models.Base.metadata.drop_all(engine)
+    models.Base.metadata.create_all(engine)
+    models.Session.configure(bind=engine)
+
+    path = tempfile.mkdtemp()
+    stages = {}
+    memory = [('start', max_rss())]
+    try:
+        filepaths = make_packages(path, args.packages, args.references)
+        memory.append(('generation', max_rss()))
+
+        attempts = run_checkin(filepaths, stages)
+        memory.append(('checkin', max_rss()))
+        if not attempts:
+            print >> sys.stderr, 'No package was checked in, nothing to measure.'
+            return 1
+
+        run_validation([attempt for attempt in attempts if attempt.is_valid], stages)
+        memory.append(('validation', max_rss()))
+
+        run_api(engine, attempts, stages)
+        memory.append(('api', max_rss()))
+    finally:
+        shutil.rmtree(path)
+
+    results = {
+        'dsn': engine.url.drivername,
+        'packages': args.packages,
+        'references': args.references,
+        'stages': dict((name, stage.report()) for name, stage in stages.items()),
+        'memory_mb': memory,
+    }
+    print_report(results)
+
+    if args.json:
+        with open(args.json, 'w') as fp:
+            json.dump(results, fp, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as fp:
+            if compare(results, json.load(fp), args.tolerance):
+                return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
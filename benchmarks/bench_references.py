@@ -0,0 +1,150 @@
+# coding: utf-8
+"""
+Compares the reference validation pipes walking the tree on each pipe
+against the single-pass reference index shared by them.
+
+Each pipe is run through `ValidationPipe.transform`, the way the
+validator runs it, on a new package for each attempt. The pipes of
+the ``before`` column walk the tree as they used to.
+
+Usage::
+
+    $ python benchmarks/bench_references.py [number of references] [rounds] [repeat]
+"""
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from lxml import etree
+
+from balaio import validator, models
+
+
+REF_TEMPLATE = '''
+<ref id="B%(i)s">
+  <element-citation publication-type="journal">
+    <person-group person-group-type="author">
+      <name><surname>Surname</surname><given-names>G</given-names></name>
+    </person-group>
+    <article-title xml:lang="en">Title %(i)s</article-title>
+    <source>Source %(i)s</source>
+    <year>19%(year)02d</year>
+    <volume>49</volume>
+    <page-range>641-46</page-range>
+  </element-citation>
+</ref>'''
+
+
+class PackageAnalyzer(object):
+    def __init__(self, xml):
+        self.xml = xml
+
+
+class AttemptStub(object):
+    is_valid = True
+
+
+class NotifierStub(object):
+    def __init__(self, attempt, session):
+        pass
+
+    def tell(self, message, status, label=None):
+        pass
+
+
+def make_xml(refs):
+    body = ''.join(REF_TEMPLATE % {'i': i, 'year': i % 100} for i in range(refs))
+    return etree.ElementTree(etree.fromstring('<article><back><ref-list>%s</ref-list></back></article>' % body))
+
+
+class OldReferenceValidationPipe(validator.ReferenceValidationPipe):
+    def validate(self, item):
+        refs = item[1].xml.findall('.//ref-list/ref')
+        if refs:
+            return [models.Status.ok, 'Found ' + str(len(refs)) + ' references']
+        else:
+            return [models.Status.warning, 'Missing data: references']
+
+
+def _missing(refs, path):
+    errors = []
+    for ref in refs:
+        elem = ref.find(path)
+        if elem is None or elem.text is None:
+            errors.append(ref.attrib['id'])
+    return errors
+
+
+class OldReferenceSourceValidationPipe(validator.ReferenceSourceValidationPipe):
+    def validate(self, item):
+        errors = _missing(item[1].xml.findall('.//ref-list/ref'), './/source')
+        return [models.Status.error, ', '.join(errors)] if errors else [models.Status.ok, 'Valid data: source']
+
+
+class OldReferenceYearValidationPipe(validator.ReferenceYearValidationPipe):
+    def validate(self, item):
+        missing, bad_data = [], []
+        for ref in item[1].xml.findall('.//ref-list/ref'):
+            year = ref.find('.//year')
+            if year is None or year.text is None:
+                missing.append(ref.attrib['id'])
+            elif not re.search(r'\d{4}', year.text):
+                bad_data.append((ref.attrib['id'], year.text))
+        return [models.Status.error, 'error'] if missing or bad_data else [models.Status.ok, 'Valid data: year']
+
+
+class OldReferenceJournalTypeArticleTitleValidationPipe(
+        validator.ReferenceJournalTypeArticleTitleValidationPipe):
+    def validate(self, item):
+        errors = _missing(item[1].xml.findall('.//ref-list/ref'),
+                          ".//element-citation[@publication-type='journal']/article-title")
+        return [models.Status.error, ', '.join(errors)] if errors else [models.Status.ok, 'Valid data: article-title']
+
+
+BEFORE = (OldReferenceValidationPipe, OldReferenceSourceValidationPipe,
+          OldReferenceYearValidationPipe, OldReferenceJournalTypeArticleTitleValidationPipe)
+AFTER = (validator.ReferenceValidationPipe, validator.ReferenceSourceValidationPipe,
+         validator.ReferenceYearValidationPipe, validator.ReferenceJournalTypeArticleTitleValidationPipe)
+
+
+def time_pipes(pipe_classes, xml, rounds):
+    """
+    Returns the seconds spent by each pipe on `rounds` attempts.
+    """
+    pipes = [pipe_class(NotifierStub) for pipe_class in pipe_classes]
+    elapsed = [0.0] * len(pipes)
+    for i in range(rounds):
+        # the reference index is built once per package.
+        item = (AttemptStub(), PackageAnalyzer(xml), {}, None)
+        for j, pipe in enumerate(pipes):
+            started = time.time()
+            pipe.transform(item)
+            elapsed[j] += time.time() - started
+    return elapsed
+
+
+def best_of(repeat, pipe_classes, xml, rounds):
+    """
+    The least time of each pipe among `repeat` runs.
+    """
+    return [min(times) for times in zip(*[time_pipes(pipe_classes, xml, rounds)
+                                          for i in range(repeat)])]
+
+
+def main(refs=500, rounds=50, repeat=3):
+    xml = make_xml(refs)
+    before = best_of(repeat, BEFORE, xml, rounds)
+    after = best_of(repeat, AFTER, xml, rounds)
+
+    print 'references: %s, rounds: %s' % (refs, rounds)
+    print '%-48s %12s %12s' % ('ms/attempt', 'before', 'after')
+    for pipe_class, old, new in zip(AFTER, before, after):
+        print '%-48s %12.2f %12.2f' % (pipe_class.__name__, old / rounds * 1000, new / rounds * 1000)
+    print '%-48s %12.2f %12.2f' % ('total', sum(before) / rounds * 1000, sum(after) / rounds * 1000)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:4]])
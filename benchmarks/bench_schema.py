@@ -0,0 +1,91 @@
+# coding: utf-8
+"""
+Compares validating packages against a freshly compiled SPS schema,
+the way each PackageAnalyzer used to do, against the schema compiled
+once by checkin.schema_registry.
+
+The registry is also measured from concurrent threads, as used by the
+monitor workers.
+
+Usage::
+
+    $ python benchmarks/bench_schema.py [package] [packages] [threads]
+"""
+import os
+import sys
+import time
+import zipfile
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from lxml import etree
+
+from balaio import checkin
+
+
+SAMPLE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+    'samples', '0042-9686-bwho-91-08-545.zip')
+
+
+def load_xml(package):
+    with zipfile.ZipFile(package) as zfile:
+        name = [name for name in zfile.namelist() if name.endswith('.xml')][0]
+        return etree.parse(zfile.open(name))
+
+
+def fresh_schema(xml):
+    schema = etree.XMLSchema(etree.parse(checkin.SPS_XSD))
+    return schema.validate(xml)
+
+
+def registry_schema(xml):
+    return checkin.schema_registry.validate(checkin.SPS_XSD, xml)
+
+
+def concurrent(package, packages, threads):
+    """
+    Validates `packages` packages on each one of `threads` threads.
+    Each thread works on its own tree, as the monitor workers do.
+    """
+    def work():
+        xml = load_xml(package)
+        # the compilation is measured apart.
+        registry_schema(xml)
+        ready.wait()
+        for i in range(packages):
+            registry_schema(xml)
+
+    ready = threading.Event()
+    workers = [threading.Thread(target=work) for i in range(threads)]
+    for worker in workers:
+        worker.start()
+
+    time.sleep(0.5)
+    started = time.time()
+    ready.set()
+    for worker in workers:
+        worker.join()
+    return time.time() - started
+
+
+def main(package=SAMPLE, packages=20, threads=4):
+    xml = load_xml(package)
+
+    print 'package: %s, packages: %s, threads: %s' % (os.path.basename(package), packages, threads)
+    for func in (fresh_schema, registry_schema):
+        started = time.time()
+        for i in range(packages):
+            func(xml)
+        elapsed = time.time() - started
+        print '%-16s %10.2f ms/package' % (func.__name__, elapsed / packages * 1000)
+
+    elapsed = concurrent(package, packages, threads)
+    print '%-16s %10.2f ms/package' % ('%s threads' % threads, elapsed / (packages * threads) * 1000)
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:4]
+    for i in range(1, len(args)):
+        args[i] = int(args[i])
+    main(*args)
@@ -0,0 +1,296 @@
+# coding: utf-8
+"""
+Measures the throughput of StaticScieloBackend.send with a new SFTP
+connection per asset, as before the connection pool, against the
+pooled connections, with concurrent senders. The mkdir requests
+received by the server are counted too.
+
+Then measures the publication of an issue, i.e. files on disk of
+varying sizes, sent one at a time against StaticScieloBackend.send_many,
+and the resubmission of the issue with a tenth of its files changed,
+with and without an AssetManifest. The issue is also published with
+FileSystemBackend, with hardlinks and with copies.
+
+A local paramiko SFTP server, backed by a temporary directory, stands in
+for static.scielo.org.
+
+Usage::
+
+    $ python benchmarks/bench_uploader.py [assets] [threads]
+"""
+import os
+import sys
+import time
+import shutil
+import socket
+import tempfile
+import threading
+from StringIO import StringIO
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import paramiko
+
+from balaio import uploader, models
+
+
+ASSET_SIZE = 64 * 1024
+# sizes of the files of an issue: xml, images and pdf.
+ISSUE_FILE_SIZES = (50 * 1024, 200 * 1024, 2 * 1024 * 1024)
+USERNAME = u'balaio'
+PASSWORD = u'balaio'
+
+
+#
+# SFTP server stand-in
+#
+class Server(paramiko.ServerInterface):
+
+    def check_auth_password(self, username, password):
+        if (username, password) == (USERNAME, PASSWORD):
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+    def get_allowed_auths(self, username):
+        return 'password'
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED
+
+
+class Handle(paramiko.SFTPHandle):
+    def stat(self):
+        return paramiko.SFTPAttributes.from_stat(os.fstat(self.filehandle.fileno()))
+
+
+class SFTPServer(paramiko.SFTPServerInterface):
+    """
+    Serves the files under `root`.
+    """
+    root = None
+    mkdirs = 0
+    uploads = 0
+
+    def _local(self, path):
+        return os.path.join(self.root, self.canonicalize(path).lstrip('/'))
+
+    def canonicalize(self, path):
+        return os.path.normpath('/' + path)
+
+    def stat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.stat(self._local(path)))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    lstat = stat
+
+    def mkdir(self, path, attr):
+        SFTPServer.mkdirs += 1
+        try:
+            os.mkdir(self._local(path))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def remove(self, path):
+        try:
+            os.remove(self._local(path))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def rename(self, oldpath, newpath):
+        try:
+            os.rename(self._local(oldpath), self._local(newpath))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def symlink(self, target_path, path):
+        try:
+            # relative targets are kept, as a real server does.
+            if target_path.startswith('/'):
+                target_path = self._local(target_path)
+            os.symlink(target_path, self._local(path))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def open(self, path, flags, attr):
+        if flags & os.O_WRONLY:
+            SFTPServer.uploads += 1
+        try:
+            fp = open(self._local(path), 'wb' if flags & os.O_WRONLY else 'rb')
+        except (IOError, OSError) as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+        handle = Handle(flags)
+        handle.filename = path
+        handle.readfile = handle.writefile = handle.filehandle = fp
+        return handle
+
+
+def serve(root):
+    """
+    Starts the SFTP server on a random port, and returns the port.
+    """
+    SFTPServer.root = root
+    host_key = paramiko.RSAKey.generate(1024)
+
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(100)
+
+    def accept():
+        while True:
+            client, addr = listener.accept()
+            transport = paramiko.Transport(client)
+            transport.add_server_key(host_key)
+            transport.set_subsystem_handler('sftp', paramiko.SFTPServer, SFTPServer)
+            transport.start_server(server=Server())
+
+    thread = threading.Thread(target=accept)
+    thread.daemon = True
+    thread.start()
+
+    return listener.getsockname()[1]
+
+
+#
+# Measures
+#
+def send_fresh(backend, path):
+    # a new connection per asset.
+    conn = backend._connect()
+    try:
+        backend._send(conn, StringIO('x' * ASSET_SIZE), path)
+    finally:
+        conn.close()
+
+
+def send_pooled(backend, path):
+    backend.send(StringIO('x' * ASSET_SIZE), path)
+
+
+def measure(send, backend, assets, threads):
+    paths = [u'/journals/issue%s/asset%s.pdf' % (i % 10, i) for i in range(assets)]
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                if not paths:
+                    return
+                path = paths.pop()
+            send(backend, path)
+
+    workers = [threading.Thread(target=worker) for i in range(threads)]
+    started = time.time()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+
+    elapsed = time.time() - started
+
+    mkdirs, SFTPServer.mkdirs = SFTPServer.mkdirs, 0
+    return assets / elapsed, mkdirs
+
+
+def make_issue(path, assets):
+    items = []
+    for i in range(assets):
+        filepath = os.path.join(path, 'file%s' % i)
+        with open(filepath, 'wb') as fp:
+            fp.write(os.urandom(ISSUE_FILE_SIZES[i % len(ISSUE_FILE_SIZES)]))
+        items.append((filepath, u'/journals/issue/file%s' % i))
+    return items
+
+
+def measure_serial(backend, items):
+    started = time.time()
+    with backend:
+        for filepath, path in items:
+            with open(filepath, 'rb') as fp:
+                backend.send(fp, path)
+    return len(items) / (time.time() - started)
+
+
+def measure_send_many(backend, items, threads):
+    started = time.time()
+    results = backend.send_many(items, workers=threads)
+    elapsed = time.time() - started
+
+    assert all(result.error is None for result in results)
+    return len(items) / elapsed
+
+
+def measure_resubmission(backend, items, threads):
+    """
+    Sends the issue, changes a tenth of its files and sends it again.
+    Returns a tuple (files/sec of the resubmission, files uploaded).
+    """
+    backend.send_many(items, workers=threads)
+
+    for filepath, path in items[::10]:
+        with open(filepath, 'ab') as fp:
+            fp.write('changed')
+
+    SFTPServer.uploads = 0
+    started = time.time()
+    results = backend.send_many(items, workers=threads)
+    elapsed = time.time() - started
+
+    assert all(result.error is None for result in results)
+    return len(items) / elapsed, SFTPServer.uploads
+
+
+def main(assets=200, threads=4):
+    root = tempfile.mkdtemp()
+    issue_path = tempfile.mkdtemp()
+    try:
+        port = serve(root)
+        backend = uploader.StaticScieloBackend(USERNAME, PASSWORD, u'/', host=u'127.0.0.1',
+                                               port=port, pool_size=threads)
+
+        print '%-8s %14s %8s' % ('mode', 'assets/sec', 'mkdirs')
+        print '%-8s %14.1f %8d' % (('fresh',) + measure(send_fresh, backend, assets, threads))
+        print '%-8s %14.1f %8d' % (('pooled',) + measure(send_pooled, backend, assets, threads))
+        print backend.pool.stats()
+
+        items = make_issue(issue_path, assets)
+        print
+        print '%-10s %14s' % ('issue', 'files/sec')
+        print '%-10s %14.1f' % ('serial', measure_serial(backend, items))
+        print '%-10s %14.1f' % ('send_many', measure_send_many(backend, items, threads))
+
+        engine = create_engine('sqlite:///%s' % os.path.join(issue_path, 'manifest.db'))
+        models.Base.metadata.create_all(engine)
+        manifest = uploader.AssetManifest(Session=sessionmaker(bind=engine, expire_on_commit=False))
+
+        print
+        print '%-14s %14s %8s' % ('resubmission', 'files/sec', 'uploads')
+        for name, manifest in [('no manifest', None), ('manifest', manifest)]:
+            backend.manifest = manifest
+            print '%-14s %14.1f %8d' % ((name,) + measure_resubmission(backend, items, threads))
+
+        print
+        print '%-14s %14s' % ('filesystem', 'files/sec')
+        for name, hardlink in [('hardlink', True), ('copy', False)]:
+            fs_path = tempfile.mkdtemp(dir=issue_path)
+            fs = uploader.FileSystemBackend(fs_path, hardlink=hardlink)
+            print '%-14s %14.1f' % (name, measure_send_many(fs, items, threads))
+
+        backend.pool.close()
+    finally:
+        shutil.rmtree(root)
+        shutil.rmtree(issue_path)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:3]])
@@ -26,5 +26,7 @@ setup(
     ],
     setup_requires=["nose>=1.0", "coverage"],
     tests_require=["mocker"],
+    # copies files between filesystems in the kernel, see uploader.FileSystemBackend.
+    extras_require={"sendfile": ["pysendfile"]},
     test_suite="nose.collector",
 )